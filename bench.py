@@ -0,0 +1,477 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import gc
+import json
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+
+from db import UserRecord, local_day
+from storage import MemoryStorage, ShardedStorage, SQLiteStorage, shard_paths
+from update_processor import PerUserUpdateProcessor
+from transport import build_request
+
+
+# --- updates: пропускная способность обработки апдейтов в зависимости от CONCURRENT_UPDATES ---
+async def run_updates(concurrency, users, per_user, latency):
+    processor = PerUserUpdateProcessor(concurrency)
+    seen = {}
+
+    async def handle(update):
+        # Имитация хэндлера: немного работы и ожидание ответа Bot API
+        await asyncio.sleep(latency)
+        seen.setdefault(update.effective_user.id, []).append(update.seq)
+
+    updates = [
+        SimpleNamespace(effective_user=SimpleNamespace(id=user_id), seq=seq)
+        for seq in range(per_user)
+        for user_id in range(users)
+    ]
+    tasks = []
+    started = time.perf_counter()
+    for update in updates:
+        if concurrency > 1:
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(update))))
+        else:
+            await processor.process_update(update, handle(update))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    # Порядок апдейтов каждого пользователя должен сохраняться
+    assert all(seqs == sorted(seqs) for seqs in seen.values()), "per-user order violated"
+    return len(updates) / elapsed
+
+
+def bench_updates(args):
+    print(f"{args.users} users x {args.per_user} updates, handler latency {args.latency * 1000:.0f} ms")
+    print(f"{'concurrency':>12} {'updates/s':>12}")
+    for concurrency in args.concurrency:
+        rate = asyncio.run(run_updates(concurrency, args.users, args.per_user, args.latency))
+        print(f"{concurrency:>12} {rate:>12.1f}")
+
+
+# --- storage: одинаковое поведение и скорость SQLiteStorage и MemoryStorage ---
+STORAGE_TZS = ("Europe/Kyiv", "Europe/London", "America/New_York", "Asia/Tokyo")
+
+
+def conformance_script(storage, users, seed):
+    # Один и тот же сценарий для любого хранилища; возвращает всё, что вернули операции
+    rng = random.Random(seed)
+    results = []
+    for user_id in range(1, users + 1):
+        storage.add_user(user_id, f"user{user_id}", 480, 1200, 3, username=f"u{user_id}", tz=STORAGE_TZS[user_id % len(STORAGE_TZS)])
+    storage.add_user(1, "duplicate", 0, 0, 0)
+    for chat_id in (-1, -2):
+        for user_id in range(1, users + 1, abs(chat_id) + 1):
+            results.append(("join", storage.join_group(chat_id, f"group{chat_id}", user_id)))
+    results.append(("join again", storage.join_group(-1, "group-1", 1)))
+    results.append(("leave", storage.leave_group(-2, 1), storage.leave_group(-2, 1)))
+    for _ in range(users * 5):
+        user_id = rng.randint(1, users + 1)
+        op = rng.random()
+        if op < 0.6:
+            results.append(("add", user_id, storage.add_pushups(user_id, rng.choice((10, 15, 20, 25, 40)))))
+        elif op < 0.7:
+            results.append(("dec", user_id, storage.decrease_pushups(user_id, 5)))
+        elif op < 0.75:
+            results.append(("fail", user_id, storage.fail_day(user_id)))
+        elif op < 0.78:
+            storage.set_game_over(user_id, 1)
+        elif op < 0.8:
+            storage.next_day(user_id)
+        results.append(("pushups", user_id, storage.get_pushups_today(user_id), storage.get_fails(user_id), storage.get_game_over(user_id)))
+    some = list(range(users, 0, -3)) + [users + 100, 7, 7]
+    results.append(("get_users", sorted((u for u in storage.get_users(some)), key=lambda u: u.user_id)))
+    results.append(("fail_days", sorted(storage.fail_days(some[:len(some) // 2]))))
+    results.append(("next_days", sorted(storage.next_days(some))))
+    results.append(("notify many", storage.set_notify_fail_many(some[:5], 1)))
+    results.append(("game over many", sorted(storage.set_game_over_many(some[-6:], 1))))
+    storage.update_user_settings(2, 420, 1260, 5, tz="Asia/Tokyo")
+    storage.set_notify_fail(3, 1)
+    storage.set_greeted_day(3, 42)
+    storage.set_card_message_id(3, 777)
+    storage.save_scheduler_state([(3, "greeting", 1, 2), (3, "summary", 3, 4), (3, "greeting", 5, 6)])
+    results.append(("scheduler", storage.get_scheduler_state(3), storage.get_scheduler_state(4)))
+    results.append(("notify", storage.get_notify_fail(3), storage.get_notify_fail(4)))
+    results.append(("leaderboard", sorted(storage.get_leaderboard_rows(), key=lambda row: row.user_id)))
+    # Порядок при равенстве в SQL не определён — сравниваем пары (отжимания, время финиша)
+    results.append(("top", [(row.pushups_today, row.completed_at) for row in storage.get_top_pushups_today(10)]))
+    results.append(("group top", [(row.pushups_today, row.completed_at) for row in storage.get_group_top(-1, 10)]))
+    results.append(("group summary", storage.get_group_summary(-1), storage.get_group_summary(-2)))
+    results.append(("timezones", sorted(storage.get_timezones())))
+    results.append(("in timezones", sorted(storage.get_users_in_timezones(["Asia/Tokyo", "Europe/London"]), key=lambda u: u.user_id)))
+    today = local_day("Europe/Kyiv")
+    results.append(("rollover", storage.rollover_timezones(["Europe/Kyiv", "Asia/Tokyo"], today + 1)))
+    for user_id in range(1, users + 1, 4):
+        storage.add_pushups(user_id, 100 if user_id % 8 == 1 else 40)
+    results.append(("rollover 2", storage.rollover_timezones(["Europe/Kyiv"], today + 2)))
+    results.append(("catch-up", storage.rollover_timezones(["Europe/London", "America/New_York"], today + 3, missed=3)))
+    storage.save_rollover_state([("Asia/Tokyo", today)])
+    results.append(("rollover state", storage.get_rollover_state()))
+    results.append(("weekly", storage.get_weekly_summaries(today - 5, today + 1), storage.get_weekly_summaries(today - 5, today + 1, 10, 3)))
+    storage.save_job_cursor("weekly", today, 10)
+    storage.save_job_cursor("weekly", today, 20, done=1)
+    results.append(("job cursor", storage.get_job_cursor("weekly"), storage.get_job_cursor("other")))
+    results.append(("inactive", storage.set_active_many(some, 0), storage.set_active_many(some[:3], 0), storage.set_active_many([some[0]], 1)))
+    results.append(("recipients", storage.count_recipients(), storage.get_recipient_ids(), storage.get_recipient_ids(20, 5)))
+    broadcast_id = storage.create_broadcast("hello", 1, 10)
+    storage.save_broadcast_progress(broadcast_id, 5, 4, 1, 0, message_id=42)
+    storage.create_broadcast("done", 1, 0)
+    storage.save_broadcast_progress(broadcast_id + 1, 0, 0, 0, 0, done=1)
+    results.append(("broadcasts", [
+        {key: value for key, value in row.items() if key not in ("created_at", "updated_at")}
+        for row in storage.get_unfinished_broadcasts()
+    ]))
+    far = (today + 10) * 86400
+    results.append(("enqueue", storage.enqueue_messages([
+        ("reminder:2:1", 2, 2, "reminder", {"day": today}, 100),
+        ("reminder:2:1", 2, 2, "reminder", {"day": today}, 200),
+        ("summary:3:1", 3, 3, "summary", {"day": today}, far + 1),
+    ]), storage.enqueue_greeting(4, 4, today, 50), storage.enqueue_greeting(4, 4, today, 60)))
+    # id — порядок вставки, внутри одного перехода дня он у хранилищ разный; сравниваем без него
+    due = storage.get_due_messages(far)
+    results.append(("outbox due", sorted(
+        ({key: value for key, value in row.items() if key not in ("outbox_id", "created_at", "updated_at")} for row in due),
+        key=lambda row: (row["send_after"], row["dedup_key"])
+    )))
+    storage.save_outbox_results([("sent", 0, due[0]["outbox_id"]), ("pending", far + 5, due[1]["outbox_id"])])
+    results.append(("outbox after", sorted((row["dedup_key"], row["attempts"]) for row in storage.get_due_messages(far + 5))))
+    results.append(("outbox prune", storage.prune_outbox(int(time.time()) + 1), storage.count_outbox()))
+    results.append(("greeted", storage.get_user(4).greeted_day))
+    results.append(("reset", storage.reset_user(5), storage.reset_user(5)))
+    results.append(("purge", storage.archive_users_with_3_fails()))
+    results.append(("archive", [
+        {key: value for key, value in row.items() if key != "archived_at"}
+        for user_id in range(1, users + 1)
+        for row in storage.get_archive(user_id)
+    ]))
+    storage.save_persistence([("reg", "[1, 1]", "2")], [], [(1, "{}")], [])
+    storage.save_persistence([], [("reg", "[1, 1]")], [], [1])
+    results.append(("persistence", storage.load_conversations("reg"), storage.load_user_data(1)))
+    results.append(("ids", sorted(storage.get_all_user_ids())))
+    results.append(("users", sorted(storage.get_all_users(), key=lambda u: u.user_id)))
+    return results
+
+
+def sqlite_storage(tmpdir, name):
+    storage = SQLiteStorage(os.path.join(tmpdir, name))
+    storage.init()
+    return storage
+
+
+def bench_storage(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # completed_at — текущее время: на время сверки часы стоят, иначе сценарии расходятся на границе секунды
+        sharded = ShardedStorage(shard_paths(os.path.join(tmpdir, "conformance-sharded.db"), 4))
+        sharded.init()
+        with mock.patch("time.time", return_value=time.time()):
+            expected = conformance_script(sqlite_storage(tmpdir, "conformance.db"), args.users, args.seed)
+            results = [
+                (backend, conformance_script(storage, args.users, args.seed))
+                for backend, storage in (("memory", MemoryStorage()), ("sharded", sharded))
+            ]
+        diverged = False
+        for backend, actual in results:
+            mismatches = [(e, a) for e, a in zip(expected, actual) if e != a]
+            if len(expected) != len(actual):
+                mismatches.append(("length", len(expected), len(actual)))
+            print(f"conformance {backend}: {len(expected)} results, {len(mismatches)} mismatches")
+            for e, a in mismatches[:5]:
+                print(f"  sqlite: {e}\n  {backend}: {a}")
+            diverged = diverged or bool(mismatches)
+        # Расхождение с SQLite — ошибка, а не строчка в отчёте: скорость такого хранилища не меряем
+        if diverged:
+            sys.exit(1)
+        if args.conformance_only:
+            return
+
+        print(f"{'backend':>8} {'users':>8} {'add_pushups/s':>14} {'get_user/s':>12} {'rollover ms':>12}")
+        for backend in ("sqlite", "memory"):
+            storage = sqlite_storage(tmpdir, "bench.db") if backend == "sqlite" else MemoryStorage()
+            for user_id in range(args.bench_users):
+                storage.add_user(user_id, f"user{user_id}", 480, 1200, 3, tz=STORAGE_TZS[user_id % len(STORAGE_TZS)])
+            ops = min(args.ops, args.bench_users * 10)
+            started = time.perf_counter()
+            for i in range(ops):
+                storage.add_pushups(i % args.bench_users, 10)
+            add_rate = ops / (time.perf_counter() - started)
+            started = time.perf_counter()
+            for i in range(ops):
+                storage.get_user(i % args.bench_users)
+            get_rate = ops / (time.perf_counter() - started)
+            started = time.perf_counter()
+            storage.rollover_timezones(list(STORAGE_TZS), local_day("Europe/Kyiv") + 1)
+            rollover_ms = (time.perf_counter() - started) * 1000
+            print(f"{backend:>8} {args.bench_users:>8} {add_rate:>14.0f} {get_rate:>12.0f} {rollover_ms:>12.1f}")
+
+
+# --- bulk: пачечные операции db против цикла по одному пользователю ---
+BULK_OPS = (
+    ("get_user", lambda storage, ids: [storage.get_user(user_id) for user_id in ids], lambda storage, ids: list(storage.get_users(ids))),
+    ("fail_day", lambda storage, ids: [storage.fail_day(user_id) for user_id in ids], lambda storage, ids: list(storage.fail_days(ids))),
+    ("next_day", lambda storage, ids: [storage.next_day(user_id) for user_id in ids], lambda storage, ids: list(storage.next_days(ids))),
+    ("set_notify_fail", lambda storage, ids: [storage.set_notify_fail(user_id, 1) for user_id in ids], lambda storage, ids: storage.set_notify_fail_many(ids, 1)),
+    ("set_game_over", lambda storage, ids: [storage.set_game_over(user_id, 1) for user_id in ids], lambda storage, ids: list(storage.set_game_over_many(ids, 1))),
+)
+
+
+def bench_bulk(args):
+    # Цикл по одному на 100k занимает минуты — меряем его на выборке и пересчитываем на всех
+    print(f"{'users':>8} {'operation':>16} {'loop s':>10} {'bulk s':>10} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for users in args.users:
+            storage = sqlite_storage(tmpdir, f"bulk{users}.db")
+            # Заполняем напрямую одной транзакцией — add_user по одному на 100k заняла бы минуты
+            conn = sqlite3.connect(storage.path)
+            conn.executemany(
+                "INSERT INTO users (user_id, username, name, start_minute, end_minute, reminders, last_day, registered_day, tz) "
+                "VALUES (:user_id, :username, :name, :start_minute, :end_minute, :reminders, :last_day, :registered_day, :tz)",
+                (make_user_fields(user_id) for user_id in range(users))
+            )
+            conn.commit()
+            conn.close()
+            ids = list(range(users))
+            sample = ids[:min(users, args.loop_sample)]
+            for name, loop, bulk in BULK_OPS:
+                started = time.perf_counter()
+                loop(storage, sample)
+                loop_time = (time.perf_counter() - started) * users / len(sample)
+                started = time.perf_counter()
+                bulk(storage, ids)
+                bulk_time = time.perf_counter() - started
+                print(f"{users:>8} {name:>16} {loop_time:>10.2f} {bulk_time:>10.2f} {loop_time / bulk_time:>7.0f}x")
+
+
+# --- memory: сколько байт занимает один пользователь в памяти ---
+def make_user_fields(user_id):
+    # Имена у всех разные, пояс — один из нескольких (как в проде)
+    return dict(
+        user_id=user_id, username=f"user{user_id}", name=f"Name {user_id}",
+        start_minute=480, end_minute=1200, reminders=3,
+        pushups_today=user_id % 101, last_day=20000, fails=user_id % 4,
+        completed_at=1700000000 + user_id if user_id % 101 == 100 else None,
+        registered_day=19950, notify_fail=0, game_over=0, greeted_day=20000,
+        tz=STORAGE_TZS[user_id % len(STORAGE_TZS)], card_message_id=None, game_over_day=None,
+    )
+
+
+def measure_users(layout, users):
+    gc.collect()
+    tracemalloc.start()
+    if layout == "dict":
+        resident = [make_user_fields(user_id) for user_id in range(users)]
+    else:
+        resident = [UserRecord(**make_user_fields(user_id)) for user_id in range(users)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del resident
+    gc.collect()
+    return size / users
+
+
+def bench_memory(args):
+    print(f"{'users':>10} " + " ".join(f"{layout + ' B/user':>16}" for layout in args.layouts))
+    for users in args.users:
+        sizes = [measure_users(layout, users) for layout in args.layouts]
+        print(f"{users:>10} " + " ".join(f"{size:>16.0f}" for size in sizes))
+
+
+# --- shards: скорость записи при разном числе файлов SQLite ---
+def bench_shards(args):
+    print(f"{args.users} users, {args.writers} writer threads / coroutines, {args.ops} add_pushups")
+    print(f"{'shards':>7} {'writes/s':>10} {'p99 ms':>8} {'locked':>7} {'loop writes/s':>14} {'rollover ms':>12} {'top ms':>8}")
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            storage = ShardedStorage(shard_paths(os.path.join(tmpdir, "users.db"), shards))
+            storage.init()
+            for user_id in range(1, args.users + 1):
+                storage.add_user(user_id, f"user{user_id}", 480, 1200, 3, tz=STORAGE_TZS[user_id % len(STORAGE_TZS)])
+            latencies = []
+            locked = 0
+            lock = threading.Lock()
+
+            def writer(seed):
+                nonlocal locked
+                rng = random.Random(seed)
+                mine = []
+                for _ in range(args.ops // args.writers):
+                    started = time.perf_counter()
+                    try:
+                        storage.add_pushups(rng.randint(1, args.users), 10)
+                    except sqlite3.OperationalError:
+                        with lock:
+                            locked += 1
+                    mine.append(time.perf_counter() - started)
+                with lock:
+                    latencies.extend(mine)
+
+            threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(args.writers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            rate = len(latencies) / (time.perf_counter() - started)
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+            # Как в боте: один event loop, хэндлеры ждут await storage.write(...)
+            async def handler(seed):
+                rng = random.Random(seed)
+                for _ in range(args.ops // args.writers):
+                    await storage.write("add_pushups", rng.randint(1, args.users), 10)
+
+            async def loop_writers():
+                await asyncio.gather(*(handler(seed) for seed in range(args.writers)))
+
+            started = time.perf_counter()
+            asyncio.run(loop_writers())
+            loop_rate = args.ops // args.writers * args.writers / (time.perf_counter() - started)
+            started = time.perf_counter()
+            storage.get_top_pushups_today(10)
+            top_ms = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            storage.rollover_timezones(list(STORAGE_TZS), local_day("Europe/Kyiv") + 1)
+            rollover_ms = (time.perf_counter() - started) * 1000
+            storage.close()
+            print(f"{shards:>7} {rate:>10.0f} {p99:>8.1f} {locked:>7} {loop_rate:>14.0f} {rollover_ms:>12.1f} {top_ms:>8.1f}")
+
+
+# --- transport: скорость отправки в зависимости от пула соединений, против локального фейкового Bot API ---
+async def start_fake_bot_api(latency, stats):
+    # Минимальный HTTP/1.1-сервер с keep-alive: на каждый запрос — ответ через latency секунд
+    me = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "x"}
+
+    async def handle(reader, writer):
+        stats["connections"] += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                await asyncio.sleep(latency)
+                result = me if b"/getMe " in head else message
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload)
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def run_transport(pool_size, messages, concurrency, latency, pool_timeout, keepalive_expiry):
+    from telegram import Bot
+    from telegram.error import TelegramError
+
+    stats = {"connections": 0}
+    server = await start_fake_bot_api(latency, stats)
+    port = server.sockets[0].getsockname()[1]
+    request = build_request(pool_size, 5.0, 5.0, 5.0, pool_timeout, http2="0", keepalive_expiry=keepalive_expiry)
+    bot = Bot("123456:BENCH", base_url=f"http://127.0.0.1:{port}/bot", request=request)
+    await bot.initialize()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def send(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await bot.send_message(chat_id=i, text="bench")
+                latencies.append(time.perf_counter() - started)
+            except TelegramError:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(messages)))
+    elapsed = time.perf_counter() - started
+    await bot.shutdown()
+    server.close()
+    await server.wait_closed()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0
+    return len(latencies) / elapsed, p99, errors, stats["connections"]
+
+
+def bench_transport(args):
+    print(
+        f"{args.messages} sendMessage, {args.concurrency} concurrent senders, API latency {args.latency * 1000:.0f} ms, "
+        f"pool timeout {args.pool_timeout:g} s"
+    )
+    print(f"{'pool':>6} {'sent/s':>10} {'p99 ms':>10} {'errors':>8} {'connections':>12}")
+    for pool_size in args.pool_sizes:
+        rate, p99, errors, connections = asyncio.run(run_transport(
+            pool_size, args.messages, args.concurrency, args.latency, args.pool_timeout, args.keepalive_expiry
+        ))
+        print(f"{pool_size:>6} {rate:>10.1f} {p99:>10.1f} {errors:>8} {connections:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Devil's 100 bot")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("updates", help="update processing throughput vs concurrency")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--per-user", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    p.set_defaults(func=bench_updates)
+
+    p = sub.add_parser("storage", help="SQLite vs in-memory storage: conformance and throughput")
+    p.add_argument("--users", type=int, default=50, help="users in the conformance scenario")
+    p.add_argument("--conformance-only", action="store_true", help="only check that all backends match SQLite")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--bench-users", type=int, default=2000)
+    p.add_argument("--ops", type=int, default=5000)
+    p.set_defaults(func=bench_storage)
+
+    p = sub.add_parser("bulk", help="bulk db operations vs per-user loops")
+    p.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    p.add_argument("--loop-sample", type=int, default=2000, help="users to time the per-user loop on")
+    p.set_defaults(func=bench_bulk)
+
+    p = sub.add_parser("memory", help="resident bytes per user: dict rows vs UserRecord")
+    p.add_argument("--users", type=int, nargs="+", default=[100_000, 1_000_000])
+    p.add_argument("--layouts", nargs="+", choices=["dict", "record"], default=["dict", "record"])
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("shards", help="add_pushups throughput from concurrent writers vs number of SQLite shards")
+    p.add_argument("--shards", type=int, nargs="+", default=[1, 4, 8])
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--writers", type=int, default=8)
+    p.add_argument("--ops", type=int, default=4000)
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("transport", help="Bot API send throughput vs connection pool size (local fake API)")
+    p.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=256, help="sends in flight, like a reminder burst")
+    p.add_argument("--latency", type=float, default=0.02, help="fake API response time, seconds")
+    p.add_argument("--pool-timeout", type=float, default=1.0, help="seconds a send waits for a free connection")
+    p.add_argument("--keepalive-expiry", type=float, default=30.0)
+    p.set_defaults(func=bench_transport)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,166 @@
+import inspect
+import json
 import sqlite3
-from datetime import date, datetime
-from pytz import timezone
+import sys
+import time
+from contextvars import ContextVar
+from datetime import date, datetime, time as dt_time
+from functools import lru_cache
+from pytz import timezone, UnknownTimeZoneError
+
+from tracing import traced
 
 DB_PATH = "/data/users.db"
+# Файл текущего вызова: шардированное хранилище (storage.ShardedStorage) выставляет свой на каждый шард
+db_path = ContextVar("db_path", default=None)
+# Уведомления подписчиков: True — сразу, False — не уведомлять, список — копить изменения.
+# В потоках шардов копятся и доставляются в потоке вызывающего — подписчики не потокобезопасны
+publishing = ContextVar("publishing", default=True)
+# Постоянное соединение-писатель шарда (ShardedStorage); None — новое соединение на вызов
+connection = ContextVar("connection", default=None)
+
+DEFAULT_TZ = "Europe/Kyiv"
+# Длина челленджа: после этого дня участник уходит в архив
+CHALLENGE_DAYS = 90
+KIEV_TZ = timezone(DEFAULT_TZ)
+
+# Дни храним как номер дня от 1970-01-01, время суток — в минутах, моменты — в секундах epoch
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+@lru_cache(maxsize=None)
+def get_tz(tz_name):
+    try:
+        return timezone(tz_name or DEFAULT_TZ)
+    except UnknownTimeZoneError:
+        return KIEV_TZ
+
+def day_number(d):
+    return d.toordinal() - EPOCH_ORDINAL
+
+def day_from_number(day):
+    return date.fromordinal(day + EPOCH_ORDINAL)
+
+def local_today(tz_name):
+    return datetime.now(get_tz(tz_name)).date()
+
+def utc_offset_seconds(tz_name, day):
+    # Смещение пояса в середине дня: у поясов одной смены дня оно общее
+    return int(get_tz(tz_name).localize(datetime.combine(day_from_number(day), dt_time(12))).utcoffset().total_seconds())
+
+def local_day(tz_name):
+    return day_number(local_today(tz_name))
+
+class UserRecord:
+    # Строка users без dict на каждого пользователя: слоты вместо словаря, все поля — целые,
+    # кроме имён и пояса (пояс интернируется — у тысяч пользователей это одна и та же строка)
+    __slots__ = (
+        "user_id", "username", "name", "start_minute", "end_minute", "reminders",
+        "pushups_today", "last_day", "fails", "completed_at", "registered_day",
+        "notify_fail", "game_over", "greeted_day", "tz", "card_message_id", "game_over_day", "active",
+        "current_streak", "longest_streak", "best_finish_minute", "total_pushups",
+    )
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_row(cls, row):
+        record = cls.__new__(cls)
+        keys = row.keys()
+        for field in cls.__slots__:
+            setattr(record, field, row[field] if field in keys else None)
+        record.tz = sys.intern(record.tz or DEFAULT_TZ)
+        return record
 
-KIEV_TZ = timezone("Europe/Kyiv")
+    def copy(self):
+        record = UserRecord.__new__(UserRecord)
+        for field in self.__slots__:
+            setattr(record, field, getattr(self, field))
+        return record
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, UserRecord) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return f"UserRecord({self.as_dict()!r})"
+
+# Подписчики на изменения пользователей (рейтинг, статистика): user_changed(before, after), reloaded()
+_listeners = []
+
+def subscribe(listener):
+    _listeners.append(listener)
+
+def _notify(sink, changes):
+    if isinstance(sink, list):
+        sink.extend(changes)
+        return
+    for before, after in changes:
+        for listener in _listeners:
+            listener.user_changed(before, after)
+
+def _publish(user_id, before):
+    sink = publishing.get()
+    if not _listeners or sink is False:
+        return
+    _notify(sink, [(before, get_user(user_id))])
+
+def _publish_many(befores):
+    # befores: {user_id: запись до изменения}; "после" читаем одним запросом
+    sink = publishing.get()
+    if not _listeners or not befores or sink is False:
+        return
+    afters = {u.user_id: u for u in get_users(befores)}
+    _notify(sink, [(before, afters.get(user_id)) for user_id, before in befores.items()])
+
+def _publish_reload():
+    sink = publishing.get()
+    if sink is False:
+        return
+    if isinstance(sink, list):
+        sink.append(None)
+        return
+    for listener in _listeners:
+        listener.reloaded()
+
+def _deliver(changes):
+    # Изменения, накопленные в потоке шарда, — подписчикам уже в потоке вызывающего; None — перечитать всё
+    sink = publishing.get()
+    if sink is False:
+        return
+    for change in changes:
+        if change is None:
+            _publish_reload()
+        else:
+            _notify(sink, [change])
+
+class _KeptConnection(sqlite3.Connection):
+    # Функции ниже закрывают соединение после себя — постоянному писателю шарда закрываться нельзя
+    def close(self):
+        pass
+
+    def release(self):
+        super().close()
+
+def open_writer(path):
+    # check_same_thread по умолчанию: соединение живёт в одном потоке — потоке своего шарда
+    conn = sqlite3.connect(path, factory=_KeptConnection)
+    conn.row_factory = sqlite3.Row
+    return conn
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    kept = connection.get()
+    if kept is not None:
+        return kept
+    conn = sqlite3.connect(db_path.get() or DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
+def _migrate_v1(cur):
+    # Исходная схема с TEXT-датами и все колонки, которые добавлялись к ней со временем
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -28,54 +175,332 @@ def init_db():
             completed_time TEXT,
             registered_date TEXT,
             notify_fail INTEGER DEFAULT 0,
-            game_over INTEGER DEFAULT 0
+            game_over INTEGER DEFAULT 0,
+            greeted_date TEXT,
+            tz TEXT DEFAULT 'Europe/Kyiv'
         )
     """)
-    # Миграция для старых БД: notify_fail
     cur.execute("PRAGMA table_info(users);")
     cols = [row[1] for row in cur.fetchall()]
     if "notify_fail" not in cols:
-        try:
-            cur.execute("ALTER TABLE users ADD COLUMN notify_fail INTEGER DEFAULT 0;")
-            conn.commit()
-        except Exception as e:
-            print("Failed to add notify_fail:", e)
+        cur.execute("ALTER TABLE users ADD COLUMN notify_fail INTEGER DEFAULT 0;")
     if "game_over" not in cols:
+        cur.execute("ALTER TABLE users ADD COLUMN game_over INTEGER DEFAULT 0;")
+    if "greeted_date" not in cols:
+        cur.execute("ALTER TABLE users ADD COLUMN greeted_date TEXT;")
+    if "tz" not in cols:
+        cur.execute(f"ALTER TABLE users ADD COLUMN tz TEXT DEFAULT '{DEFAULT_TZ}';")
+    # Состояние планировщика: время следующего и последнего отправленного события по каждому виду
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS scheduler_state (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            last_fire INTEGER,
+            next_fire INTEGER,
+            PRIMARY KEY (user_id, kind)
+        )
+    """)
+
+def _text_to_day(value):
+    return day_number(date.fromisoformat(value)) if value else None
+
+def _text_to_minutes(value):
+    if not value:
+        return None
+    h, m = map(int, value.split(":"))
+    return h * 60 + m
+
+def _text_to_timestamp(value, tz_name):
+    if not value:
+        return None
+    return int(get_tz(tz_name).localize(datetime.strptime(value, "%Y-%m-%d %H:%M:%S")).timestamp())
+
+def _migrate_v2(cur):
+    # TEXT-даты и время -> целые числа: дни от эпохи, минуты суток, секунды epoch
+    cur.execute("""
+        CREATE TABLE users_v2 (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            name TEXT,
+            start_minute INTEGER NOT NULL,
+            end_minute INTEGER NOT NULL,
+            reminders INTEGER NOT NULL,
+            pushups_today INTEGER NOT NULL DEFAULT 0,
+            last_day INTEGER,
+            fails INTEGER NOT NULL DEFAULT 0,
+            completed_at INTEGER,
+            registered_day INTEGER NOT NULL,
+            notify_fail INTEGER NOT NULL DEFAULT 0,
+            game_over INTEGER NOT NULL DEFAULT 0,
+            greeted_day INTEGER,
+            tz TEXT NOT NULL DEFAULT 'Europe/Kyiv'
+        )
+    """)
+    cur.execute("SELECT * FROM users")
+    rows = [
+        (
+            row["user_id"], row["username"], row["name"],
+            _text_to_minutes(row["start_time"]), _text_to_minutes(row["end_time"]), row["reminders"],
+            row["pushups_today"] or 0, _text_to_day(row["last_date"]), row["fails"] or 0,
+            _text_to_timestamp(row["completed_time"], row["tz"]), _text_to_day(row["registered_date"]),
+            row["notify_fail"] or 0, row["game_over"] or 0, _text_to_day(row["greeted_date"]),
+            row["tz"] or DEFAULT_TZ,
+        )
+        for row in cur.fetchall()
+    ]
+    cur.executemany("INSERT INTO users_v2 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    cur.execute("DROP TABLE users")
+    cur.execute("ALTER TABLE users_v2 RENAME TO users")
+    cur.execute("CREATE INDEX idx_users_tz ON users(tz)")
+    cur.execute("CREATE INDEX idx_users_day ON users(last_day, game_over)")
+
+def _migrate_v3(cur):
+    # Командный челлендж в групповых чатах
+    cur.execute("""
+        CREATE TABLE groups (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            tz TEXT NOT NULL DEFAULT 'Europe/Kyiv',
+            digest_day INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE group_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            joined_day INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    cur.execute("CREATE INDEX idx_group_members_user ON group_members(user_id)")
+
+def _migrate_v4(cur):
+    # Закреплённая карточка статуса с inline-кнопками
+    cur.execute("ALTER TABLE users ADD COLUMN card_message_id INTEGER")
+
+def _migrate_v5(cur):
+    # Персистентность Application: состояния диалогов и user_data
+    cur.execute("""
+        CREATE TABLE conversations (
+            name TEXT NOT NULL,
+            conv_key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, conv_key)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    """)
+
+def _migrate_v6(cur):
+    # Статистика челленджа: день game over у пользователя и ежедневные снимки счётчиков
+    cur.execute("ALTER TABLE users ADD COLUMN game_over_day INTEGER")
+    cur.execute("""
+        CREATE TABLE daily_stats (
+            day INTEGER NOT NULL,
+            utc_offset INTEGER NOT NULL,
+            active_users INTEGER NOT NULL,
+            finishers INTEGER NOT NULL,
+            median_finish_minute INTEGER,
+            fails_0 INTEGER NOT NULL,
+            fails_1 INTEGER NOT NULL,
+            fails_2 INTEGER NOT NULL,
+            fails_3 INTEGER NOT NULL,
+            game_overs INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (day, utc_offset)
+        )
+    """)
+
+def _migrate_v7(cur):
+    # Архив завершённых челленджей: строка users целиком в JSON, чтобы не зависеть от схемы
+    cur.execute("""
+        CREATE TABLE users_archive (
+            archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            registered_day INTEGER,
+            archived_day INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX idx_users_archive_user ON users_archive(user_id)")
+
+def _migrate_v8(cur):
+    # Итоги каждого дня по пользователю (пишутся на смене дня) и курсоры фоновых рассылок
+    cur.execute("""
+        CREATE TABLE daily_results (
+            user_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            pushups INTEGER NOT NULL,
+            finish_minute INTEGER,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE job_cursors (
+            job TEXT PRIMARY KEY,
+            period INTEGER NOT NULL,
+            cursor INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+def _migrate_v9(cur):
+    # active=0 — бот заблокирован пользователем; рассылки с чекпоинтом для продолжения после рестарта
+    cur.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    cur.execute("""
+        CREATE TABLE broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            total INTEGER NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+
+def _migrate_v10(cur):
+    # Серии и личные рекорды — счётчики на строке пользователя, обновляются на лету.
+    # Серии из истории не восстанавливаем: daily_results появилась недавно и неполная
+    cur.execute("ALTER TABLE users ADD COLUMN current_streak INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE users ADD COLUMN longest_streak INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE users ADD COLUMN best_finish_minute INTEGER")
+    cur.execute("ALTER TABLE users ADD COLUMN total_pushups INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""
+        UPDATE users SET
+            total_pushups = pushups_today + COALESCE((
+                SELECT SUM(r.pushups) FROM daily_results r
+                WHERE r.user_id = users.user_id AND r.day >= users.registered_day
+            ), 0),
+            best_finish_minute = (
+                SELECT MIN(r.finish_minute) FROM daily_results r
+                WHERE r.user_id = users.user_id AND r.day >= users.registered_day
+            )
+    """)
+
+def _migrate_v11(cur):
+    # Последний обработанный день по каждому поясу — по нему после простоя догоняем пропущенные смены дня
+    cur.execute("""
+        CREATE TABLE rollover_state (
+            tz TEXT PRIMARY KEY,
+            last_day INTEGER NOT NULL
+        )
+    """)
+
+def _migrate_v12(cur):
+    # Исходящие сообщения (outbox): намерение отправить пишется в одной транзакции с изменением состояния,
+    # отправляет фоновая задача. dedup_key уникален — повторная постановка того же события ничего не добавит
+    cur.execute("""
+        CREATE TABLE outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            send_after INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX outbox_pending ON outbox (send_after, outbox_id) WHERE status = 'pending'")
+    # Ещё не объявленные потерянные жизни переносим в очередь: приветствие о них больше не сообщает
+    now = int(time.time())
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO outbox (dedup_key, user_id, chat_id, kind, payload, send_after, created_at, updated_at)
+        SELECT 'fail:' || user_id || ':' || last_day, user_id, user_id, 'fail', json_object('fails', fails), ?, ?, ?
+        FROM users WHERE notify_fail = 1 AND game_over = 0
+        """,
+        (now, now, now)
+    )
+    cur.execute("UPDATE users SET notify_fail = 0 WHERE notify_fail = 1")
+
+MIGRATIONS = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+    (3, _migrate_v3),
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+    (6, _migrate_v6),
+    (7, _migrate_v7),
+    (8, _migrate_v8),
+    (9, _migrate_v9),
+    (10, _migrate_v10),
+    (11, _migrate_v11),
+    (12, _migrate_v12),
+]
+
+def init_db():
+    conn = get_db()
+    conn.isolation_level = None  # транзакциями миграций управляем сами
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL)")
+    cur.execute("SELECT MAX(version) FROM schema_migrations")
+    version = cur.fetchone()[0] or 0
+    for target, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        cur.execute("BEGIN")
         try:
-            cur.execute("ALTER TABLE users ADD COLUMN game_over INTEGER DEFAULT 0;")
-            conn.commit()
+            migrate(cur)
+            cur.execute("INSERT INTO schema_migrations (version, applied_at) VALUES (?, ?)", (target, int(time.time())))
+            cur.execute("COMMIT")
         except Exception as e:
-            print("Failed to add game_over:", e)
-    conn.commit()
+            cur.execute("ROLLBACK")
+            conn.close()
+            raise RuntimeError(f"Migration to schema v{target} failed: {e}") from e
+    # Освобождённые архивом страницы возвращаем постепенно (incremental_vacuum),
+    # режим включается один раз полным VACUUM
+    if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("VACUUM")
     conn.close()
 
-def add_user(user_id, name, start_time, end_time, reminders, username=None):
+def add_user(user_id, name, start_minute, end_minute, reminders, username=None, tz=DEFAULT_TZ):
     conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
     if cur.fetchone():
         conn.close()
         return
-    today_str = date.today().isoformat()
+    today = local_day(tz)
     cur.execute(
         """
-        INSERT INTO users (user_id, username, name, start_time, end_time, reminders, pushups_today, last_date, fails, completed_time, registered_date, notify_fail, game_over)
-        VALUES (?, ?, ?, ?, ?, ?, 0, ?, 0, NULL, ?, 0, 0)
+        INSERT INTO users (user_id, username, name, start_minute, end_minute, reminders, pushups_today, last_day, fails, completed_at, registered_day, notify_fail, game_over, tz)
+        VALUES (?, ?, ?, ?, ?, ?, 0, ?, 0, NULL, ?, 0, 0, ?)
         """,
-        (user_id, username, name, start_time, end_time, reminders, today_str, today_str)
+        (user_id, username, name, start_minute, end_minute, reminders, today, today, tz)
     )
     conn.commit()
     conn.close()
+    _publish(user_id, None)
 
-def update_user_settings(user_id, start_time, end_time, reminders):
+def update_user_settings(user_id, start_minute, end_minute, reminders, tz=None):
+    before = get_user(user_id) if _listeners else None
     conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        "UPDATE users SET start_time=?, end_time=?, reminders=? WHERE user_id=?",
-        (start_time, end_time, reminders, user_id)
+        "UPDATE users SET start_minute=?, end_minute=?, reminders=?, tz=COALESCE(?, tz) WHERE user_id=?",
+        (start_minute, end_minute, reminders, tz, user_id)
     )
     conn.commit()
     conn.close()
+    _publish(user_id, before)
 
 def get_user(user_id):
     conn = get_db()
@@ -83,109 +508,247 @@ def get_user(user_id):
     cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
     row = cur.fetchone()
     conn.close()
-    return dict(row) if row else None
+    return UserRecord.from_row(row) if row else None
+
+def _archive_rows(cur, rows, reason=None):
+    # Переносит пользователей (UserRecord) в архив одной пачкой; reason=None — по состоянию строки
+    if not rows:
+        return 0
+    now = int(time.time())
+    cur.executemany(
+        "INSERT INTO users_archive (user_id, registered_day, archived_day, archived_at, reason, data) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                u.user_id, u.registered_day, local_day(u.tz), now,
+                reason or ("game_over" if u.game_over else "finished"),
+                json.dumps(u.as_dict(), ensure_ascii=False),
+            )
+            for u in rows
+        ]
+    )
+    ids = [(u.user_id,) for u in rows]
+    cur.executemany("DELETE FROM users WHERE user_id=?", ids)
+    cur.executemany("DELETE FROM scheduler_state WHERE user_id=?", ids)
+    cur.executemany("DELETE FROM group_members WHERE user_id=?", ids)
+    return len(rows)
 
 def reset_user(user_id):
+    # Данные не теряются: текущий челлендж уходит в архив
+    before = get_user(user_id)
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("DELETE FROM users WHERE user_id=?", (user_id,))
+    archived = _archive_rows(cur, [before], "reset") if before else 0
+    cur.execute("DELETE FROM scheduler_state WHERE user_id=?", (user_id,))
     conn.commit()
     conn.close()
+    _publish(user_id, before)
+    return archived > 0
+
+def get_archive(user_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT archived_day, archived_at, reason, data FROM users_archive WHERE user_id=? ORDER BY archive_id",
+        (user_id,)
+    )
+    rows = [
+        dict(json.loads(row["data"]), archived_day=row["archived_day"], archived_at=row["archived_at"], reason=row["reason"])
+        for row in cur.fetchall()
+    ]
+    conn.close()
+    return rows
 
 def add_pushups(user_id, count):
     u = get_user(user_id)
-    if not u or u.get("game_over", 0):
+    if not u or u.game_over:
         return False
-    today_str = date.today().isoformat()
-    now_str = datetime.now(KIEV_TZ).strftime("%Y-%m-%d %H:%M:%S")
-    if u["last_date"] != today_str:
+    today = local_day(u.tz)
+    if u.last_day != today:
         pushups = 0
-        fails = u["fails"]
-        completed_time = None
+        fails = u.fails
+        completed_at = None
     else:
-        pushups = u["pushups_today"]
-        fails = u["fails"]
-        completed_time = u.get("completed_time")
+        pushups = u.pushups_today
+        fails = u.fails
+        completed_at = u.completed_at
     new_pushups = min(pushups + count, 100)
-    if new_pushups >= 100 and not completed_time:
-        completed_time = now_str
+    if new_pushups >= 100 and not completed_at:
+        completed_at = int(time.time())
     conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        "UPDATE users SET pushups_today=?, last_date=?, fails=?, completed_time=? WHERE user_id=?",
-        (new_pushups, today_str, fails, completed_time, user_id)
+        "UPDATE users SET pushups_today=?, last_day=?, fails=?, completed_at=?, total_pushups=total_pushups + ? WHERE user_id=?",
+        (new_pushups, today, fails, completed_at, new_pushups - pushups, user_id)
     )
     conn.commit()
     conn.close()
+    _publish(user_id, u)
     return True
 
 def decrease_pushups(user_id, count):
     u = get_user(user_id)
-    if not u or u.get("game_over", 0):
+    if not u or u.game_over:
         return False
-    today_str = date.today().isoformat()
-    cur_pushups = u["pushups_today"] if u["last_date"] == today_str else 0
+    today = local_day(u.tz)
+    cur_pushups = u.pushups_today if u.last_day == today else 0
     new_pushups = max(0, cur_pushups - count)
-    completed_time = u["completed_time"]
+    completed_at = u.completed_at
     if cur_pushups >= 100 and new_pushups < 100:
-        completed_time = None
+        completed_at = None
     conn = get_db()
     cur = conn.cursor()
+    # Убранные отжимания вычитаем и из общего счёта — это исправление добавленного сегодня
     cur.execute(
-        "UPDATE users SET pushups_today=?, last_date=?, completed_time=? WHERE user_id=?",
-        (new_pushups, today_str, completed_time, user_id)
+        "UPDATE users SET pushups_today=?, last_day=?, completed_at=?, total_pushups=MAX(total_pushups - ?, 0) WHERE user_id=?",
+        (new_pushups, today, completed_at, cur_pushups - new_pushups, user_id)
     )
     conn.commit()
     conn.close()
+    _publish(user_id, u)
     return new_pushups
 
 def get_pushups_today(user_id):
     u = get_user(user_id)
-    if not u or u.get("game_over", 0):
+    if not u or u.game_over:
         return 0
-    today_str = date.today().isoformat()
-    if u["last_date"] != today_str:
+    if u.last_day != local_day(u.tz):
         return 0
-    return u["pushups_today"]
+    return u.pushups_today
 
 def next_day(user_id):
     u = get_user(user_id)
-    if not u or u.get("game_over", 0):
+    if not u or u.game_over:
         return
-    today_str = date.today().isoformat()
     conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        "UPDATE users SET pushups_today=0, last_date=?, fails=?, completed_time=NULL WHERE user_id=?",
-        (today_str, u["fails"], user_id)
+        "UPDATE users SET pushups_today=0, last_day=?, fails=?, completed_at=NULL WHERE user_id=?",
+        (local_day(u.tz), u.fails, user_id)
     )
     conn.commit()
     conn.close()
+    _publish(user_id, u)
 
 def fail_day(user_id):
     u = get_user(user_id)
-    if not u or u.get("game_over", 0):
+    if not u or u.game_over:
         return 0
-    fails = min(u["fails"] + 1, 3)
-    today_str = date.today().isoformat()
+    fails = min(u.fails + 1, 3)
     conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        "UPDATE users SET fails=?, pushups_today=0, last_date=?, completed_time=NULL WHERE user_id=?",
-        (fails, today_str, user_id)
+        "UPDATE users SET fails=?, pushups_today=0, last_day=?, completed_at=NULL WHERE user_id=?",
+        (fails, local_day(u.tz), user_id)
     )
     conn.commit()
     conn.close()
+    _publish(user_id, u)
     return fails
 
 def get_fails(user_id):
     u = get_user(user_id)
-    return u["fails"] if u and not u.get("game_over", 0) else 0
+    return u.fails if u and not u.game_over else 0
 
 def get_user_current_day(u):
-    today = date.today()
-    reg_date = datetime.strptime(u["registered_date"], "%Y-%m-%d").date()
-    return (today - reg_date).days + 1
+    return local_day(u.tz) - u.registered_day + 1
+
+# --- Пачечные операции: много пользователей за один запрос/транзакцию ---
+def _load_bulk_ids(cur, user_ids):
+    # Список id во временную таблицу соединения — дальше обычный JOIN вместо IN (?, ?, ...)
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_ids (user_id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM bulk_ids")
+    cur.executemany("INSERT OR IGNORE INTO bulk_ids (user_id) VALUES (?)", ((user_id,) for user_id in user_ids))
+
+def get_users(user_ids):
+    # Итератор UserRecord по списку id (отсутствующих просто нет в выдаче)
+    conn = get_db()
+    cur = conn.cursor()
+    _load_bulk_ids(cur, user_ids)
+    cur.execute("SELECT u.* FROM bulk_ids b JOIN users u ON u.user_id = b.user_id")
+    try:
+        for row in cur:
+            yield UserRecord.from_row(row)
+    finally:
+        conn.close()
+
+def _today_by_tz():
+    # local_day на каждого пользователя пачки дорог — хватает одного вычисления на пояс
+    cache = {}
+
+    def today(tz_name):
+        if tz_name not in cache:
+            cache[tz_name] = local_day(tz_name)
+        return cache[tz_name]
+
+    return today
+
+def _bulk_update(user_ids, sql, params_for):
+    # Одна транзакция: читаем затронутых, executemany по ним, публикуем изменения.
+    # params_for(u) -> параметры UPDATE (последний — user_id) или None, если пользователя не трогаем
+    conn = get_db()
+    cur = conn.cursor()
+    _load_bulk_ids(cur, user_ids)
+    cur.execute("SELECT u.* FROM bulk_ids b JOIN users u ON u.user_id = b.user_id")
+    befores = {}
+    params = []
+    for row in cur.fetchall():
+        u = UserRecord.from_row(row)
+        values = params_for(u)
+        if values is not None:
+            befores[u.user_id] = u
+            params.append(values)
+    cur.executemany(sql, params)
+    conn.commit()
+    conn.close()
+    _publish_many(befores)
+    return befores
+
+def fail_days(user_ids):
+    # Пачечный fail_day: итератор (user_id, fails) по активным пользователям
+    results = {}
+    today = _today_by_tz()
+
+    def params_for(u):
+        if u.game_over:
+            return None
+        results[u.user_id] = min(u.fails + 1, 3)
+        return (results[u.user_id], today(u.tz), u.user_id)
+
+    _bulk_update(
+        user_ids,
+        "UPDATE users SET fails=?, pushups_today=0, last_day=?, completed_at=NULL WHERE user_id=?",
+        params_for
+    )
+    return iter(results.items())
+
+def next_days(user_ids):
+    # Пачечный next_day: итератор id, которым начат новый день
+    today = _today_by_tz()
+    befores = _bulk_update(
+        user_ids,
+        "UPDATE users SET pushups_today=0, last_day=?, completed_at=NULL WHERE user_id=?",
+        lambda u: None if u.game_over else (today(u.tz), u.user_id)
+    )
+    return iter(befores)
+
+def set_notify_fail_many(user_ids, value):
+    conn = get_db()
+    cur = conn.cursor()
+    _load_bulk_ids(cur, user_ids)
+    cur.execute("UPDATE users SET notify_fail=? WHERE user_id IN (SELECT user_id FROM bulk_ids)", (value,))
+    changed = cur.rowcount
+    conn.commit()
+    conn.close()
+    return changed
+
+def set_game_over_many(user_ids, value):
+    today = _today_by_tz()
+    befores = _bulk_update(
+        user_ids,
+        "UPDATE users SET game_over=?, game_over_day=? WHERE user_id=?",
+        lambda u: (value, today(u.tz) if value else None, u.user_id)
+    )
+    return iter(befores)
 
 def get_all_user_ids():
     conn = get_db()
@@ -195,33 +758,526 @@ def get_all_user_ids():
     conn.close()
     return ids
 
-def delete_users_with_3_fails():
+def archive_users_with_3_fails():
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("DELETE FROM users WHERE fails >= 3")
+    cur.execute("SELECT * FROM users WHERE fails >= 3")
+    archived = _archive_rows(cur, [UserRecord.from_row(row) for row in cur.fetchall()], "purged")
     conn.commit()
     conn.close()
+    _publish_reload()
+    return archived
 
-def get_top_pushups_today(limit=5):
+def get_all_users():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM users")
+    rows = [UserRecord.from_row(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def get_users_in_timezones(tz_names):
+    if not tz_names:
+        return []
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"SELECT * FROM users WHERE tz IN ({','.join('?' * len(tz_names))})", tuple(tz_names))
+    rows = [UserRecord.from_row(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def describe_users():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(users)")
+    columns = [(row["name"], row["type"], row["notnull"], row["dflt_value"]) for row in cur.fetchall()]
+    conn.close()
+    return columns
+
+def save_daily_stats(row):
     conn = get_db()
     cur = conn.cursor()
-    today_str = date.today().isoformat()
     cur.execute(
         """
+        INSERT OR REPLACE INTO daily_stats
+            (day, utc_offset, active_users, finishers, median_finish_minute, fails_0, fails_1, fails_2, fails_3, game_overs, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        row
+    )
+    conn.commit()
+    conn.close()
+
+def get_timezones():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT tz FROM users")
+    tz_names = [row["tz"] or DEFAULT_TZ for row in cur.fetchall()]
+    conn.close()
+    return tz_names
+
+def _today_condition(prefix=""):
+    # "Сегодня" у каждого часового пояса своё: условие строим по каждому поясу отдельно
+    pairs = [(tz_name, local_day(tz_name)) for tz_name in get_timezones()]
+    if not pairs:
+        return "0", []
+    cond = " OR ".join([f"({prefix}tz=? AND {prefix}last_day=?)"] * len(pairs))
+    return f"({cond})", [value for pair in pairs for value in pair]
+
+def get_top_pushups_today(limit=5):
+    today_cond, params = _today_condition()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
         SELECT * FROM users
-        WHERE last_date=? AND game_over=0
+        WHERE {today_cond} AND game_over=0
         ORDER BY
             CASE WHEN pushups_today >= 100 THEN 0 ELSE 1 END,
-            CASE WHEN pushups_today >= 100 THEN completed_time END ASC,
+            CASE WHEN pushups_today >= 100 THEN completed_at END ASC,
             pushups_today DESC
         LIMIT ?
         """,
-        (today_str, limit)
+        (*params, limit)
+    )
+    rows = [UserRecord.from_row(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def get_leaderboard_rows():
+    # Все, кто сегодня уже отжимался — для построения рейтинга в памяти
+    today_cond, params = _today_condition()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT user_id, username, name, pushups_today, completed_at, tz FROM users
+        WHERE {today_cond} AND game_over=0 AND pushups_today > 0
+        """,
+        params
     )
-    rows = cur.fetchall()
+    # Остальные поля записи остаются None — рейтингу они не нужны
+    rows = [UserRecord.from_row(row) for row in cur.fetchall()]
     conn.close()
     return rows
 
+def join_group(chat_id, title, user_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO groups (chat_id, title) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE SET title=excluded.title",
+        (chat_id, title)
+    )
+    cur.execute(
+        "INSERT OR IGNORE INTO group_members (chat_id, user_id, joined_day) VALUES (?, ?, ?)",
+        (chat_id, user_id, local_day(DEFAULT_TZ))
+    )
+    joined = cur.rowcount > 0
+    conn.commit()
+    conn.close()
+    return joined
+
+def leave_group(chat_id, user_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM group_members WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+    left = cur.rowcount > 0
+    conn.commit()
+    conn.close()
+    return left
+
+def get_group_top(chat_id, limit=5):
+    # Топ-k только по участникам группы: стоимость зависит от размера группы, а не от всей базы
+    today_cond, params = _today_condition("u.")
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT u.* FROM group_members g
+        JOIN users u ON u.user_id = g.user_id
+        WHERE g.chat_id=? AND u.game_over=0 AND {today_cond}
+        ORDER BY
+            CASE WHEN u.pushups_today >= 100 THEN 0 ELSE 1 END,
+            CASE WHEN u.pushups_today >= 100 THEN u.completed_at END ASC,
+            u.pushups_today DESC
+        LIMIT ?
+        """,
+        (chat_id, *params, limit)
+    )
+    rows = [UserRecord.from_row(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def get_group_summary(chat_id):
+    today_cond, params = _today_condition("u.")
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT
+            COUNT(*) AS members,
+            COALESCE(SUM(CASE WHEN {today_cond} AND u.pushups_today >= 100 THEN 1 ELSE 0 END), 0) AS finished,
+            COALESCE(SUM(CASE WHEN {today_cond} THEN u.pushups_today ELSE 0 END), 0) AS pushups
+        FROM group_members g
+        JOIN users u ON u.user_id = g.user_id
+        WHERE g.chat_id=? AND u.game_over=0
+        """,
+        (*params, *params, chat_id)
+    )
+    row = cur.fetchone()
+    conn.close()
+    return dict(row)
+
+def get_groups():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM groups")
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def set_group_digest_day(chat_id, day):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("UPDATE groups SET digest_day=? WHERE chat_id=?", (day, chat_id))
+    conn.commit()
+    conn.close()
+
+def rollover_timezones(tz_names, day, missed=1):
+    # Переход на новый день одним набором запросов для всех пользователей из этих поясов.
+    # missed > 1 — смены дня, пропущенные пока бот лежал: последний день с данными — day - missed,
+    # дни между ним и day пустые и каждый стоит жизни; всё в одной транзакции
+    if not tz_names:
+        return
+    marks = ",".join("?" * len(tz_names))
+    last = day - missed
+    empty_days = missed - 1
+    now = int(time.time())
+    conn = get_db()
+    cur = conn.cursor()
+    offset = utc_offset_seconds(tz_names[0], last)
+    # Итог закончившегося дня — до того, как отжимания обнулятся
+    cur.execute(
+        f"""
+        INSERT OR REPLACE INTO daily_results (user_id, day, pushups, finish_minute)
+        SELECT user_id, last_day, pushups_today,
+               CASE WHEN pushups_today >= 100 AND completed_at IS NOT NULL THEN (completed_at + ?) % 86400 / 60 END
+        FROM users WHERE tz IN ({marks}) AND game_over=0 AND last_day=?
+        """,
+        (offset, *tz_names, last)
+    )
+    if empty_days:
+        cur.execute(
+            f"""
+            WITH RECURSIVE empty(day) AS (SELECT ? UNION ALL SELECT day + 1 FROM empty WHERE day < ?)
+            INSERT OR IGNORE INTO daily_results (user_id, day, pushups, finish_minute)
+            SELECT u.user_id, empty.day, 0, NULL FROM users u, empty
+            WHERE u.tz IN ({marks}) AND u.game_over=0 AND empty.day >= u.registered_day
+            """,
+            (last + 1, day - 1, *tz_names)
+        )
+    cur.execute(
+        f"""
+        UPDATE users SET fails=MIN(fails + (pushups_today < 100) + ?, 3)
+        WHERE tz IN ({marks}) AND game_over=0 AND (pushups_today < 100 OR ? > 0)
+        """,
+        (empty_days, *tz_names, empty_days)
+    )
+    # Сообщение о потерянной жизни — в outbox той же транзакцией. Обычно оно уходит к началу дня
+    # пользователя, перед приветствием; после простоя — сразу, и третья жизнь означает game over
+    cur.execute(
+        f"""
+        INSERT OR IGNORE INTO outbox (dedup_key, user_id, chat_id, kind, payload, send_after, created_at, updated_at)
+        SELECT 'fail:' || user_id || ':' || ?, user_id, user_id,
+               CASE WHEN fails >= 3 THEN 'game_over' WHEN ? = 0 THEN 'fail' ELSE 'fail_missed' END,
+               json_object('fails', fails, 'day', ?, 'missed', ?),
+               CASE WHEN ? = 0 THEN ? * 86400 + start_minute * 60 - ? ELSE ? END, ?, ?
+        FROM users WHERE tz IN ({marks}) AND game_over=0 AND active=1 AND (pushups_today < 100 OR ? > 0)
+        """,
+        (day, empty_days, day, empty_days, empty_days, day, utc_offset_seconds(tz_names[0], day), now, now, now, *tz_names, empty_days)
+    )
+    # Серия и лучший финиш — по итогу закончившегося дня; в SET справа везде старые значения строки
+    cur.execute(
+        f"""
+        UPDATE users SET
+            current_streak = CASE WHEN pushups_today >= 100 AND last_day = ? AND ? = 0 THEN current_streak + 1 ELSE 0 END,
+            longest_streak = MAX(longest_streak, CASE WHEN pushups_today >= 100 AND last_day = ? THEN current_streak + 1 ELSE 0 END),
+            best_finish_minute = CASE
+                WHEN pushups_today >= 100 AND last_day = ? AND completed_at IS NOT NULL
+                THEN MIN(COALESCE(best_finish_minute, 1440), (completed_at + ?) % 86400 / 60)
+                ELSE best_finish_minute
+            END,
+            pushups_today=0, last_day=?, completed_at=NULL
+        WHERE tz IN ({marks}) AND game_over=0
+        """,
+        (last, empty_days, last, last, offset, day, *tz_names)
+    )
+    # Третья потерянная жизнь — game over сразу, и в обычную полночь, и после простоя (сообщение game_over
+    # уже в outbox); в архив такие уйдут на следующей смене дня, когда уведомление придёт
+    cur.execute(
+        f"UPDATE users SET game_over=1, game_over_day=? WHERE tz IN ({marks}) AND game_over=0 AND fails >= 3",
+        (day, *tz_names)
+    )
+    # Выбывшие раньше и прошедшие все дни уходят из горячей таблицы в той же транзакции
+    cur.execute(
+        f"""
+        SELECT * FROM users
+        WHERE tz IN ({marks}) AND ((game_over=1 AND COALESCE(game_over_day, 0) < ?) OR ? - registered_day >= ?)
+        """,
+        (*tz_names, day, day, CHALLENGE_DAYS)
+    )
+    archived = _archive_rows(cur, [UserRecord.from_row(row) for row in cur.fetchall()])
+    cur.executemany(
+        "INSERT OR REPLACE INTO rollover_state (tz, last_day) VALUES (?, ?)",
+        ((tz_name, day) for tz_name in tz_names)
+    )
+    conn.commit()
+    conn.close()
+    _publish_reload()
+    return archived
+
+def get_rollover_state():
+    # {пояс: последний день, на который уже переключились}
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT tz, last_day FROM rollover_state")
+    state = {row["tz"]: row["last_day"] for row in cur.fetchall()}
+    conn.close()
+    return state
+
+def save_rollover_state(rows):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.executemany("INSERT OR REPLACE INTO rollover_state (tz, last_day) VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+def get_weekly_summaries(first_day, last_day, after_user_id=0, limit=500):
+    # Итоги дней [first_day, last_day] для активных пользователей с id > after_user_id, по возрастанию id.
+    # Пара агрегирующих запросов на страницу вместо прохода по истории каждого
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT u.user_id, u.username, u.name,
+               COUNT(*) AS days,
+               SUM(r.pushups >= 100) AS completed,
+               AVG(r.finish_minute) AS avg_finish_minute,
+               SUM(r.pushups < 100) AS hearts_lost,
+               SUM(r.pushups) AS total_pushups
+        FROM users u
+        JOIN daily_results r ON r.user_id = u.user_id AND r.day BETWEEN ? AND ? AND r.day >= u.registered_day
+        WHERE u.user_id > ? AND u.game_over = 0 AND u.active = 1
+        GROUP BY u.user_id
+        ORDER BY u.user_id
+        LIMIT ?
+        """,
+        (first_day, last_day, after_user_id, limit)
+    )
+    summaries = [dict(row) for row in cur.fetchall()]
+    if not summaries:
+        conn.close()
+        return []
+    _load_bulk_ids(cur, [row["user_id"] for row in summaries])
+    # Лучший день: сотка с самым ранним финишем, без сотки — больше всего отжиманий
+    cur.execute(
+        """
+        SELECT user_id, day, pushups, finish_minute FROM (
+            SELECT r.*, ROW_NUMBER() OVER (
+                PARTITION BY r.user_id ORDER BY r.pushups DESC, r.finish_minute IS NULL, r.finish_minute, r.day
+            ) AS place
+            FROM daily_results r JOIN bulk_ids b ON b.user_id = r.user_id
+            WHERE r.day BETWEEN ? AND ?
+        ) WHERE place = 1
+        """,
+        (first_day, last_day)
+    )
+    best = {row["user_id"]: row for row in cur.fetchall()}
+    conn.close()
+    for row in summaries:
+        best_row = best[row["user_id"]]
+        row["avg_finish_minute"] = round(row["avg_finish_minute"]) if row["avg_finish_minute"] is not None else None
+        row["best_day"] = best_row["day"]
+        row["best_pushups"] = best_row["pushups"]
+        row["best_finish_minute"] = best_row["finish_minute"]
+    return summaries
+
+def get_job_cursor(job):
+    # -> (period, cursor, done) или None
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT period, cursor, done FROM job_cursors WHERE job=?", (job,))
+    row = cur.fetchone()
+    conn.close()
+    return (row["period"], row["cursor"], row["done"]) if row else None
+
+def save_job_cursor(job, period, cursor, done=0):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT OR REPLACE INTO job_cursors (job, period, cursor, done, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (job, period, cursor, done, int(time.time()))
+    )
+    conn.commit()
+    conn.close()
+
+def get_recipient_ids(after_user_id=0, limit=500):
+    # Следующая страница id для рассылки: по первичному ключу, без OFFSET
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT user_id FROM users WHERE user_id > ? AND active = 1 ORDER BY user_id LIMIT ?",
+        (after_user_id, limit)
+    )
+    user_ids = [row["user_id"] for row in cur.fetchall()]
+    conn.close()
+    return user_ids
+
+def count_recipients():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM users WHERE active = 1")
+    count = cur.fetchone()[0]
+    conn.close()
+    return count
+
+def set_active_many(user_ids, value):
+    conn = get_db()
+    cur = conn.cursor()
+    _load_bulk_ids(cur, user_ids)
+    cur.execute("UPDATE users SET active=? WHERE user_id IN (SELECT user_id FROM bulk_ids) AND active != ?", (value, value))
+    changed = cur.rowcount
+    conn.commit()
+    conn.close()
+    return changed
+
+def create_broadcast(text, chat_id, total):
+    now = int(time.time())
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO broadcasts (text, chat_id, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (text, chat_id, total, now, now)
+    )
+    broadcast_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    return broadcast_id
+
+def get_unfinished_broadcasts():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM broadcasts WHERE done = 0 ORDER BY broadcast_id")
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def save_broadcast_progress(broadcast_id, cursor, sent, blocked, failed, done=0, message_id=None):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        UPDATE broadcasts SET cursor=?, sent=?, blocked=?, failed=?, done=?, message_id=COALESCE(?, message_id), updated_at=?
+        WHERE broadcast_id=?
+        """,
+        (cursor, sent, blocked, failed, done, message_id, int(time.time()), broadcast_id)
+    )
+    conn.commit()
+    conn.close()
+
+def _outbox_row(row):
+    return dict(row, payload=json.loads(row["payload"]))
+
+def enqueue_messages(rows):
+    # rows: (dedup_key, user_id, chat_id, kind, payload, send_after) -> сколько добавлено;
+    # уже стоящие в очереди (или недавно отправленные) по dedup_key пропускаются
+    now = int(time.time())
+    conn = get_db()
+    cur = conn.cursor()
+    cur.executemany(
+        """
+        INSERT OR IGNORE INTO outbox (dedup_key, user_id, chat_id, kind, payload, send_after, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            (dedup_key, user_id, chat_id, kind, json.dumps(payload), send_after, now, now)
+            for dedup_key, user_id, chat_id, kind, payload, send_after in rows
+        )
+    )
+    added = cur.rowcount
+    conn.commit()
+    conn.close()
+    return added
+
+def enqueue_greeting(user_id, chat_id, day, send_after):
+    # Приветствие и отметка "поприветствован" — одной транзакцией
+    now = int(time.time())
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO outbox (dedup_key, user_id, chat_id, kind, payload, send_after, created_at, updated_at)
+        VALUES (?, ?, ?, 'greeting', ?, ?, ?, ?)
+        """,
+        (f"greeting:{user_id}:{day}", user_id, chat_id, json.dumps({"day": day}), send_after, now, now)
+    )
+    added = cur.rowcount
+    cur.execute("UPDATE users SET greeted_day=? WHERE user_id=?", (day, user_id))
+    conn.commit()
+    conn.close()
+    return added
+
+def get_due_messages(now, limit=200):
+    # Ожидающие отправки с send_after <= now в порядке постановки
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT * FROM outbox WHERE status = 'pending' AND send_after <= ? ORDER BY send_after, outbox_id LIMIT ?",
+        (now, limit)
+    )
+    rows = [_outbox_row(row) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def save_outbox_results(rows):
+    # rows: (status, send_after, outbox_id); каждая запись — ещё одна попытка
+    conn = get_db()
+    cur = conn.cursor()
+    cur.executemany(
+        "UPDATE outbox SET status=?, send_after=?, attempts=attempts + 1, updated_at=? WHERE outbox_id=?",
+        ((status, send_after, int(time.time()), outbox_id) for status, send_after, outbox_id in rows)
+    )
+    conn.commit()
+    conn.close()
+
+def prune_outbox(before):
+    # Обработанные записи старше before; пока запись есть, её dedup_key не даст отправить повтор
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM outbox WHERE status != 'pending' AND updated_at < ?", (before,))
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def count_outbox():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) AS count FROM outbox GROUP BY status")
+    counts = {row["status"]: row["count"] for row in cur.fetchall()}
+    conn.close()
+    return counts
+
+def incremental_vacuum(pages):
+    # Шаг освобождения места; возвращает, сколько свободных страниц осталось
+    conn = get_db()
+    cur = conn.cursor()
+    # executescript прогоняет прагму до конца — execute освободил бы одну страницу
+    cur.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    remaining = cur.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.close()
+    return remaining
+
 def get_notify_fail(user_id):
     conn = get_db()
     cur = conn.cursor()
@@ -246,15 +1302,96 @@ def get_game_over(user_id):
     return row["game_over"] if row else 0
 
 def set_game_over(user_id, value):
+    before = get_user(user_id) if _listeners else None
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE users SET game_over=?, game_over_day=CASE WHEN ? THEN ? END WHERE user_id=?",
+        (value, value, local_day(before.tz if before else DEFAULT_TZ), user_id)
+    )
+    conn.commit()
+    conn.close()
+    _publish(user_id, before)
+
+def set_greeted_day(user_id, day):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET greeted_day=? WHERE user_id=?", (day, user_id))
+    conn.commit()
+    conn.close()
+
+def set_card_message_id(user_id, message_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET card_message_id=? WHERE user_id=?", (message_id, user_id))
+    conn.commit()
+    conn.close()
+
+def get_scheduler_state(user_id):
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE users SET game_over=? WHERE user_id=?", (value, user_id))
+    cur.execute("SELECT kind, last_fire, next_fire FROM scheduler_state WHERE user_id=?", (user_id,))
+    state = {row["kind"]: (row["last_fire"], row["next_fire"]) for row in cur.fetchall()}
+    conn.close()
+    return state
+
+def save_scheduler_state(rows):
+    # rows: [(user_id, kind, last_fire, next_fire), ...] — пишется одной транзакцией
+    if not rows:
+        return
+    conn = get_db()
+    cur = conn.cursor()
+    cur.executemany(
+        """
+        INSERT INTO scheduler_state (user_id, kind, last_fire, next_fire)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, kind) DO UPDATE SET
+            last_fire=excluded.last_fire,
+            next_fire=excluded.next_fire
+        """,
+        rows
+    )
     conn.commit()
     conn.close()
 
-def set_greeted_date(user_id, date_str):
+def load_conversations(name):
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE users SET greeted_date=? WHERE user_id=?", (date_str, user_id))
+    cur.execute("SELECT conv_key, state FROM conversations WHERE name=?", (name,))
+    rows = [(row["conv_key"], row["state"]) for row in cur.fetchall()]
+    conn.close()
+    return rows
+
+def load_user_data(user_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT data FROM user_data WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    return row["data"] if row else None
+
+def save_persistence(conversations, dropped_conversations, user_data, dropped_user_data):
+    # Все накопленные изменения — одной транзакцией
+    conn = get_db()
+    cur = conn.cursor()
+    cur.executemany(
+        "INSERT INTO conversations (name, conv_key, state) VALUES (?, ?, ?) "
+        "ON CONFLICT(name, conv_key) DO UPDATE SET state=excluded.state",
+        conversations
+    )
+    cur.executemany("DELETE FROM conversations WHERE name=? AND conv_key=?", dropped_conversations)
+    cur.executemany(
+        "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data",
+        user_data
+    )
+    cur.executemany("DELETE FROM user_data WHERE user_id=?", [(user_id,) for user_id in dropped_user_data])
     conn.commit()
     conn.close()
+
+# Трассировка: каждый вызов функции доступа к БД — спан текущего апдейта.
+# Новые функции объявлять выше этого блока.
+_NOT_TRACED = {"day_number", "day_from_number", "local_today", "local_day", "utc_offset_seconds", "subscribe", "get_db", "open_writer", "init_db", "get_user_current_day"}
+for _name, _func in list(globals().items()):
+    if inspect.isfunction(_func) and _func.__module__ == __name__ and not _name.startswith("_") and _name not in _NOT_TRACED:
+        globals()[_name] = traced("db", _name)(_func)
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+SENT = "sent"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+
+class ThrottledSender:
+    # Массовая отправка в пределах лимитов Telegram (около 30 сообщений в секунду на бота):
+    # не чаще rate сообщений в секунду и не больше concurrency запросов одновременно.
+    # RetryAfter притормаживает всю рассылку, а не только упавший запрос.
+    def __init__(self, bot, rate=25, concurrency=8, attempts=3):
+        self.bot = bot
+        self.interval = 1 / rate
+        self.attempts = attempts
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_slot = 0.0
+
+    async def _wait_slot(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _pause(self, seconds):
+        self._next_slot = max(self._next_slot, asyncio.get_running_loop().time() + seconds)
+
+    async def send(self, chat_id, text, **kwargs):
+        # -> SENT | BLOCKED (бот заблокирован или чата нет) | FAILED
+        async with self._semaphore:
+            for attempt in range(1, self.attempts + 1):
+                await self._wait_slot()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    return SENT
+                except RetryAfter as e:
+                    logger.warning(f"Flood limit hit, pausing sends for {e.retry_after}s")
+                    self._pause(e.retry_after)
+                except Forbidden:
+                    return BLOCKED
+                except BadRequest as e:
+                    if "chat not found" in str(e).lower():
+                        return BLOCKED
+                    logger.warning(f"Failed to send to {chat_id}: {e}")
+                    return FAILED
+                except TelegramError as e:
+                    # Сеть, таймауты — повторяем с паузой
+                    logger.warning(f"Send to {chat_id} failed (attempt {attempt}): {e}")
+                    self._pause(attempt)
+            return FAILED
+
+    async def send_many(self, messages, **kwargs):
+        # messages: [(chat_id, text)] -> [(chat_id, результат)] в том же порядке
+        results = await asyncio.gather(*(self.send(chat_id, text, **kwargs) for chat_id, text in messages))
+        return list(zip((chat_id for chat_id, _text in messages), results))
@@ -0,0 +1,60 @@
+import time
+
+
+class FloodGuard:
+    # Входящий лимит на пользователя (token bucket): в ведре до burst апдейтов, пополняется rate в секунду.
+    # Проверка идёт в процессоре апдейтов до хэндлеров и persistence — отброшенный апдейт не трогает БД.
+    def __init__(self, rate, burst, notice_interval=30):
+        self.rate = rate
+        self.burst = burst
+        self.notice_interval = notice_interval
+        self.buckets = {}  # {key: [токены, когда пересчитаны]}
+        self.notified = {}  # {key: когда последний раз просили притормозить}
+        self.allowed = 0
+        self.dropped = 0
+        self.notices = 0
+
+    def allow(self, key):
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def should_notify(self, key):
+        # Одно "притормози" на notice_interval, а не ответ на каждый отброшенный апдейт
+        now = time.monotonic()
+        if now - self.notified.get(key, -self.notice_interval) < self.notice_interval:
+            return False
+        self.notified[key] = now
+        self.notices += 1
+        return True
+
+    def prune(self):
+        # Полные вёдра ничем не отличаются от отсутствующих — убираем, чтобы словарь не рос
+        now = time.monotonic()
+        full = [
+            key for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate >= self.burst
+        ]
+        for key in full:
+            del self.buckets[key]
+        for key in [key for key, at in self.notified.items() if now - at >= self.notice_interval]:
+            del self.notified[key]
+        return len(full)
+
+    def counters(self):
+        return {
+            "allowed": self.allowed,
+            "dropped": self.dropped,
+            "notices": self.notices,
+            "buckets": len(self.buckets),
+        }
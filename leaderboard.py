@@ -0,0 +1,150 @@
+from db import local_day
+
+
+class FenwickTree:
+    # Дерево Фенвика (1-based): префиксные суммы и поиск k-го элемента за O(log n)
+    def __init__(self, size=0):
+        self.tree = [0] * (size + 1)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, i, delta):
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def append(self, value):
+        # Новый узел i покрывает (i - lowbit(i), i]
+        i = len(self.tree)
+        self.tree.append(self.prefix(i - 1) - self.prefix(i - (i & -i)) + value)
+
+    def find(self, k):
+        # Наименьший i, для которого prefix(i) >= k
+        pos = 0
+        step = 1 << (len(self).bit_length() - 1) if len(self) else 0
+        while step:
+            nxt = pos + step
+            if nxt <= len(self) and self.tree[nxt] < k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return pos + 1
+
+
+class Leaderboard:
+    # Рейтинг дня: сначала финишёры в порядке финиша, потом остальные по убыванию отжиманий.
+    # Место и любая страница считаются без сортировки всей таблицы.
+    def __init__(self, storage):
+        self.storage = storage
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        # Финишёры: порядковый номер финиша -> user_id, удалённые остаются "надгробиями" (None)
+        self.finish_order = []
+        self.finish_seq = {}
+        self.finishers = FenwickTree()
+        # Остальные: корзины по числу отжиманий 99..1, индекс в дереве = 100 - pushups
+        self.counts = FenwickTree(99)
+        self.buckets = {pushups: [] for pushups in range(1, 100)}
+        self.bucket_pos = {}
+
+    def __len__(self):
+        return self.finishers.prefix(len(self.finishers)) + self.counts.prefix(99)
+
+    # --- Подписка на изменения в db ---
+    def user_changed(self, before, after):
+        if after is None:
+            self.remove(before.user_id if before else None)
+            return
+        if after.game_over or after.pushups_today <= 0 or after.last_day != local_day(after.tz):
+            self.remove(after.user_id)
+            return
+        self.update(after)
+
+    def reloaded(self):
+        self.rebuild(self.storage.get_leaderboard_rows())
+
+    # --- Изменения ---
+    def rebuild(self, rows):
+        self.clear()
+        finished = sorted((e for e in rows if e.pushups_today >= 100), key=lambda e: (e.completed_at or 0))
+        for entry in finished:
+            self._insert_finisher(entry)
+        for entry in rows:
+            if entry.pushups_today < 100:
+                self._insert_bucket(entry)
+
+    def update(self, entry):
+        old = self.entries.get(entry.user_id)
+        if old and old.pushups_today >= 100 and entry.pushups_today >= 100 and old.completed_at == entry.completed_at:
+            # Финиш не изменился — место в очереди финишёров сохраняем
+            self.entries[entry.user_id] = entry
+            return
+        self.remove(entry.user_id)
+        if entry.pushups_today >= 100:
+            self._insert_finisher(entry)
+        else:
+            self._insert_bucket(entry)
+
+    def remove(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        seq = self.finish_seq.pop(user_id, None)
+        if seq is not None:
+            self.finish_order[seq - 1] = None
+            self.finishers.add(seq, -1)
+            return
+        bucket = self.buckets[entry.pushups_today]
+        idx = self.bucket_pos.pop(user_id)
+        last = bucket.pop()
+        if last != user_id:
+            bucket[idx] = last
+            self.bucket_pos[last] = idx
+        self.counts.add(100 - entry.pushups_today, -1)
+
+    def _insert_finisher(self, entry):
+        self.entries[entry.user_id] = entry
+        self.finish_order.append(entry.user_id)
+        self.finishers.append(1)
+        self.finish_seq[entry.user_id] = len(self.finish_order)
+
+    def _insert_bucket(self, entry):
+        self.entries[entry.user_id] = entry
+        bucket = self.buckets[entry.pushups_today]
+        self.bucket_pos[entry.user_id] = len(bucket)
+        bucket.append(entry.user_id)
+        self.counts.add(100 - entry.pushups_today, 1)
+
+    # --- Запросы ---
+    def position_of(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        seq = self.finish_seq.get(user_id)
+        if seq is not None:
+            return self.finishers.prefix(seq) - 1
+        finished = self.finishers.prefix(len(self.finishers))
+        return finished + self.counts.prefix(99 - entry.pushups_today) + self.bucket_pos[user_id]
+
+    def entry_at(self, pos):
+        finished = self.finishers.prefix(len(self.finishers))
+        if pos < finished:
+            return self.entries[self.finish_order[self.finishers.find(pos + 1) - 1]]
+        k = pos - finished
+        idx = self.counts.find(k + 1)
+        within = k - self.counts.prefix(idx - 1)
+        return self.entries[self.buckets[100 - idx][within]]
+
+    def page(self, page, size):
+        start = page * size
+        return [self.entry_at(pos) for pos in range(start, min(start + size, len(self)))]
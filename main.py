@@ -2,45 +2,55 @@ import logging
 import os
 import re
 import asyncio
+import time
 from datetime import datetime, timedelta, time as dt_time
 from dotenv import load_dotenv
-from pytz import timezone
+from pytz import timezone, utc, UnknownTimeZoneError
 from telegram import (
     Update,
+    ChatMember,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
 )
 from telegram.ext import (
     Application,
+    TypeHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
     ConversationHandler,
+    CallbackQueryHandler,
+    ChatMemberHandler,
 )
+from telegram.error import BadRequest, TelegramError
 from db import (
-    init_db,
-    add_user,
-    get_user,
-    reset_user,
-    add_pushups,
-    get_pushups_today,
-    next_day,
-    fail_day,
-    get_fails,
-    get_all_user_ids,
-    update_user_settings,
-    get_top_pushups_today,
-    decrease_pushups,
-    get_db,
     get_user_current_day,
-    set_greeted_date,
-    get_notify_fail,
-    set_notify_fail,
+    day_number,
+    day_from_number,
+    get_tz,
+    DEFAULT_TZ,
+    CHALLENGE_DAYS,
+    DB_PATH,
+    local_day,
+    utc_offset_seconds,
 )
-
-ASK_NAME, ASK_START_TIME, ASK_END_TIME, ASK_REMINDERS = range(4)
+from leaderboard import Leaderboard
+from stats import ChallengeStats
+from update_processor import PerUserUpdateProcessor
+from flood import FloodGuard
+from persistence import StoragePersistence
+from storage import MemoryStorage, ShardedStorage, SQLiteStorage, shard_paths
+from recorder import UpdateRecorder
+from fanout import BLOCKED, FAILED, SENT, ThrottledSender
+from memreport import MemoryReport, describe_stat, format_bytes, rss_bytes, shallow_size, task_counts
+from tracing import event, setup_logging, stop_logging
+from transport import build_request
+
+ASK_NAME, ASK_START_TIME, ASK_END_TIME, ASK_REMINDERS, ASK_TIMEZONE = range(5)
 (
     SETTINGS_ASK_START,
     SETTINGS_INPUT_START,
@@ -48,7 +58,9 @@ ASK_NAME, ASK_START_TIME, ASK_END_TIME, ASK_REMINDERS = range(4)
     SETTINGS_INPUT_END,
     SETTINGS_ASK_REMINDERS,
     SETTINGS_INPUT_REMINDERS,
-) = range(10, 16)
+    SETTINGS_ASK_TIMEZONE,
+    SETTINGS_INPUT_TIMEZONE,
+) = range(10, 18)
 
 DEVIL = "😈"
 CLOVER = "🍀"
@@ -63,6 +75,7 @@ CHILL = "🧘"
 SKULL = "💀"
 ROAD = "🛣️"
 UP = "📈"
+CALENDAR = "📅"
 SETTINGS = "⚙️"
 LEADERBOARD = "🏆 Топ учасників"
 
@@ -73,28 +86,105 @@ ADMIN_ID = 271278573
 
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
-
-logging.basicConfig(level=logging.INFO)
+# Сколько апдейтов разных пользователей обрабатывать одновременно (1 — последовательно)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+# Как часто (сек) сохранять состояния диалогов и user_data в БД
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "30"))
+# Хранилище: sqlite (по умолчанию) или memory — для тестовых ботов, всё теряется при перезапуске
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+# Сколько файлов SQLite делят пользователей по хэшу id (1 — один файл, как раньше). На живой базе не менять:
+# пользователи из users.db сами по шардам не переедут
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Запись входящих апдейтов (обезличенных) для replay.py; пусто — не пишем
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH", "")
+# Глубина стека tracemalloc с самого старта (0 — включается первым /memreport)
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "0"))
+# Уборка: завершённые задачи, user_data и кэши тех, кто не писал дольше USER_DATA_IDLE_HOURS
+HOUSEKEEPING_INTERVAL = int(os.getenv("HOUSEKEEPING_INTERVAL", "600"))
+USER_DATA_IDLE_HOURS = float(os.getenv("USER_DATA_IDLE_HOURS", "72"))
+# Входящий лимит на пользователя: апдейтов подряд (FLOOD_BURST, 0 — без лимита) и пополнение в секунду;
+# просьба притормозить — не чаще раза в FLOOD_NOTICE_INTERVAL сек
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "10"))
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_NOTICE_INTERVAL = float(os.getenv("FLOOD_NOTICE_INTERVAL", "30"))
+# Соединения с Bot API: отдельные пулы для отправки и для getUpdates, таймауты (сек),
+# HTTP/2 (auto — если установлен h2), keep-alive простаивающих соединений
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "256"))
+BOT_API_UPDATES_POOL_SIZE = int(os.getenv("BOT_API_UPDATES_POOL_SIZE", "1"))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "5"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "5"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "1"))
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "auto")
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", "30"))
+# Массовые рассылки: сообщений в секунду и одновременных запросов
+FANOUT_RATE = float(os.getenv("FANOUT_RATE", "25"))
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "8"))
+
+setup_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
-init_db()
+if STORAGE_BACKEND == "memory":
+    storage = MemoryStorage()
+elif DB_SHARDS > 1:
+    storage = ShardedStorage(shard_paths(DB_PATH, DB_SHARDS))
+else:
+    storage = SQLiteStorage()
+storage.init()
 
 reminder_tasks = {}
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_NOTICE_INTERVAL) if FLOOD_BURST > 0 else None
+memory_report = MemoryReport(TRACEMALLOC_FRAMES)
+
+# Рейтинг дня в памяти, обновляется при каждой записи в хранилище
+leaderboard = Leaderboard(storage)
+storage.subscribe(leaderboard)
+challenge_stats = ChallengeStats(storage)
+storage.subscribe(challenge_stats)
+LOBBY_PAGE_SIZE = 10
+
+# Что сейчас показано на карточке статуса: {user_id: (message_id, text, minus)}
+card_state = {}
+
+# Отправленные события планировщика, ещё не записанные в БД: {user_id: {kind: (last_fire, next_fire)}}
+scheduler_state_buffer = {}
+SCHEDULER_FLUSH_INTERVAL = int(os.getenv("SCHEDULER_FLUSH_INTERVAL", "30"))
+# Что делать с событиями, пропущенными пока бот лежал: all | latest | none
+CATCHUP_POLICY = os.getenv("CATCHUP_POLICY", "latest")
+ONCE_A_DAY_EVENTS = ("greeting", "summary")
 
 KIEV_TZ = timezone("Europe/Kyiv")
 
-def get_game_over(user_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT game_over FROM users WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    return row["game_over"] if row and "game_over" in row.keys() else 0
-
-def set_game_over(user_id, value=1):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET game_over = ? WHERE user_id = ?", (value, user_id))
-    conn.commit()
+TIMEZONE_CHOICES = [
+    "Europe/Kyiv", "Europe/Warsaw",
+    "Europe/Berlin", "Europe/London",
+    "America/New_York", "Asia/Dubai",
+]
+ROLLOVER_RESCHEDULE_INTERVAL = 600
+# Время ежедневного дайджеста в группах (по часовому поясу группы)
+GROUP_DIGEST_TIME = os.getenv("GROUP_DIGEST_TIME", "22:00")
+# Тихие часы (по Киеву, [начало, конец)), когда база понемногу возвращает место после архивации
+VACUUM_QUIET_HOURS = tuple(int(h) for h in os.getenv("VACUUM_QUIET_HOURS", "3-5").split("-"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+VACUUM_STEP_INTERVAL = 10
+# Недельный итог: день недели (0 — понедельник) и время по Киеву — не в вечерний пик
+WEEKLY_SUMMARY_WEEKDAY = int(os.getenv("WEEKLY_SUMMARY_WEEKDAY", "0"))
+WEEKLY_SUMMARY_TIME = os.getenv("WEEKLY_SUMMARY_TIME", "10:00")
+WEEKLY_SUMMARY_BATCH = 500
+WEEKLY_SUMMARY_JOB = "weekly_summary"
+BROADCAST_BATCH = 200
+# Не чаще, чем раз в столько секунд, правим сообщение с прогрессом рассылки
+BROADCAST_PROGRESS_INTERVAL = 5
+# Outbox: как часто проверять очередь без явного пробуждения (сек), сколько строк за проход,
+# сколько попыток до отказа и сколько часов хранить обработанные (на это время работает дедупликация)
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", "2"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_KEEP_HOURS = float(os.getenv("OUTBOX_KEEP_HOURS", "48"))
+PENDING = "pending"
+SKIPPED = "skipped"
+# Будит отправителя сразу после постановки в очередь
+outbox_wakeup = asyncio.Event()
 
 def get_main_keyboard():
     keyboard = [
@@ -106,6 +196,13 @@ def get_main_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+def is_group_chat(update):
+    return update.effective_chat.type in ("group", "supergroup")
+
+def main_keyboard_for(update):
+    # В группах личную клавиатуру не показываем — она всплыла бы у всех участников
+    return None if is_group_chat(update) else get_main_keyboard()
+
 def get_yes_no_back_keyboard():
     keyboard = [
         [KeyboardButton("✅ Так"), KeyboardButton("❌ Ні")],
@@ -169,165 +266,490 @@ def minutes_to_time(mins):
     m = mins % 60
     return dt_time(hour=h, minute=m)
 
-def get_reminder_times(start_time_str, end_time_str, reminders_count):
-    start_dt = datetime.strptime(start_time_str, "%H:%M")
-    end_dt = datetime.strptime(end_time_str, "%H:%M")
+def format_minutes(mins):
+    return f"{mins // 60:02d}:{mins % 60:02d}"
+
+def format_clock(ts, tz_name):
+    return datetime.fromtimestamp(ts, get_tz(tz_name)).strftime("%H:%M")
+
+def get_reminder_times(start_minute, end_minute, reminders_count):
+    # Всё в минутах от начала суток — без разбора строк
+    actual_start = start_minute + 60
+    actual_end = end_minute - 60
 
     if reminders_count < 2:
         # Одно напоминание — через час после старта, но не позже чем за час до конца
-        reminder_time = start_dt + timedelta(hours=1)
-        latest_time = end_dt - timedelta(hours=1)
-        if reminder_time > latest_time:
-            reminder_time = latest_time
-        return [reminder_time.time()]
-
-    # Диапазон для равномерного распределения
-    actual_start = start_dt + timedelta(hours=1)
-    actual_end = end_dt - timedelta(hours=1)
-    total_minutes = int((actual_end - actual_start).total_seconds() // 60)
+        return [min(actual_start, actual_end)]
+
+    total_minutes = actual_end - actual_start
     if total_minutes < 0:
         # Если диапазон некорректный
         return []
 
-    times = []
     if reminders_count == 2:
         # Только два напоминания: через час после старта и за час до конца
-        times = [actual_start.time(), actual_end.time()]
-    else:
-        interval = total_minutes / (reminders_count - 1)
-        for i in range(reminders_count):
-            mins = int(round(i * interval))
-            t = (actual_start + timedelta(minutes=mins)).time()
-            times.append(t)
-    return times
-
-def is_within_today_working_period(start_time, end_time):
-    now = datetime.now(KIEV_TZ)
-    today = now.date()
-    start_dt = KIEV_TZ.localize(datetime.combine(today, datetime.strptime(start_time, "%H:%M").time()))
-    end_dt = KIEV_TZ.localize(datetime.combine(today, datetime.strptime(end_time, "%H:%M").time()))
-    return start_dt <= now < end_dt
+        return [actual_start, actual_end]
+    interval = total_minutes / (reminders_count - 1)
+    return [actual_start + int(round(i * interval)) for i in range(reminders_count)]
+
+def is_within_today_working_period(start_minute, end_minute, tz_name=DEFAULT_TZ):
+    now = datetime.now(get_tz(tz_name))
+    return start_minute <= now.hour * 60 + now.minute < end_minute
+
+def parse_timezone(text):
+    try:
+        return timezone(text.strip()).zone
+    except UnknownTimeZoneError:
+        return None
+
+def get_timezone_keyboard():
+    keyboard = [[KeyboardButton(tz_name) for tz_name in TIMEZONE_CHOICES[i:i + 2]] for i in range(0, len(TIMEZONE_CHOICES), 2)]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+def build_rollover_schedule(now_utc):
+    # Полночь считаем один раз на часовой пояс, а не на пользователя.
+    # Пояса с одинаковым смещением попадают в одну корзину — у них общий момент полуночи.
+    buckets = {}
+    for tz_name in storage.get_timezones():
+        tz = get_tz(tz_name)
+        tomorrow = now_utc.astimezone(tz).date() + timedelta(days=1)
+        midnight_utc = tz.localize(datetime.combine(tomorrow, dt_time(0, 0))).astimezone(utc)
+        buckets.setdefault(midnight_utc, []).append(tz_name)
+    return buckets
 
 async def global_midnight_job(application):
     while True:
-        now = datetime.now(KIEV_TZ)
-        tomorrow = now.date() + timedelta(days=1)
-        midnight = KIEV_TZ.localize(datetime.combine(tomorrow, dt_time(0, 0)))
-        seconds_to_midnight = (midnight - now).total_seconds()
+        now = datetime.now(utc)
+        buckets = build_rollover_schedule(now)
+        if not buckets:
+            await asyncio.sleep(ROLLOVER_RESCHEDULE_INTERVAL)
+            continue
+        midnight_utc = min(buckets)
+        seconds_to_midnight = (midnight_utc - now).total_seconds()
+        # Новые пояса могут появиться в любой момент — периодически пересчитываем расписание
+        if seconds_to_midnight > ROLLOVER_RESCHEDULE_INTERVAL:
+            await asyncio.sleep(ROLLOVER_RESCHEDULE_INTERVAL)
+            continue
         if seconds_to_midnight > 0:
             await asyncio.sleep(seconds_to_midnight)
 
-        for user_id in get_all_user_ids():
-            u = get_user(user_id)
-            if not u or get_game_over(user_id):
+        tz_names = buckets[midnight_utc]
+        local_midnight = midnight_utc.astimezone(get_tz(tz_names[0]))
+        day = day_number(local_midnight.date())
+        archived = run_rollovers({tz_name: day for tz_name in tz_names})
+        logger.info(
+            f"Midnight job: day {local_midnight.date().isoformat()} started for time zones {', '.join(tz_names)}, "
+            f"{archived} users archived."
+        )
+
+def run_rollovers(days_by_tz):
+    # {пояс: новый день} -> сколько ушло в архив. Пояса группируем по числу пропущенных смен дня:
+    # обычно это одна смена, после простоя — несколько, одной транзакцией на группу
+    state = storage.get_rollover_state()
+    groups = {}
+    for tz_name, day in days_by_tz.items():
+        last = state.get(tz_name, day - 1)
+        if last >= day:
+            continue
+        missed = min(day - last, CHALLENGE_DAYS)
+        # После простоя в одну группу могут попасть пояса с разным смещением — их не смешиваем:
+        # по смещению считаются минуты финиша и ключ снимка статистики
+        offset = utc_offset_seconds(tz_name, day - missed)
+        groups.setdefault((day, missed, offset), []).append(tz_name)
+    archived = 0
+    for (day, missed, offset), tz_names in groups.items():
+        if missed > 1:
+            logger.warning(f"Catching up {missed} day changes for time zones {', '.join(tz_names)}")
+        # Снимок статистики за последний день с данными — до того, как обнулятся отжимания
+        challenge_stats.snapshot(day - missed, offset // 60, tz_names)
+        archived += storage.rollover_timezones(tz_names, day, missed) or 0
+    return archived
+
+def catch_up_rollovers():
+    # На старте: пояса, где смена дня прошла, пока бот лежал. Пояс без истории считаем актуальным
+    state = storage.get_rollover_state()
+    today = {tz_name: local_day(tz_name) for tz_name in storage.get_timezones()}
+    storage.save_rollover_state([(tz_name, day) for tz_name, day in today.items() if tz_name not in state])
+    behind = {tz_name: day for tz_name, day in today.items() if tz_name in state and state[tz_name] < day}
+    if not behind:
+        return set()
+    # Сообщения о потерянных за простой жизнях и game over ставит в outbox сам переход дня
+    run_rollovers(behind)
+    outbox_wakeup.set()
+    return set(behind)
+
+async def vacuum_job(application):
+    start_hour, end_hour = VACUUM_QUIET_HOURS
+    while True:
+        now = datetime.now(get_tz(DEFAULT_TZ))
+        if not start_hour <= now.hour < end_hour:
+            await asyncio.sleep(ROLLOVER_RESCHEDULE_INTERVAL)
+            continue
+        try:
+            remaining = storage.compact(VACUUM_STEP_PAGES)
+        except Exception as e:
+            logger.warning(f"Incremental vacuum failed: {e}")
+            remaining = 0
+        # Всё освобождено — ждём следующей ночи, иначе следующий маленький шаг
+        await asyncio.sleep(VACUUM_STEP_INTERVAL if remaining else ROLLOVER_RESCHEDULE_INTERVAL)
+
+def last_weekly_run(now):
+    # Последний момент недельной рассылки, не позже now
+    hour, minute = map(int, WEEKLY_SUMMARY_TIME.split(":"))
+    run_date = now.date() - timedelta(days=(now.weekday() - WEEKLY_SUMMARY_WEEKDAY) % 7)
+    run_dt = KIEV_TZ.localize(datetime.combine(run_date, dt_time(hour, minute)))
+    if run_dt > now:
+        run_dt = KIEV_TZ.localize(datetime.combine(run_date - timedelta(days=7), dt_time(hour, minute)))
+    return run_dt
+
+def render_weekly_summary(row):
+    best_date = day_from_number(row["best_day"]).strftime("%d.%m")
+    if row["best_finish_minute"] is not None:
+        best = f"{best_date} — сотка о {format_minutes(row['best_finish_minute'])}"
+    else:
+        best = f"{best_date} — {row['best_pushups']} віджимань"
+    avg = format_minutes(row["avg_finish_minute"]) if row["avg_finish_minute"] is not None else "—"
+    lost = f"{row['hearts_lost']} {HEART_BLACK}" if row["hearts_lost"] else "жодного"
+    return (
+        f"{CALENDAR} *Твій тиждень у Devil's 100*\n\n"
+        f"Днів із соткою: *{row['completed']}* з {row['days']}\n"
+        f"Середній час фінішу: *{avg}*\n"
+        f"Найкращий день: *{best}*\n"
+        f"Втрачено сердець: *{lost}*\n"
+        f"Всього віджимань: *{row['total_pushups']}* {STRONG}"
+    )
+
+async def send_weekly_summaries(application, period, after_user_id):
+    # Страницами по id: итоги считаются пачкой, отправляются через троттлинг,
+    # после каждой страницы курсор в БД — прерванная рассылка продолжится с того же места
+    sender = application.bot_data["sender"]
+    cursor = after_user_id
+    counts = {}
+    while True:
+        rows = storage.get_weekly_summaries(period, period + 6, cursor, WEEKLY_SUMMARY_BATCH)
+        if not rows:
+            break
+        messages = [(row["user_id"], render_weekly_summary(row)) for row in rows]
+        results = await sender.send_many(messages, parse_mode="Markdown")
+        for _chat_id, result in results:
+            counts[result] = counts.get(result, 0) + 1
+        storage.set_active_many([chat_id for chat_id, result in results if result == BLOCKED], 0)
+        cursor = rows[-1]["user_id"]
+        storage.save_job_cursor(WEEKLY_SUMMARY_JOB, period, cursor)
+    storage.save_job_cursor(WEEKLY_SUMMARY_JOB, period, cursor, done=1)
+    return counts
+
+async def run_weekly_summaries(application, period, after_user_id):
+    # Ошибка посреди рассылки — пауза и продолжение с сохранённого курсора
+    while True:
+        try:
+            counts = await send_weekly_summaries(application, period, after_user_id)
+            logger.info(f"Weekly summaries for {day_from_number(period).isoformat()}: {counts}")
+            return
+        except Exception as e:
+            logger.exception(f"Weekly summary job failed: {e}")
+            await asyncio.sleep(ROLLOVER_RESCHEDULE_INTERVAL)
+            saved = storage.get_job_cursor(WEEKLY_SUMMARY_JOB)
+            if saved and saved[0] == period:
+                after_user_id = saved[1]
+
+async def weekly_summary_job(application):
+    # На старте досылаем только прерванную рассылку текущей недели (курсор есть, done=0).
+    # Неначатую неделю не шлём: после первого деплоя или рестарта итоги ушли бы в любой час,
+    # в том числе в вечерний пик, — ждём следующего WEEKLY_SUMMARY_WEEKDAY/TIME
+    now = datetime.now(KIEV_TZ)
+    saved = storage.get_job_cursor(WEEKLY_SUMMARY_JOB)
+    # Итоги за 7 дней до дня рассылки
+    period = day_number(last_weekly_run(now).date()) - 7
+    if saved and saved[0] == period and not saved[2]:
+        await run_weekly_summaries(application, period, saved[1])
+    while True:
+        next_run = last_weekly_run(datetime.now(KIEV_TZ) + timedelta(days=7))
+        while datetime.now(KIEV_TZ) < next_run:
+            await asyncio.sleep(max((next_run - datetime.now(KIEV_TZ)).total_seconds(), 1))
+        await run_weekly_summaries(application, day_number(next_run.date()) - 7, 0)
+
+def render_broadcast_progress(b, rate, done=False):
+    processed = b["sent"] + b["blocked"] + b["failed"]
+    title = f"📣 Рассылка #{b['broadcast_id']} завершена" if done else f"📣 Рассылка #{b['broadcast_id']}"
+    return (
+        f"{title}\n"
+        f"Обработано: {processed} из {b['total']}\n"
+        f"Доставлено: {b['sent']}, заблокировали бота: {b['blocked']}, ошибок: {b['failed']}\n"
+        f"Скорость: {rate:.1f} сообщений/с"
+    )
+
+async def show_broadcast_progress(application, b, text):
+    try:
+        if b["message_id"]:
+            await application.bot.edit_message_text(chat_id=b["chat_id"], message_id=b["message_id"], text=text)
+        else:
+            message = await application.bot.send_message(chat_id=b["chat_id"], text=text)
+            b["message_id"] = message.message_id
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            logger.warning(f"Failed to update broadcast progress: {e}")
+    except TelegramError as e:
+        logger.warning(f"Failed to update broadcast progress: {e}")
+
+async def run_broadcast(application, b):
+    # b — строка broadcasts. Получатели идут страницами по id от курсора; после каждой страницы
+    # чекпоинт в БД, так что после рестарта рассылка продолжается, а не начинается заново
+    sender = application.bot_data["sender"]
+    started = time.monotonic()
+    # Скорость — по этому запуску, без обработанных до рестарта
+    processed = 0
+    last_progress = 0.0
+
+    def rate():
+        return processed / max(time.monotonic() - started, 0.001)
+
+    while True:
+        user_ids = storage.get_recipient_ids(b["cursor"], BROADCAST_BATCH)
+        if not user_ids:
+            break
+        results = await sender.send_many([(user_id, b["text"]) for user_id in user_ids])
+        # Результаты отправки совпадают с именами счётчиков: sent, blocked, failed
+        for _user_id, result in results:
+            b[result] += 1
+        processed += len(results)
+        storage.set_active_many([user_id for user_id, result in results if result == BLOCKED], 0)
+        b["cursor"] = user_ids[-1]
+        storage.save_broadcast_progress(b["broadcast_id"], b["cursor"], b["sent"], b["blocked"], b["failed"], message_id=b["message_id"])
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await show_broadcast_progress(application, b, render_broadcast_progress(b, rate()))
+    storage.save_broadcast_progress(b["broadcast_id"], b["cursor"], b["sent"], b["blocked"], b["failed"], done=1, message_id=b["message_id"])
+    await show_broadcast_progress(application, b, render_broadcast_progress(b, rate(), done=True))
+    logger.info(f"Broadcast #{b['broadcast_id']} finished: sent {b['sent']}, blocked {b['blocked']}, failed {b['failed']}.")
+
+def start_broadcast(application, b):
+    async def guarded():
+        try:
+            await run_broadcast(application, b)
+        except Exception as e:
+            logger.exception(f"Broadcast #{b['broadcast_id']} stopped: {e}")
+    asyncio.create_task(guarded())
+
+def build_day_events(u, day):
+    tz = get_tz(u.tz)
+    start_dt = tz.localize(datetime.combine(day, minutes_to_time(u.start_minute)))
+    end_dt = tz.localize(datetime.combine(day, minutes_to_time(u.end_minute)))
+    events = [("greeting", start_dt)]
+    for mins in get_reminder_times(u.start_minute, u.end_minute, u.reminders):
+        if u.start_minute < mins < u.end_minute:
+            events.append(("reminder", tz.localize(datetime.combine(day, minutes_to_time(mins)))))
+    events.append(("summary", end_dt))
+    return events
+
+def load_scheduler_state(user_id):
+    state = storage.get_scheduler_state(user_id)
+    state.update(scheduler_state_buffer.get(user_id, {}))
+    return state
+
+def is_event_delivered(state, kind, fire_dt):
+    last_fire = state.get(kind, (None, None))[0]
+    if last_fire is None:
+        return False
+    if kind in ONCE_A_DAY_EVENTS:
+        return datetime.fromtimestamp(last_fire, fire_dt.tzinfo).date() == fire_dt.date()
+    return last_fire >= int(fire_dt.timestamp())
+
+def select_missed_events(missed):
+    if CATCHUP_POLICY == "all":
+        return missed
+    if CATCHUP_POLICY == "none":
+        return []
+    # latest: по одному самому свежему пропущенному событию каждого вида
+    latest = {}
+    for kind, fire_dt in missed:
+        latest[kind] = fire_dt
+    return sorted(latest.items(), key=lambda e: e[1])
+
+def remember_delivery(user_id, kind, fire_dt, events):
+    same_kind = [dt for k, dt in events if k == kind]
+    next_dt = next((dt for dt in same_kind if dt > fire_dt), same_kind[0] + timedelta(days=1))
+    scheduler_state_buffer.setdefault(user_id, {})[kind] = (int(fire_dt.timestamp()), int(next_dt.timestamp()))
+
+def flush_scheduler_state():
+    rows = [
+        (user_id, kind, last_fire, next_fire)
+        for user_id, kinds in scheduler_state_buffer.items()
+        for kind, (last_fire, next_fire) in kinds.items()
+    ]
+    storage.save_scheduler_state(rows)
+    scheduler_state_buffer.clear()
+
+async def scheduler_state_flush_job(application):
+    while True:
+        await asyncio.sleep(SCHEDULER_FLUSH_INTERVAL)
+        try:
+            flush_scheduler_state()
+        except Exception as e:
+            logger.exception(f"Failed to flush scheduler state: {e}")
+
+def fire_event(user_id, chat_id, kind, fire_dt):
+    # Событие расписания не отправляется здесь, а ставится в outbox; текст собирается при отправке
+    if not storage.get_user(user_id) or storage.get_game_over(user_id):
+        return False
+    day = day_number(fire_dt.date())
+    fire_ts = int(fire_dt.timestamp())
+    if kind == "greeting":
+        storage.enqueue_greeting(user_id, chat_id, day, fire_ts)
+    else:
+        key = f"{kind}:{user_id}:{fire_ts if kind == 'reminder' else day}"
+        storage.enqueue_messages([(key, user_id, chat_id, kind, {"day": day}, fire_ts)])
+    outbox_wakeup.set()
+    return True
+
+def render_outbox_message(u, kind, payload):
+    # -> (текст, параметры send_message) или None, если сообщение уже неактуально
+    if not u or (u.game_over and kind != "game_over"):
+        return None
+    user_name = u.username or u.name or "друг"
+    markdown = {"parse_mode": "Markdown", "reply_markup": get_main_keyboard()}
+    if kind == "fail":
+        return (
+            f"Пу-пу-пу… *{user_name}*, вчора ти не осилив(ла) сотку. Нажаль це мінус жізнь. В тебе лишилось усього: {hearts(payload['fails'])}",
+            markdown
+        )
+    if kind == "fail_missed":
+        return (
+            f"Пу-пу-пу… *{user_name}*, поки мене не було, минуло кілька днів без сотки. "
+            f"Нажаль це мінус жізні. В тебе лишилось: {hearts(payload['fails'])}",
+            markdown
+        )
+    if kind == "game_over":
+        if payload.get("missed"):
+            reason = f"Поки мене не було, минуло кілька днів без сотки, і це була третя втрачена жізнь {SKULL}"
+        else:
+            reason = f"Нажаль ти зафейлив(ла) третій раз! {SKULL}"
+        return (
+            f"{reason}\nДля тебе, *{user_name}*, Devil's 100 Challenge закінчено… цього разу!\nДля перезапуску натисни /reset",
+            {"parse_mode": "Markdown", "reply_markup": ReplyKeyboardRemove()}
+        )
+    # Приветствие, напоминание и итог дня имеют смысл только в свой день
+    if payload["day"] != local_day(u.tz):
+        return None
+    if kind == "greeting":
+        return (
+            f"Знову вітаю в Devil's 100 Challenge! {DEVIL} Сьогодні {emoji_number(get_user_current_day(u))} день змагання, а значить тобі треба зробити чергові 100 віджимань! Хай щастить і гарного дня! {CLOVER}",
+            markdown
+        )
+    pushups = u.pushups_today if u.last_day == payload["day"] else 0
+    if kind == "reminder":
+        if pushups >= 100:
+            return None
+        return "Агов! Ти не забув(ла) про челлендж? Відожмись! 💪", {"reply_markup": get_main_keyboard()}
+    if kind == "summary":
+        if pushups >= 100:
+            return f"Вітаю, *{user_name}*, ти молодець! Сьогоднішня сотка зроблена, побачимося завтра! {STRONG}", markdown
+        return (
+            f"Піднажми, *{user_name}*! Тобі залишилось зробити сьогодні {100 - pushups} віджимань, а то - мінус серденько!",
+            markdown
+        )
+    logger.warning(f"Unknown outbox message kind: {kind}")
+    return None
+
+async def send_outbox_batch(application):
+    # Пачка созревших сообщений через троттлинг. Сообщения одного чата уходят по очереди, в порядке постановки.
+    # Статус пишется после отправки: упади бот между ними, сообщение уйдёт ещё раз (доставка хотя бы один раз)
+    rows = storage.get_due_messages(int(time.time()), OUTBOX_BATCH)
+    if not rows:
+        return 0
+    sender = application.bot_data["sender"]
+    users = {u.user_id: u for u in storage.get_users([row["user_id"] for row in rows])}
+    by_chat = {}
+    for row in rows:
+        by_chat.setdefault(row["chat_id"], []).append(row)
+    results = []
+
+    async def send_chat(chat_rows):
+        for row in chat_rows:
+            message = render_outbox_message(users.get(row["user_id"]), row["kind"], row["payload"])
+            if message is None:
+                results.append((row, SKIPPED))
                 continue
-            if u["pushups_today"] < 100:
-                fail_day(user_id)
-                set_notify_fail(user_id, 1)
-            next_day(user_id)
-        logger.info("Global midnight job: days updated for all users.")
+            text, kwargs = message
+            results.append((row, await sender.send(row["chat_id"], text, **kwargs)))
+
+    await asyncio.gather(*(send_chat(chat_rows) for chat_rows in by_chat.values()))
+    now = int(time.time())
+    updates = []
+    for row, result in results:
+        if result == FAILED and row["attempts"] + 1 < OUTBOX_MAX_ATTEMPTS:
+            # Повтор с нарастающей паузой: 1, 2, 4… минуты, не больше часа
+            updates.append((PENDING, now + min(60 * 2 ** row["attempts"], 3600), row["outbox_id"]))
+        else:
+            updates.append((result, row["send_after"], row["outbox_id"]))
+    storage.save_outbox_results(updates)
+    storage.set_active_many([row["user_id"] for row, result in results if result == BLOCKED], 0)
+    return len(rows)
 
-async def send_reminders_loop(application, user_id, chat_id):
+async def outbox_job(application):
+    last_prune = time.monotonic()
     while True:
+        outbox_wakeup.clear()
         try:
-            u = get_user(user_id)
-            if not u or get_game_over(user_id):
-                return
-            start_time = u["start_time"]
-            end_time = u["end_time"]
-            reminders_count = u["reminders"]
-            now = datetime.now(KIEV_TZ)
-            today = now.date()
-            start_dt = KIEV_TZ.localize(datetime.combine(today, datetime.strptime(start_time, "%H:%M").time()))
-            end_dt = KIEV_TZ.localize(datetime.combine(today, datetime.strptime(end_time, "%H:%M").time()))
-
-            # --- Ждём до start_time пользователя ---
-            if now < start_dt:
-                await asyncio.sleep((start_dt - now).total_seconds())
-
-            # --- Проверка greeted_date и отправка приветствия ---
-            u = get_user(user_id)
-            if not u or get_game_over(user_id):
+            processed = await send_outbox_batch(application)
+        except Exception as e:
+            logger.exception(f"Outbox batch failed: {e}")
+            processed = 0
+        if time.monotonic() - last_prune >= HOUSEKEEPING_INTERVAL:
+            last_prune = time.monotonic()
+            try:
+                storage.prune_outbox(int(time.time() - OUTBOX_KEEP_HOURS * 3600))
+            except Exception as e:
+                logger.exception(f"Outbox prune failed: {e}")
+        # Полная пачка — скорее всего есть ещё, берём сразу
+        if processed >= OUTBOX_BATCH:
+            continue
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def send_reminders_loop(application, user_id, chat_id, catch_up=False):
+    # catch_up — цикл поднят на старте бота: прошедшие события, которые бот проспал, досылаются по CATCHUP_POLICY.
+    # При регистрации и смене настроек прошедшие события сегодня не считаются пропущенными
+    while True:
+        try:
+            u = storage.get_user(user_id)
+            if not u or storage.get_game_over(user_id):
                 return
-            today_str = datetime.now(KIEV_TZ).strftime("%Y-%m-%d")
-            greeted_date = u.get("greeted_date", "")
-            if greeted_date != today_str:
-                day_num = get_user_current_day(u)
-                user_name = u["username"] or u["name"] or "друг"
-                fails = u["fails"]
-                if get_notify_fail(user_id):
-                    await application.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"Пу-пу-пу… *{user_name}*, вчора ти не осилив(ла) сотку. Нажаль це мінус жізнь. В тебе лишилось усього: {hearts(fails)}",
-                        parse_mode="Markdown",
-                        reply_markup=get_main_keyboard()
-                    )
-                    set_notify_fail(user_id, 0)
-                await application.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Знову вітаю в Devil's 100 Challenge! {DEVIL} Сьогодні {emoji_number(day_num)} день змагання, а значить тобі треба зробити чергові 100 віджимань! Хай щастить і гарного дня! {CLOVER}",
-                    parse_mode="Markdown",
-                    reply_markup=get_main_keyboard()
-                )
-                set_greeted_date(user_id, today_str)
-
-            # --- Напоминания между start_time и end_time ---
-            times = get_reminder_times(start_time, end_time, reminders_count)
-            now = datetime.now(KIEV_TZ)
-            today = now.date()
-            reminder_datetimes = []
-            for t in times:
-                reminder_dt = KIEV_TZ.localize(datetime.combine(today, t))
-                if reminder_dt > now and reminder_dt < end_dt:
-                    reminder_datetimes.append(reminder_dt)
-            for reminder_dt in reminder_datetimes:
-                seconds = (reminder_dt - datetime.now(KIEV_TZ)).total_seconds()
+            tz = get_tz(u.tz)
+            now = datetime.now(tz)
+            events = build_day_events(u, now.date())
+
+            # --- Восстанавливаем, что уже было отправлено сегодня (переживает рестарты) ---
+            state = load_scheduler_state(user_id)
+            pending = [(kind, fire_dt) for kind, fire_dt in events if not is_event_delivered(state, kind, fire_dt)]
+            past = [(kind, fire_dt) for kind, fire_dt in pending if fire_dt <= now]
+            upcoming = [(kind, fire_dt) for kind, fire_dt in pending if fire_dt > now]
+            # Пропущенное за простой — только позже последней доставки этому пользователю;
+            # без истории доставок пропущенным ничего не считаем
+            last_fire = max((fire for fire, _next in state.values() if fire is not None), default=None)
+            missed = []
+            if catch_up and last_fire is not None:
+                missed = select_missed_events([(kind, fire_dt) for kind, fire_dt in past if fire_dt.timestamp() > last_fire])
+            # Приветствие дня — как и раньше, в любой момент, если сегодня его ещё не было
+            if any(kind == "greeting" for kind, _dt in past) and not any(kind == "greeting" for kind, _dt in missed):
+                missed.insert(0, next(event for event in past if event[0] == "greeting"))
+            catch_up = False
+
+            # --- Приветствие, напоминания и итог дня по расписанию ---
+            for kind, fire_dt in missed + upcoming:
+                seconds = (fire_dt - datetime.now(tz)).total_seconds()
                 if seconds > 0:
                     await asyncio.sleep(seconds)
-                pushups = get_pushups_today(user_id)
-                if pushups >= 100 or get_game_over(user_id):
-                    continue
-                await application.bot.send_message(
-                    chat_id=chat_id,
-                    text="Агов! Ти не забув(ла) про челлендж? Відожмись! 💪",
-                    reply_markup=get_main_keyboard()
-                )
-
-            # --- Ждем до конца дня пользователя ---
-            now = datetime.now(KIEV_TZ)
-            if now < end_dt:
-                await asyncio.sleep((end_dt - now).total_seconds())
-
-            # --- Итоговое сообщение в end_time ---
-            u = get_user(user_id)
-            if not u or get_game_over(user_id):
-                return
-            user_name = u["username"] or u["name"] or "друг"
-            pushups = u["pushups_today"]
-            completed_time = u.get("completed_time")
-            today_str = datetime.now(KIEV_TZ).strftime("%Y-%m-%d")
-            completed_date = completed_time[:10] if completed_time else None
-
-            if pushups >= 100 and completed_date == today_str:
-                await application.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Вітаю, *{user_name}*, ти молодець! Сьогоднішня сотка зроблена, побачимося завтра! {STRONG}",
-                    parse_mode="Markdown",
-                    reply_markup=get_main_keyboard()
-                )
-            else:
-                left = 100 - pushups
-                await application.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Піднажми, *{user_name}*! Тобі залишилось зробити сьогодні {left} віджимань, а то - мінус серденько!",
-                    parse_mode="Markdown",
-                    reply_markup=get_main_keyboard()
-                )
+                if not fire_event(user_id, chat_id, kind, fire_dt):
+                    return
+                remember_delivery(user_id, kind, fire_dt, events)
 
             # --- Ждем до следующего start_time пользователя ---
-            now = datetime.now(KIEV_TZ)
+            now = datetime.now(tz)
             tomorrow = now.date() + timedelta(days=1)
-            next_start_dt = KIEV_TZ.localize(datetime.combine(tomorrow, datetime.strptime(start_time, "%H:%M").time()))
+            next_start_dt = tz.localize(datetime.combine(tomorrow, minutes_to_time(u.start_minute)))
             seconds_to_next_start = (next_start_dt - now).total_seconds()
             if seconds_to_next_start > 0:
                 await asyncio.sleep(seconds_to_next_start)
@@ -335,20 +757,26 @@ async def send_reminders_loop(application, user_id, chat_id):
             logger.exception(f"Exception in send_reminders_loop for user {user_id}: {e}")
             await asyncio.sleep(60)  # чтобы не спамить ошибками, ждем минуту перед повтором
 
-def start_reminders(application, user_id, chat_id):
+def start_reminders(application, user_id, chat_id, catch_up=False):
     old_task = reminder_tasks.get(user_id)
     if old_task:
         old_task.cancel()
-    if get_game_over(user_id):
+    if storage.get_game_over(user_id):
         return
-    task = asyncio.create_task(send_reminders_loop(application, user_id, chat_id))
+    task = asyncio.create_task(send_reminders_loop(application, user_id, chat_id, catch_up))
     reminder_tasks[user_id] = task
+    task.add_done_callback(lambda done: forget_reminder_task(user_id, done))
+
+def forget_reminder_task(user_id, task):
+    # Цикл вернулся (game over, пользователь удалён) или отменён — задача больше не нужна
+    if reminder_tasks.get(user_id) is task:
+        del reminder_tasks[user_id]
 
 # --- Хэндлеры старта и регистрации ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    user_db = get_user(user.id)
-    if user_db and get_game_over(user.id):
+    user_db = storage.get_user(user.id)
+    if user_db and storage.get_game_over(user.id):
         await update.message.reply_text(
             "Твій попередній челлендж завершено! Напиши /reset, щоб розпочати все з нуля.",
             reply_markup=get_main_keyboard()
@@ -426,15 +854,30 @@ async def save_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return ASK_REMINDERS
     context.user_data["reminders"] = reminders
+    await update.message.reply_text(
+        f"В якому ти часовому поясі? {CLOCK} Обери зі списку або напиши назву (наприклад, Europe/Kyiv).",
+        reply_markup=get_timezone_keyboard()
+    )
+    return ASK_TIMEZONE
+
+async def save_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    tz_name = parse_timezone(update.message.text)
+    if not tz_name:
+        await update.message.reply_text(
+            "Не знаю такого часового поясу. Обери зі списку або напиши назву у форматі Europe/Kyiv.",
+            reply_markup=get_timezone_keyboard()
+        )
+        return ASK_TIMEZONE
     user = update.effective_user
     user_name = context.user_data.get("name", "друг")
 
-    add_user(
+    storage.add_user(
         user.id,
         context.user_data["name"],
-        context.user_data["start_time"],
-        context.user_data["end_time"],
-        context.user_data["reminders"]
+        time_to_minutes(context.user_data["start_time"]),
+        time_to_minutes(context.user_data["end_time"]),
+        context.user_data["reminders"],
+        tz=tz_name
     )
 
     await update.message.reply_text(
@@ -448,16 +891,41 @@ async def save_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    reset_user(user.id)
-    set_game_over(user.id, 0)
+    archived = storage.reset_user(user.id)
+    storage.set_game_over(user.id, 0)
     old_task = reminder_tasks.get(user.id)
     if old_task:
         old_task.cancel()
-        reminder_tasks.pop(user.id)
-    await update.message.reply_text(
-        "Усі дані скинуто! Можеш пройти реєстрацію наново через /start.",
-        reply_markup=ReplyKeyboardRemove()
-    )
+        reminder_tasks.pop(user.id, None)
+    scheduler_state_buffer.pop(user.id, None)
+    card_state.pop(user.id, None)
+    msg = "Усі дані скинуто! Можеш пройти реєстрацію наново через /start."
+    if archived or storage.get_archive(user.id):
+        msg += "\nПопередні челенджі збережено — подивитись можна через /history."
+    await update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+
+ARCHIVE_REASONS = {
+    "finished": f"{TROPHY} пройдено",
+    "game_over": f"{SKULL} вибув(ла)",
+    "purged": f"{SKULL} вибув(ла)",
+    "reset": "🔄 скинуто",
+}
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = storage.get_archive(update.effective_user.id)
+    if not rows:
+        await update.message.reply_text("Завершених челенджів поки немає.", reply_markup=main_keyboard_for(update))
+        return
+    msg = "📜 *Твої челенджі:*\n\n"
+    for row in rows:
+        last_day = row["game_over_day"] if row["reason"] != "finished" and row["game_over_day"] else row["archived_day"]
+        days = min(max(last_day - row["registered_day"] + (0 if row["reason"] == "finished" else 1), 1), 90)
+        msg += (
+            f"{day_from_number(row['registered_day']).strftime('%d.%m.%Y')} — "
+            f"{day_from_number(row['archived_day']).strftime('%d.%m.%Y')}: "
+            f"день {days}/90, {ARCHIVE_REASONS.get(row['reason'], row['reason'])}\n"
+        )
+    await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=main_keyboard_for(update))
 
 def parse_pushup_command(text):
     mapping = {
@@ -468,64 +936,108 @@ def parse_pushup_command(text):
     }
     return mapping.get(text.strip(), None)
 
-async def add_pushups_generic(update, context, count):
+SETS_RE = re.compile(r"\d+(?:\s*[+,\s]\s*\d+)*")
+
+def parse_sets(text):
+    # "13", "10 15 20", "10+15+20", "10, 15" -> [подходы] или None
+    text = text.strip()
+    if not SETS_RE.fullmatch(text):
+        return None
+    sets = [int(part) for part in re.findall(r"\d+", text)]
+    return sets if all(sets) else None
+
+async def add_pushups_generic(update, context, count, sets=None):
     user = update.effective_user
-    if get_game_over(user.id):
+    keyboard = main_keyboard_for(update)
+    if storage.get_game_over(user.id):
         await update.message.reply_text(
-            "Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard()
+            "Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=keyboard
         )
         return
-    user_db = get_user(user.id)
+    user_db = storage.get_user(user.id)
     if not user_db:
-        await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=get_main_keyboard())
+        await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=keyboard)
         return
 
-    user_name = user_db["username"] or user_db["name"] or "друг"
-    cur = user_db["pushups_today"]
+    if is_group_chat(update):
+        storage.join_group(update.effective_chat.id, update.effective_chat.title, user.id)
+
+    user_name = user_db.username or user_db.name or "друг"
+    cur = user_db.pushups_today
 
     if cur >= 100:
         await update.message.reply_text(
             "Не можна додавати більше 100 віджимань на день!",
-            reply_markup=get_main_keyboard()
+            reply_markup=keyboard
         )
         return
 
-    ok = add_pushups(user.id, count)
-    new_count = get_pushups_today(user.id)
+    # Несколько подходов одним сообщением — одно изменение в базе и один ответ
+    await storage.write("add_pushups", user.id, count)
+    new_count = storage.get_pushups_today(user.id)
+    if user_db.card_message_id and not is_group_chat(update):
+        await refresh_status_card(context.bot, storage.get_user(user.id))
+
+    if sets and len(sets) > 1:
+        # День ограничен сотней — показываем, сколько реально зачтено
+        added = new_count - cur
+        msg = f"Чудово! {len(sets)} {'підходи' if len(sets) % 10 in (2, 3, 4) and len(sets) % 100 not in (12, 13, 14) else 'підходів'}: {' + '.join(str(n) for n in sets)}"
+        if added < count:
+            msg += f"\nЗараховано {emoji_number(added)} з {count} віджимань — більше 100 на день не можна {UP}"
+        else:
+            msg += f" = {emoji_number(added)} віджимань {UP}"
+        msg += f"\nПоточний прогрес: {emoji_number(new_count)}"
+        if new_count >= 100 and cur < 100:
+            msg += f"\n\nЮху! *{user_name}*, сьогоднішня сотка зроблена! Вітаю! {STRONG} 💯"
+        await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=keyboard)
+        return
 
     await update.message.reply_text(
         f"Чудово! {emoji_number(count)} віджимань додано до сьогоднішнього прогресу {UP}",
         parse_mode="Markdown",
-        reply_markup=get_main_keyboard()
+        reply_markup=keyboard
     )
     await update.message.reply_text(
         f"Поточний прогрес: {emoji_number(new_count)}",
-        reply_markup=get_main_keyboard()
+        reply_markup=keyboard
     )
     if new_count >= 100 and cur < 100:
         await update.message.reply_text(
             f"Юху! *{user_name}*, сьогоднішня сотка зроблена! Вітаю! {STRONG} 💯",
             parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
+            reply_markup=keyboard
         )
 
 async def add_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if get_game_over(update.effective_user.id):
+    keyboard = main_keyboard_for(update)
+    if storage.get_game_over(update.effective_user.id):
         await update.message.reply_text(
-            "Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard()
+            "Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=keyboard
         )
         return
+    # /add 10 15 20 — сразу записываем подходы
+    sets = parse_sets(" ".join(context.args or []))
+    if sets:
+        await add_pushups_generic(update, context, sum(sets), sets)
+        return
+    # Свободный ввод числа следующим сообщением — только в личке
+    if is_group_chat(update):
+        await update.message.reply_text("Використовуй: /add <кількість>, наприклад /add 20 або /add 10 15 20")
+        return
     context.user_data["awaiting_custom"] = True
-    await update.message.reply_text("Вкажи кількість зроблених віджимань (наприклад, 13):", reply_markup=get_main_keyboard())
+    await update.message.reply_text(
+        "Вкажи кількість зроблених віджимань (наприклад, 13) або кілька підходів через пробіл чи + (10 15 20):",
+        reply_markup=keyboard
+    )
 
 async def decrease_pushups_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text(
             "Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard()
         )
         return
-    user_db = get_user(user.id)
+    user_db = storage.get_user(user.id)
     if not user_db:
         await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=get_main_keyboard())
         return
@@ -539,7 +1051,7 @@ async def decrease_pushups_handler(update: Update, context: ContextTypes.DEFAULT
 async def handle_custom_pushups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text(
             "Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard()
         )
@@ -554,8 +1066,9 @@ async def handle_custom_pushups(update: Update, context: ContextTypes.DEFAULT_TY
                 "Будь ласка, вкажи число", reply_markup=get_main_keyboard()
             )
             return
-        new_val = decrease_pushups(user.id, dec_count)
+        new_val = await storage.write("decrease_pushups", user.id, dec_count)
         context.user_data["awaiting_decrease"] = False
+        await refresh_status_card(context.bot, storage.get_user(user.id))
         await update.message.reply_text(
             f"Кількість зменшено! Новий прогрес: {emoji_number(new_val)}",
             reply_markup=get_main_keyboard()
@@ -580,65 +1093,301 @@ async def handle_custom_pushups(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     if context.user_data.get("awaiting_custom"):
-        try:
-            count = int(text)
-        except ValueError:
+        sets = parse_sets(text)
+        if sets is None:
             await update.message.reply_text(
-                "Будь ласка, вкажи число", reply_markup=get_main_keyboard()
+                "Будь ласка, вкажи число або кілька чисел, наприклад 10 15 20", reply_markup=get_main_keyboard()
             )
             return
-        await add_pushups_generic(update, context, count)
+        await add_pushups_generic(update, context, sum(sets), sets)
         context.user_data["awaiting_custom"] = False
 
+def render_status(u):
+    day = get_user_current_day(u)
+    fails = u.fails
+    pushups = u.pushups_today if u.last_day == local_day(u.tz) else 0
+
+    # Счётчики на записи учитывают дни до сегодняшнего — сегодняшнюю сотку добавляем сами
+    done_today = pushups >= 100
+    streak = (u.current_streak or 0) + (1 if done_today else 0)
+    longest = max(u.longest_streak or 0, streak)
+    best = u.best_finish_minute
+    if done_today and u.completed_at:
+        finished = datetime.fromtimestamp(u.completed_at, get_tz(u.tz))
+        best = min(best if best is not None else 24 * 60, finished.hour * 60 + finished.minute)
+
+    bar_days = days_bar(day, 90, 5, "🟪", "⬜️")
+    bar_pushups = progress_bar(pushups, 100, 5, "🟩", "⬜️")
+    return (
+        f"DAY: {emoji_number(day)} {bar_days}\n\n"
+        f"PROGRESS: {emoji_number(pushups)} {bar_pushups}\n\n"
+        f"HEALTH: {hearts(fails)}\n\n"
+        f"STREAK: 🔥 {streak} (рекорд {longest})\n"
+        f"BEST: {CLOCK} {format_minutes(best) if best is not None else '—'}\n"
+        f"TOTAL: {STRONG} {u.total_pushups or 0}"
+    )
+
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    u = get_user(user.id)
+    u = storage.get_user(user.id)
+    if not u:
+        await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=main_keyboard_for(update))
+        return
+    if storage.get_game_over(user.id):
+        await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=main_keyboard_for(update))
+        return
+    await update.message.reply_text(render_status(u), reply_markup=main_keyboard_for(update))
+
+# --- Карточка статуса: одно закреплённое сообщение, которое редактируется на месте ---
+CARD_STEPS = (10, 15, 20, 25)
+
+def get_card_keyboard(minus=False):
+    sign, prefix = ("-", "card:dec") if minus else ("+", "card:add")
+    keyboard = [
+        [InlineKeyboardButton(f"{sign}{n}", callback_data=f"{prefix}:{n}") for n in CARD_STEPS[:2]],
+        [InlineKeyboardButton(f"{sign}{n}", callback_data=f"{prefix}:{n}") for n in CARD_STEPS[2:]],
+        [InlineKeyboardButton("↩️" if minus else "➖", callback_data="card:plus" if minus else "card:minus")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+async def refresh_status_card(bot, u, minus=False):
+    if not u or not u.card_message_id:
+        return
+    message_id = u.card_message_id
+    text = render_status(u)
+    # Не дёргаем API, если карточка и так показывает то же самое
+    if card_state.get(u.user_id) == (message_id, text, minus):
+        event("cache", "card_state", hit=True)
+        return
+    event("cache", "card_state", hit=False)
+    try:
+        await bot.edit_message_text(
+            chat_id=u.user_id,
+            message_id=message_id,
+            text=text,
+            reply_markup=get_card_keyboard(minus)
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Status card for user {u.user_id} is gone: {e}")
+            storage.set_card_message_id(u.user_id, None)
+            card_state.pop(u.user_id, None)
+            return
+    card_state[u.user_id] = (message_id, text, minus)
+
+async def status_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    u = storage.get_user(user.id)
     if not u:
         await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=get_main_keyboard())
         return
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return
+    text = render_status(u)
+    message = await update.message.reply_text(text, reply_markup=get_card_keyboard())
+    try:
+        await context.bot.pin_chat_message(chat_id=update.effective_chat.id, message_id=message.message_id, disable_notification=True)
+    except TelegramError as e:
+        logger.warning(f"Failed to pin status card for user {user.id}: {e}")
+    storage.set_card_message_id(user.id, message.message_id)
+    card_state[user.id] = (message.message_id, text, False)
+
+async def status_card_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    u = storage.get_user(user_id)
+    if not u:
+        await query.answer("Спочатку зареєструйся через /start")
+        return
+    if u.game_over:
+        await query.answer("Твій челлендж завершено! Напиши /reset щоб почати знову.")
+        return
+    # callback_data приходит от клиента — принимаем только то, что рисует get_card_keyboard
+    parts = query.data.split(":")
+    action = parts[1] if len(parts) > 1 else None
+    step = None
+    if action in ("add", "dec"):
+        step = int(parts[2]) if len(parts) == 3 and parts[2].isdigit() else None
+        if step not in CARD_STEPS:
+            action = None
+    if action not in ("add", "dec", "minus", "plus"):
+        await query.answer("Невідома кнопка — відкрий картку заново через /card")
+        return
 
-    day = get_user_current_day(u)
-    fails = u["fails"]
-    pushups = u["pushups_today"]
+    if u.card_message_id != query.message.message_id:
+        # Нажатие на старую карточку — делаем актуальной её
+        storage.set_card_message_id(user_id, query.message.message_id)
+        u = storage.get_user(user_id)
+
+    minus = action in ("minus", "dec")
+    notice = None
+    if action == "add":
+        before = u.pushups_today if u.last_day == local_day(u.tz) else 0
+        if before >= 100:
+            notice = "Не можна додавати більше 100 віджимань на день!"
+        else:
+            await storage.write("add_pushups", user_id, step)
+            if storage.get_pushups_today(user_id) >= 100:
+                notice = f"Юху! Сьогоднішня сотка зроблена! {STRONG} 💯"
+    elif action == "dec":
+        await storage.write("decrease_pushups", user_id, step)
 
-    bar_days = days_bar(day, 90, 5, "🟪", "⬜️")
-    bar_pushups = progress_bar(pushups, 100, 5, "🟩", "⬜️")
-    msg = (
-        f"DAY: {emoji_number(day)} {bar_days}\n\n"
-        f"PROGRESS: {emoji_number(pushups)} {bar_pushups}\n\n"
-        f"HEALTH: {hearts(fails)}"
-    )
-    await update.message.reply_text(msg, reply_markup=get_main_keyboard())
+    await query.answer(notice)
+    await refresh_status_card(context.bot, storage.get_user(user_id), minus)
+
+def format_leaderboard_lines(rows, start=1):
+    msg = ""
+    for idx, user in enumerate(rows, start):
+        name = user.username or user.name or "Безіменний"
+        count = user.pushups_today
+        if count >= 100 and user.completed_at:
+            time_str = format_clock(user.completed_at, user.tz)
+            msg += f"{idx}. {name} — {count} віджимань (фініш о {time_str})\n"
+        else:
+            msg += f"{idx}. {name} — {count} віджимань\n"
+    return msg
+
+def render_lobby_page(user_id, page):
+    total = len(leaderboard)
+    if not total:
+        return "Поки ще ніхто не віджимався сьогодні! Будь першим! 💪", None
+    pages = (total + LOBBY_PAGE_SIZE - 1) // LOBBY_PAGE_SIZE
+    my_pos = leaderboard.position_of(user_id)
+    if page is None:
+        # По умолчанию открываем страницу, на которой находится сам пользователь
+        page = my_pos // LOBBY_PAGE_SIZE if my_pos is not None else 0
+    page = max(0, min(page, pages - 1))
+
+    msg = f"{LEADERBOARD} (сторінка {page + 1}/{pages})\n\n"
+    msg += format_leaderboard_lines(leaderboard.page(page, LOBBY_PAGE_SIZE), start=page * LOBBY_PAGE_SIZE + 1)
+    if my_pos is None:
+        msg += "\nТебе ще немає в рейтингу сьогодні — зроби перший підхід!"
+    else:
+        msg += f"\nТвоє місце: {my_pos + 1} з {total}\n"
+        first = max(0, my_pos - 1)
+        last = min(total, my_pos + 2)
+        msg += format_leaderboard_lines([leaderboard.entry_at(pos) for pos in range(first, last)], start=first + 1)
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"lobby:{page - 1}"))
+    if my_pos is not None:
+        buttons.append(InlineKeyboardButton("📍 Я", callback_data="lobby:me"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"lobby:{page + 1}"))
+    return msg, InlineKeyboardMarkup([buttons]) if buttons else None
 
 async def lobby(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if is_group_chat(update):
+        await group_lobby(update, context)
+        return
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return
-    # Показываем только тех, у кого челлендж не завершён
-    top = [u for u in get_top_pushups_today(5) if not get_game_over(u["user_id"])]
+    page = None
+    if context.args:
+        try:
+            page = int(context.args[0]) - 1
+        except ValueError:
+            pass
+    msg, markup = render_lobby_page(user.id, page)
+    await update.message.reply_text(msg, reply_markup=markup or get_main_keyboard())
+
+async def lobby_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    target = query.data.split(":", 1)[1]
+    page = None if target == "me" else int(target)
+    msg, markup = render_lobby_page(query.from_user.id, page)
+    await query.answer()
+    if msg != query.message.text:
+        await query.edit_message_text(msg, reply_markup=markup)
+
+# --- Командный челлендж в групповых чатах ---
+async def group_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group_chat(update):
+        await update.message.reply_text("Ця команда працює тільки в груповому чаті.", reply_markup=get_main_keyboard())
+        return
+    user = update.effective_user
+    if not storage.get_user(user.id):
+        await update.message.reply_text("Спочатку зареєструйся в особистих повідомленнях боту через /start")
+        return
+    if storage.join_group(update.effective_chat.id, update.effective_chat.title, user.id):
+        await update.message.reply_text(f"{user.first_name}, тепер ти в команді «{update.effective_chat.title}»! {STRONG}")
+    else:
+        await update.message.reply_text("Ти вже в цій команді!")
+
+async def group_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group_chat(update):
+        return
+    if storage.leave_group(update.effective_chat.id, update.effective_user.id):
+        await update.message.reply_text("Ти вийшов(ла) з команди.")
+    else:
+        await update.message.reply_text("Тебе і так немає в цій команді.")
+
+async def group_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    sets = parse_sets(" ".join(context.args or []))
+    if sets is None:
+        await update.message.reply_text("Використовуй: /add <кількість>, наприклад /add 20 або /add 10 15 20")
+        return
+    await add_pushups_generic(update, context, sum(sets), sets)
+
+async def group_lobby(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    top = storage.get_group_top(chat.id, 5)
     if not top:
-        await update.message.reply_text("Поки ще ніхто не віджимався сьогодні! Будь першим! 💪", reply_markup=get_main_keyboard())
+        await update.message.reply_text("У команді ще ніхто не віджимався сьогодні! Приєднуйтесь через /join 💪")
         return
-    msg = f"{LEADERBOARD}\n\n"
-    for idx, user in enumerate(top, 1):
-        name = user["username"] or user["name"] or "Безіменний"
-        count = user["pushups_today"]
-        if count >= 100 and user["completed_time"]:
-            time_str = user["completed_time"][11:16]
-            msg += f"{idx}. {name} — {count} віджимань (фініш о {time_str})\n"
-        else:
-            msg += f"{idx}. {name} — {count} віджимань\n"
-    await update.message.reply_text(msg, reply_markup=get_main_keyboard())
+    msg = f"{TROPHY} Топ команди «{chat.title}»\n\n" + format_leaderboard_lines(top)
+    await update.message.reply_text(msg)
+
+def render_group_digest(group):
+    summary = storage.get_group_summary(group["chat_id"])
+    top = storage.get_group_top(group["chat_id"], 5)
+    msg = (
+        f"{TROPHY} Підсумки дня команди «{group['title']}»\n\n"
+        f"Сотку зробили: {summary['finished']} з {summary['members']}\n"
+        f"Разом віджимань: {summary['pushups']}\n"
+    )
+    if top:
+        msg += "\n" + format_leaderboard_lines(top)
+    return msg
+
+async def group_digest_job(application):
+    digest_minute = time_to_minutes(GROUP_DIGEST_TIME)
+    while True:
+        now = datetime.now(utc)
+        # Ближайшее время дайджеста: считаем по поясам групп, а не по группам
+        tz_names = {group["tz"] for group in storage.get_groups()} or {DEFAULT_TZ}
+        next_runs = []
+        for tz_name in tz_names:
+            tz = get_tz(tz_name)
+            local_now = now.astimezone(tz)
+            run_at = tz.localize(datetime.combine(local_now.date(), minutes_to_time(digest_minute)))
+            if run_at <= local_now:
+                run_at = tz.localize(datetime.combine(local_now.date() + timedelta(days=1), minutes_to_time(digest_minute)))
+            next_runs.append(run_at)
+        seconds = (min(next_runs) - now).total_seconds()
+        await asyncio.sleep(min(max(seconds, 0), ROLLOVER_RESCHEDULE_INTERVAL))
+
+        for group in storage.get_groups():
+            tz = get_tz(group["tz"])
+            local_now = datetime.now(tz)
+            today = day_number(local_now.date())
+            if group["digest_day"] == today or local_now.hour * 60 + local_now.minute < digest_minute:
+                continue
+            try:
+                await application.bot.send_message(chat_id=group["chat_id"], text=render_group_digest(group))
+            except Exception as e:
+                logger.warning(f"Failed to send digest to group {group['chat_id']}: {e}")
+            storage.set_group_digest_day(group["chat_id"], today)
 
 async def check_end_of_day(user_id, update):
-    u = get_user(user_id)
-    user_name = u["username"] or u["name"] or "друг"
-    if u and u["pushups_today"] < 100:
-        fails = fail_day(user_id)
+    u = storage.get_user(user_id)
+    user_name = u.username or u.name or "друг"
+    if u and u.pushups_today < 100:
+        fails = storage.fail_day(user_id)
         if fails < 3:
             await update.message.reply_text(
                 f"Пу-пу-пу… *{user_name}*, вчора ти не осилив(ла) сотку. Нажаль це мінус жізнь. В тебе лишилось усього: {hearts(fails)}",
@@ -651,21 +1400,21 @@ async def check_end_of_day(user_id, update):
                 reply_markup=ReplyKeyboardRemove(),
                 parse_mode="Markdown"
             )
-            set_game_over(user_id, 1)
+            storage.set_game_over(user_id, 1)
 
 async def addday(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
     user = update.effective_user
-    u = get_user(user.id)
-    user_name = u["username"] or u["name"] or "друг"
+    u = storage.get_user(user.id)
+    user_name = u.username or u.name or "друг"
     if not u:
         await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=get_main_keyboard())
         return
-    if u["pushups_today"] < 100:
+    if u.pushups_today < 100:
         await check_end_of_day(user.id, update)
     else:
-        next_day(user.id)
+        storage.next_day(user.id)
         await update.message.reply_text(
             f"Вітаю, *{user_name}*, ти молодець! Сьогоднішня сотка зроблена, побачимося завтра! {STRONG}",
             parse_mode="Markdown",
@@ -673,13 +1422,160 @@ async def addday(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     await status(update, context)
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    median = challenge_stats.median_finish_minute()
+    fails = challenge_stats.fails
+    msg = (
+        "📊 *Статистика челленджа*\n\n"
+        f"Активных участников: *{challenge_stats.active}*\n"
+        f"Сотку сегодня сделали: *{challenge_stats.finishers}*\n"
+        f"Медиана времени финиша: *{format_minutes(median) if median is not None else '—'}*\n"
+        f"Game over сегодня: *{challenge_stats.game_overs_on(challenge_stats.today())}*\n\n"
+        "Жизни:\n"
+        + "\n".join(f"{hearts(level)} — {fails[level]}" for level in range(4))
+    )
+    if flood_guard:
+        flood = flood_guard.counters()
+        msg += (
+            "\n\nАнтифлуд (с запуска):\n"
+            f"Пропущено апдейтов: {flood['allowed']}, отброшено: {flood['dropped']}\n"
+            f"Просьб притормозить: {flood['notices']}, пользователей в лимите: {flood['buckets']}"
+        )
+    outbox = storage.count_outbox()
+    msg += (
+        f"\n\nOutbox: в очереди {outbox.get(PENDING, 0)}, доставлено {outbox.get(SENT, 0)}, "
+        f"заблокировали {outbox.get(BLOCKED, 0)}, ошибок {outbox.get(FAILED, 0)}, неактуальных {outbox.get(SKIPPED, 0)}"
+    )
+    await update.message.reply_text(msg, parse_mode="Markdown")
+
+def housekeeping(application):
+    # -> (убрано задач, убрано user_data)
+    done = [user_id for user_id, task in reminder_tasks.items() if task.done()]
+    for user_id in done:
+        del reminder_tasks[user_id]
+    if flood_guard:
+        flood_guard.prune()
+    persistence = application.persistence
+    idle = persistence.pop_idle_users(USER_DATA_IDLE_HOURS * 3600) if persistence else []
+    for user_id in idle:
+        # drop_user_data убирает и из памяти, и (при следующем сохранении) из БД
+        application.drop_user_data(user_id)
+        card_state.pop(user_id, None)
+    return len(done), len(idle)
+
+async def housekeeping_job(application):
+    while True:
+        await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+        try:
+            tasks, idle = housekeeping(application)
+            if tasks or idle:
+                logger.info(f"Housekeeping: {tasks} finished reminder tasks, {idle} idle user_data dropped.")
+        except Exception as e:
+            logger.exception(f"Housekeeping failed: {e}")
+
+def memory_structure_sizes(application):
+    sizes = [
+        ("reminder_tasks", reminder_tasks),
+        ("card_state", card_state),
+        ("scheduler_state_buffer", scheduler_state_buffer),
+        ("user_data", application.user_data),
+        ("leaderboard", leaderboard.entries),
+        ("flood buckets", flood_guard.buckets if flood_guard else {}),
+    ]
+    lines = [f"{name}: {len(value)} ({format_bytes(shallow_size(value))})" for name, value in sizes]
+    if application.persistence:
+        lines += [f"persistence {name}: {count}" for name, count in application.persistence.sizes().items()]
+    lines.append(f"get_tz cache: {get_tz.cache_info().currsize}")
+    return lines
+
+async def memreport(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    tasks_cleaned, idle_cleaned = housekeeping(context.application)
+    tasks = task_counts()
+    lines = [
+        "🧠 Память",
+        f"RSS: {format_bytes(rss_bytes())}",
+        f"Задачи asyncio: {sum(count for _name, count in tasks)}",
+        *(f"  {name}: {count}" for name, count in tasks[:8]),
+        f"Убрано сейчас: задач {tasks_cleaned}, user_data {idle_cleaned}",
+        "",
+        "Структуры:",
+        *memory_structure_sizes(context.application),
+        "",
+    ]
+    if not memory_report.tracing:
+        memory_report.start()
+        memory_report.take()
+        lines.append("tracemalloc включён — места аллокаций и прирост будут в следующем /memreport.")
+    else:
+        top, growth, traced = memory_report.take()
+        lines.append(f"tracemalloc: {format_bytes(traced)}, крупнейшие места:")
+        lines += [f"  {describe_stat(stat)} — {format_bytes(stat.size)} ({stat.count})" for stat in top]
+        if growth is not None:
+            lines.append("Прирост с прошлого отчёта:")
+            lines += [
+                f"  {describe_stat(stat)} +{format_bytes(stat.size_diff)} ({stat.count_diff:+})" for stat in growth
+            ] or ["  нет"]
+    # Без Markdown: в путях и именах полно подчёркиваний
+    await update.message.reply_text("\n".join(lines))
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    # Текст — всё после команды, с переносами строк
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("Использование: /broadcast текст сообщения")
+        return
+    total = storage.count_recipients()
+    broadcast_id = storage.create_broadcast(parts[1], update.effective_chat.id, total)
+    b = {
+        "broadcast_id": broadcast_id, "text": parts[1], "chat_id": update.effective_chat.id, "message_id": None,
+        "total": total, "cursor": 0, "sent": 0, "blocked": 0, "failed": 0,
+    }
+    start_broadcast(context.application, b)
+
+async def track_private_block(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Пользователь заблокировал или разблокировал бота — рассылки его пропускают или снова включают
+    if is_group_chat(update):
+        return
+    status = update.my_chat_member.new_chat_member.status
+    active = 0 if status in (ChatMember.BANNED, ChatMember.LEFT) else 1
+    user_id = update.effective_user.id
+    changed = storage.set_active_many([user_id], active)
+    # Разблокировал — цикл напоминаний при старте не запускался или уже закончился, поднимаем заново
+    if active and changed and storage.get_user(user_id):
+        start_reminders(context.application, user_id, user_id)
+
 async def on_startup(application: Application):
+    leaderboard.reloaded()
+    challenge_stats.reloaded()
     asyncio.create_task(global_midnight_job(application))
-    for user_id in get_all_user_ids():
-        user = get_user(user_id)
-        if user and not get_game_over(user_id):
-            chat_id = user_id
-            start_reminders(application, user_id, chat_id)
+    asyncio.create_task(scheduler_state_flush_job(application))
+    asyncio.create_task(group_digest_job(application))
+    asyncio.create_task(vacuum_job(application))
+    asyncio.create_task(housekeeping_job(application))
+    asyncio.create_task(weekly_summary_job(application))
+    asyncio.create_task(outbox_job(application))
+    catch_up_rollovers()
+    for b in storage.get_unfinished_broadcasts():
+        logger.info(f"Resuming broadcast #{b['broadcast_id']} after user {b['cursor']}")
+        start_broadcast(application, b)
+    # Одно чтение всей таблицы вместо get_user + get_game_over на каждого
+    for user in storage.get_all_users():
+        if not user.game_over and user.active:
+            start_reminders(application, user.user_id, user.user_id, catch_up=True)
+
+async def on_shutdown(application: Application):
+    flush_scheduler_state()
+    recorder = application.bot_data.get("recorder")
+    if recorder:
+        recorder.close()
+    storage.close()
+    stop_logging()
 
 async def add10(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await add_pushups_generic(update, context, 10)
@@ -703,11 +1599,11 @@ async def cancel_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ConversationHandler для настроек пользователя
 async def settings_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
-    u = get_user(user.id)
-    start_time = u["start_time"] if u else "не задано"
+    u = storage.get_user(user.id)
+    start_time = format_minutes(u.start_minute) if u else "не задано"
     await update.message.reply_text(
         f"Змінити час початку дня? (поточне значення: {start_time})",
         reply_markup=get_yes_no_back_keyboard()
@@ -717,11 +1613,11 @@ async def settings_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def settings_ask_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
-    u = get_user(user.id)
-    end_time = u["end_time"] if u else "не задано"
+    u = storage.get_user(user.id)
+    end_time = format_minutes(u.end_minute) if u else "не задано"
 
     if answer == BACK:
         return await cancel_settings(update, context)
@@ -746,7 +1642,7 @@ async def settings_ask_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def settings_input_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time_text = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
     if time_text == BACK:
@@ -757,8 +1653,8 @@ async def settings_input_start(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=get_back_keyboard()
         )
         return SETTINGS_INPUT_START
-    user_db = get_user(update.effective_user.id)
-    end_time = context.user_data.get("new_end_time") or user_db["end_time"]
+    user_db = storage.get_user(update.effective_user.id)
+    end_time = context.user_data.get("new_end_time") or format_minutes(user_db.end_minute)
     if time_to_minutes(time_text) >= time_to_minutes(end_time):
         await update.message.reply_text(
             "Час кінця дня має бути пізніше часу початку дня! Спробуй знову.\nВкажи новий час початку дня в форматі ГОДИНИ:ХВИЛИНИ (наприклад, 07:00):",
@@ -775,11 +1671,11 @@ async def settings_input_start(update: Update, context: ContextTypes.DEFAULT_TYP
 async def settings_ask_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
-    u = get_user(user.id)
-    reminders = u["reminders"] if u else "не задано"
+    u = storage.get_user(user.id)
+    reminders = u.reminders if u else "не задано"
 
     if answer == BACK:
         return await cancel_settings(update, context)
@@ -804,7 +1700,7 @@ async def settings_ask_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def settings_input_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time_text = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
     if time_text == BACK:
@@ -815,8 +1711,8 @@ async def settings_input_end(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=get_back_keyboard()
         )
         return SETTINGS_INPUT_END
-    user_db = get_user(update.effective_user.id)
-    start_time = context.user_data.get("new_start_time") or user_db["start_time"]
+    user_db = storage.get_user(update.effective_user.id)
+    start_time = context.user_data.get("new_start_time") or format_minutes(user_db.start_minute)
     if time_to_minutes(time_text) <= time_to_minutes(start_time):
         await update.message.reply_text(
             "Час кінця дня має бути пізніше часу початку дня! Спробуй знову.\nВкажи новий час кінця дня в форматі ГОДИНИ:ХВИЛИНИ (наприклад, 22:00):",
@@ -824,7 +1720,7 @@ async def settings_input_end(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return SETTINGS_INPUT_END
     context.user_data["new_end_time"] = time_text
-    reminders = user_db["reminders"] if user_db else "не задано"
+    reminders = user_db.reminders if user_db else "не задано"
     await update.message.reply_text(
         f"Змінити кількість нагадувань? (зараз їх кількість: {reminders} рвіномірно протягом робочого дня)",
         reply_markup=get_yes_no_back_keyboard()
@@ -834,7 +1730,7 @@ async def settings_input_end(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def settings_ask_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
     if answer == BACK:
@@ -846,7 +1742,7 @@ async def settings_ask_reminders(update: Update, context: ContextTypes.DEFAULT_T
         )
         return SETTINGS_INPUT_REMINDERS
     if answer == "❌ Ні":
-        return await settings_apply(update, context)
+        return await settings_prompt_timezone(update, context)
     await update.message.reply_text(
         "Будь ласка, скористайся кнопками для відповіді.",
         reply_markup=get_yes_no_back_keyboard()
@@ -856,7 +1752,7 @@ async def settings_ask_reminders(update: Update, context: ContextTypes.DEFAULT_T
 async def settings_input_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
     if text == BACK:
@@ -876,29 +1772,79 @@ async def settings_input_reminders(update: Update, context: ContextTypes.DEFAULT
         )
         return SETTINGS_INPUT_REMINDERS
     context.user_data["new_reminders"] = reminders
+    return await settings_prompt_timezone(update, context)
+
+async def settings_prompt_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = storage.get_user(update.effective_user.id)
+    tz_name = u.tz if u else DEFAULT_TZ
+    await update.message.reply_text(
+        f"Змінити часовий пояс? (поточне значення: {tz_name})",
+        reply_markup=get_yes_no_back_keyboard()
+    )
+    return SETTINGS_ASK_TIMEZONE
+
+async def settings_ask_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    answer = update.message.text.strip()
+    user = update.effective_user
+    if storage.get_game_over(user.id):
+        await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
+        return ConversationHandler.END
+    if answer == BACK:
+        return await cancel_settings(update, context)
+    if answer == "✅ Так":
+        await update.message.reply_text(
+            "Обери новий часовий пояс зі списку або напиши назву (наприклад, Europe/Kyiv):",
+            reply_markup=get_timezone_keyboard()
+        )
+        return SETTINGS_INPUT_TIMEZONE
+    if answer == "❌ Ні":
+        return await settings_apply(update, context)
+    await update.message.reply_text(
+        "Будь ласка, скористайся кнопками для відповіді.",
+        reply_markup=get_yes_no_back_keyboard()
+    )
+    return SETTINGS_ASK_TIMEZONE
+
+async def settings_input_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    user = update.effective_user
+    if storage.get_game_over(user.id):
+        await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
+        return ConversationHandler.END
+    if text == BACK:
+        return await cancel_settings(update, context)
+    tz_name = parse_timezone(text)
+    if not tz_name:
+        await update.message.reply_text(
+            "Не знаю такого часового поясу. Обери зі списку або напиши назву у форматі Europe/Kyiv:",
+            reply_markup=get_timezone_keyboard()
+        )
+        return SETTINGS_INPUT_TIMEZONE
+    context.user_data["new_timezone"] = tz_name
     return await settings_apply(update, context)
 
 async def settings_apply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if get_game_over(user.id):
+    if storage.get_game_over(user.id):
         await update.message.reply_text("Твій челлендж завершено! Напиши /reset щоб почати знову.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
-    user_db = get_user(user.id)
+    user_db = storage.get_user(user.id)
     if not user_db:
         await update.message.reply_text("Спочатку зареєструйся через /start", reply_markup=get_main_keyboard())
         return ConversationHandler.END
 
     keys = context.user_data.keys()
-    if not any(k in keys for k in ["new_start_time", "new_end_time", "new_reminders"]):
+    if not any(k in keys for k in ["new_start_time", "new_end_time", "new_reminders", "new_timezone"]):
         await update.message.reply_text(
             "Зміни не внесено!",
             reply_markup=get_main_keyboard()
         )
         return ConversationHandler.END
 
-    start_time = context.user_data["new_start_time"] if "new_start_time" in context.user_data else user_db["start_time"]
-    end_time = context.user_data["new_end_time"] if "new_end_time" in context.user_data else user_db["end_time"]
-    reminders = context.user_data["new_reminders"] if "new_reminders" in context.user_data else user_db["reminders"]
+    start_time = context.user_data["new_start_time"] if "new_start_time" in context.user_data else format_minutes(user_db.start_minute)
+    end_time = context.user_data["new_end_time"] if "new_end_time" in context.user_data else format_minutes(user_db.end_minute)
+    reminders = context.user_data["new_reminders"] if "new_reminders" in context.user_data else user_db.reminders
+    tz_name = context.user_data["new_timezone"] if "new_timezone" in context.user_data else user_db.tz
 
     if time_to_minutes(end_time) <= time_to_minutes(start_time):
         await update.message.reply_text(
@@ -907,14 +1853,15 @@ async def settings_apply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
-    update_user_settings(user.id, start_time, end_time, reminders)
+    storage.update_user_settings(user.id, time_to_minutes(start_time), time_to_minutes(end_time), reminders, tz_name)
     start_reminders(context.application, user.id, update.effective_chat.id)
 
     await update.message.reply_text(
         "Налаштування оновлено! Новий розклад:\n"
         f"Початок дня: {start_time}\n"
         f"Кінець дня: {end_time}\n"
-        f"кількість нагадувань: {reminders}",
+        f"кількість нагадувань: {reminders}\n"
+        f"Часовий пояс: {tz_name}",
         reply_markup=get_main_keyboard()
     )
     return ConversationHandler.END
@@ -939,7 +1886,7 @@ async def settestreminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if count < 1 or count > 10:
         await update.message.reply_text("Количество напоминаний — от 1 до 10")
         return
-    update_user_settings(user.id, start_time, end_time, count)
+    storage.update_user_settings(user.id, time_to_minutes(start_time), time_to_minutes(end_time), count)
     start_reminders(context.application, user.id, update.effective_chat.id)
     await update.message.reply_text(
         f"Тестовые напоминания установлены:\nНачало: {start_time}\nКонец: {end_time}\nКол-во: {count}",
@@ -950,25 +1897,22 @@ async def dump_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Тільки для адміністратора.")
         return
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users")
-    rows = cur.fetchall()
+    rows = storage.get_all_users()
     if not rows:
         await update.message.reply_text("Таблиця пуста.")
         return
     msg = ""
     for row in rows:
-        day = get_user_current_day(dict(row))
-        # Добавляем greeted_date в вывод
-        greeted_date = row["greeted_date"] if "greeted_date" in row.keys() else "N/A"
+        day = get_user_current_day(row)
+        completed = format_clock(row.completed_at, row.tz) if row.completed_at else None
+        greeted_date = day_from_number(row.greeted_day) if row.greeted_day is not None else "N/A"
         msg += (
-            f"ID: {row['user_id']}, Name: {row['name']}, Username: {row['username']}, "
-            f"Pushups: {row['pushups_today']}, Day: {day}, "
-            f"Fails: {row['fails']}, Completed: {row['completed_time']}, "
-            f"LastDate: {row['last_date']}, Registered: {row['registered_date']}, "
-            f"GameOver: {row['game_over'] if 'game_over' in row.keys() else 'N/A'}, "
-            f"GreetedDate: {greeted_date}\n"
+            f"ID: {row.user_id}, Name: {row.name}, Username: {row.username}, "
+            f"Pushups: {row.pushups_today}, Day: {day}, "
+            f"Fails: {row.fails}, Completed: {completed}, "
+            f"LastDate: {day_from_number(row.last_day)}, Registered: {day_from_number(row.registered_day)}, "
+            f"GameOver: {row.game_over}, "
+            f"GreetedDate: {greeted_date}, TZ: {row.tz}\n"
         )
     for i in range(0, len(msg), 4000):
         await update.message.reply_text(msg[i:i+4000])
@@ -977,41 +1921,76 @@ async def show_table_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Тільки для адміністратора.")
         return
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(users);")
-    rows = cur.fetchall()
     msg = ""
-    for row in rows:
-        msg += f"{row[1]} ({row[2]}), NOT NULL: {row[3]}, DEFAULT: {row[4]}\n"
+    for name, column_type, not_null, default in storage.describe_users():
+        msg += f"{name} ({column_type}), NOT NULL: {not_null}, DEFAULT: {default}\n"
     await update.message.reply_text(msg or "Нет информации о структуре.")
 
 async def purge_failed_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Тільки для адміністратора.")
         return
-    from db import delete_users_with_3_fails
-    delete_users_with_3_fails()
-    await update.message.reply_text("Всі гравці з 3 фейлами видалені з бази.")
+    archived = storage.archive_users_with_3_fails()
+    await update.message.reply_text(f"Гравців з 3 фейлами перенесено в архів: {archived}.")
      
-def main():
-    application = Application.builder().token(TOKEN).build()
+def recorder_safe_texts():
+    # Тексты кнопок не личные — их recorder оставляет как есть
+    keyboards = [get_main_keyboard(), get_yes_no_back_keyboard(), get_back_keyboard(), get_settings_only_keyboard(), get_timezone_keyboard()]
+    return [button.text for keyboard in keyboards for row in keyboard.keyboard for button in row]
+
+def build_bot_api_request(pool_size):
+    return build_request(
+        pool_size,
+        BOT_API_CONNECT_TIMEOUT,
+        BOT_API_READ_TIMEOUT,
+        BOT_API_WRITE_TIMEOUT,
+        BOT_API_POOL_TIMEOUT,
+        http2=BOT_API_HTTP2,
+        keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY,
+    )
+
+def build_application(token=None, request=None, get_updates_request=None):
+    # getUpdates держит своё соединение на время long polling — у него отдельный пул,
+    # чтобы отправки во время всплесков не ждали его освобождения.
+    # Подменяя транспорт, передавайте два разных объекта — один и тот же снова даст общий пул
+    builder = (
+        Application.builder()
+        .token(token or TOKEN)
+        .request(request or build_bot_api_request(BOT_API_POOL_SIZE))
+        .get_updates_request(get_updates_request or build_bot_api_request(BOT_API_UPDATES_POOL_SIZE))
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, flood_guard))
+        .persistence(StoragePersistence(storage, update_interval=PERSISTENCE_INTERVAL))
+    )
+    application = builder.build()
+    application.bot_data["sender"] = ThrottledSender(application.bot, FANOUT_RATE, FANOUT_CONCURRENCY)
+
+    if RECORD_UPDATES_PATH:
+        recorder = UpdateRecorder(RECORD_UPDATES_PATH, recorder_safe_texts())
+        # Группа -1 — раньше всех хэндлеров, дальнейшую обработку не останавливает
+        application.add_handler(TypeHandler(Update, recorder.record), group=-1)
+        application.bot_data["recorder"] = recorder
+
+    private = filters.ChatType.PRIVATE
+    groups = filters.ChatType.GROUPS
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start, filters=private)],
         states={
             ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_start_time)],
             ASK_START_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_end_time)],
             ASK_END_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_reminders)],
             ASK_REMINDERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_reminders)],
+            ASK_TIMEZONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_timezone)],
         },
         fallbacks=[CommandHandler("start", start), CommandHandler("reset", reset)],
+        name="registration",
+        persistent=True,
     )
 
     settings_conv = ConversationHandler(
         entry_points=[
-            CommandHandler("settings", settings_entry),
-            MessageHandler(filters.Regex(f"^{SETTINGS} Налаштування$"), settings_entry)
+            CommandHandler("settings", settings_entry, filters=private),
+            MessageHandler(private & filters.Regex(f"^{SETTINGS} Налаштування$"), settings_entry)
         ],
         states={
             SETTINGS_ASK_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_ask_start)],
@@ -1020,8 +1999,12 @@ def main():
             SETTINGS_INPUT_END: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_input_end)],
             SETTINGS_ASK_REMINDERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_ask_reminders)],
             SETTINGS_INPUT_REMINDERS: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_input_reminders)],
+            SETTINGS_ASK_TIMEZONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_ask_timezone)],
+            SETTINGS_INPUT_TIMEZONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_input_timezone)],
         },
         fallbacks=[],
+        name="settings",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
@@ -1030,21 +2013,37 @@ def main():
     application.add_handler(CommandHandler("settestreminders", settestreminders))
     application.add_handler(CommandHandler("reset", reset))
     application.add_handler(CommandHandler("status", status))
+    application.add_handler(CommandHandler("card", status_card, filters=private))
+    application.add_handler(CallbackQueryHandler(status_card_callback, pattern="^card:"))
     application.add_handler(CommandHandler("add10", add10))
     application.add_handler(CommandHandler("add15", add15))
     application.add_handler(CommandHandler("add20", add20))
     application.add_handler(CommandHandler("add25", add25))
+    application.add_handler(CommandHandler("add", group_add, filters=groups))
     application.add_handler(CommandHandler("add", add_custom))
+    application.add_handler(CommandHandler("join", group_join))
+    application.add_handler(CommandHandler("leave", group_leave))
     application.add_handler(CommandHandler("lobby", lobby))
     application.add_handler(MessageHandler(filters.Regex(f"^{LEADERBOARD}$"), lobby))
+    application.add_handler(CallbackQueryHandler(lobby_page_callback, pattern="^lobby:"))
     application.add_handler(CommandHandler("dumpusers", dump_users))
     application.add_handler(CommandHandler("showtable", show_table_info))
     application.add_handler(CommandHandler("purgefailed", purge_failed_users))
-    application.add_handler(MessageHandler(filters.Regex("^➖ Зменшити кількість$"), decrease_pushups_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_custom_pushups))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("memreport", memreport))
+    application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(ChatMemberHandler(track_private_block, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(MessageHandler(private & filters.Regex("^➖ Зменшити кількість$"), decrease_pushups_handler))
+    application.add_handler(MessageHandler(private & filters.TEXT & ~filters.COMMAND, handle_custom_pushups))
 
-    logger.info("Bot started!")
     application.post_init = on_startup
+    application.post_shutdown = on_shutdown
+    return application
+
+def main():
+    application = build_application()
+    logger.info("Bot started!")
     application.run_polling()
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+import asyncio
+import linecache
+import os
+import resource
+import sys
+import tracemalloc
+from collections.abc import Mapping
+
+# Свои аллокации tracemalloc и импорт модулей в отчёте не нужны
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, linecache.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def rss_bytes():
+    # Текущий RSS из /proc (Linux), иначе — пиковый из getrusage
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def shallow_size(container):
+    # Сам контейнер плюс ключи и значения первого уровня — для сравнения между отчётами этого хватает
+    size = sys.getsizeof(container)
+    if isinstance(container, Mapping):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in container.items())
+    elif isinstance(container, (list, set, tuple)):
+        size += sum(sys.getsizeof(item) for item in container)
+    return size
+
+
+def task_counts():
+    # Живые задачи event loop'а по имени корутины
+    counts = {}
+    for task in asyncio.all_tasks():
+        name = getattr(task.get_coro(), "__qualname__", "?")
+        counts[name] = counts.get(name, 0) + 1
+    return sorted(counts.items(), key=lambda item: -item[1])
+
+
+class MemoryReport:
+    # Снимки tracemalloc для /memreport: крупнейшие места аллокаций и прирост с прошлого отчёта.
+    # tracemalloc замедляет аллокации, поэтому включается либо TRACEMALLOC_FRAMES при старте,
+    # либо первым /memreport — тогда прирост виден со второго отчёта.
+    def __init__(self, frames=0):
+        self.frames = frames
+        self.previous = None
+        if frames:
+            self.start()
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames or 1)
+        self.previous = None
+
+    def take(self, limit=10):
+        # -> (топ мест, прирост с прошлого снимка или None, трассируемый объём)
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        top = snapshot.statistics("lineno")[:limit]
+        growth = None
+        if self.previous is not None:
+            diff = snapshot.compare_to(self.previous, "lineno")
+            growth = [stat for stat in diff if stat.size_diff > 0][:limit]
+        self.previous = snapshot
+        traced, _peak = tracemalloc.get_traced_memory()
+        return top, growth, traced
+
+
+def describe_stat(stat):
+    frame = stat.traceback[0]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno}"
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from tracing import event
+
+logger = logging.getLogger(__name__)
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class StoragePersistence(BasePersistence):
+    # Состояния диалогов и user_data в хранилище бота (см. storage.py).
+    # Пишем только изменившиеся записи, пачкой в одной транзакции; user_data грузим лениво,
+    # при первом апдейте пользователя после старта.
+    def __init__(self, storage, update_interval=30):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.storage = storage
+        self._conversations = {}  # {name: {key: state}} — то, что уже лежит в БД
+        self._user_data = {}  # {user_id: json} — то, что уже лежит в БД
+        self._loaded_users = set()
+        self._dirty_conversations = {}  # {(name, key): state или None}
+        self._dirty_user_data = {}  # {user_id: json или None}
+        self._flush_task = None
+        self.last_seen = {}  # {user_id: time.monotonic()} — для выгрузки user_data неактивных
+
+    # --- Загрузка ---
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self.last_seen[user_id] = time.monotonic()
+        if user_id in self._loaded_users:
+            event("cache", "user_data", hit=True)
+            return
+        event("cache", "user_data", hit=False)
+        self._loaded_users.add(user_id)
+        stored = self.storage.load_user_data(user_id)
+        if stored is None:
+            return
+        self._user_data[user_id] = stored
+        for key, value in json.loads(stored).items():
+            user_data.setdefault(key, value)
+
+    async def get_conversations(self, name):
+        conversations = {}
+        for conv_key, state in self.storage.load_conversations(name):
+            conversations[tuple(json.loads(conv_key))] = json.loads(state)
+        self._conversations[name] = dict(conversations)
+        return conversations
+
+    # --- Изменения: только помечаем, пишем пачкой ---
+    async def update_conversation(self, name, key, new_state):
+        if self._conversations.setdefault(name, {}).get(key) == new_state:
+            return
+        self._conversations[name][key] = new_state
+        self._dirty_conversations[(name, key)] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id, data):
+        dumped = _dumps(data) if data else None
+        if self._user_data.get(user_id) == dumped:
+            return
+        self._user_data[user_id] = dumped
+        self._dirty_user_data[user_id] = dumped
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        self.last_seen.pop(user_id, None)
+        if self._user_data.pop(user_id, None) is not None:
+            self._dirty_user_data[user_id] = None
+            self._schedule_flush()
+
+    # --- Уборка ---
+    def pop_idle_users(self, max_idle):
+        # Кто не писал дольше max_idle секунд и не находится посреди диалога (регистрация, настройки).
+        # Из last_seen убираем сразу: сам drop_user_data придёт только со следующим сохранением
+        in_conversation = {
+            key[-1] for states in self._conversations.values() for key, state in states.items() if state is not None
+        }
+        deadline = time.monotonic() - max_idle
+        idle = [
+            user_id for user_id, seen in self.last_seen.items()
+            if seen < deadline and user_id not in in_conversation
+        ]
+        for user_id in idle:
+            del self.last_seen[user_id]
+        return idle
+
+    def sizes(self):
+        return {
+            "conversations": sum(len(states) for states in self._conversations.values()),
+            "user_data (json)": len(self._user_data),
+            "loaded users": len(self._loaded_users),
+            "last seen": len(self.last_seen),
+            "dirty": len(self._dirty_conversations) + len(self._dirty_user_data),
+        }
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Application.update_persistence вызывает update_* пачкой — даём им всем отработать
+        await asyncio.sleep(0)
+        self._write_dirty()
+
+    def _write_dirty(self):
+        if not self._dirty_conversations and not self._dirty_user_data:
+            return
+        conversations, dropped_conversations = [], []
+        for (name, key), state in self._dirty_conversations.items():
+            conv_key = _dumps(list(key))
+            if state is None:
+                dropped_conversations.append((name, conv_key))
+            else:
+                conversations.append((name, conv_key, _dumps(state)))
+        user_data = [(user_id, data) for user_id, data in self._dirty_user_data.items() if data is not None]
+        dropped_user_data = [user_id for user_id, data in self._dirty_user_data.items() if data is None]
+        try:
+            self.storage.save_persistence(conversations, dropped_conversations, user_data, dropped_user_data)
+        except Exception as e:
+            # Грязные записи остаются — попробуем снова в следующий раз
+            logger.exception(f"Failed to save persistence: {e}")
+            return
+        self._dirty_conversations.clear()
+        self._dirty_user_data.clear()
+
+    async def flush(self):
+        self._write_dirty()
+
+    # --- Остальное не храним ---
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,122 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+RECORD_FORMAT_VERSION = 1
+# Поля с персональными данными заменяем на заглушки
+PERSONAL_FIELDS = {"first_name", "last_name", "username", "title", "language_code"}
+ID_HOLDERS = {"from", "chat", "user", "sender_chat"}
+KEPT_UPDATE_FIELDS = {"update_id", "message", "edited_message", "callback_query", "my_chat_member"}
+# У сообщений и нажатий кнопок пишем только то, что нужно хэндлерам: фото, документы, контакты,
+# геопозиция, подписи, пересылки, reply_to_message и ссылки-приглашения в запись не попадают
+MESSAGE_FIELDS = {"message_id", "date", "chat", "from", "text", "entities"}
+KEPT_FIELDS = {
+    "message": MESSAGE_FIELDS,
+    "edited_message": MESSAGE_FIELDS,
+    # chat_instance обязателен для CallbackQuery.de_json при воспроизведении — пишем заглушкой
+    "callback_query": {"id", "from", "message", "data", "chat_instance"},
+    "my_chat_member": {"chat", "from", "date", "old_chat_member", "new_chat_member"},
+    "entities": {"type", "offset", "length"},
+}
+# Текст сообщения сохраняем только если это кнопка или "данные" (числа, время, пояс);
+# у команды — имя и аргументы-данные. Остальное (имя на регистрации, текст /broadcast)
+# заменяется заглушкой той же длины, чтобы не сдвигать entities
+COMMAND = re.compile(r"/[A-Za-z0-9_]+(@[A-Za-z0-9_]+)?", re.ASCII)
+# Только то, что бот разбирает: подходы (10 15 20, 10+15), время ЧЧ:ММ и имя пояса.
+# Длинные числа (телефоны, номера карт) под это не подходят и маскируются
+SAFE_TEXT = re.compile(r"\d{1,3}([ +,]+\d{1,3})*|\d{1,2}:\d{2}|[A-Za-z_]+(/[A-Za-z0-9_+\-]+)+", re.ASCII)
+SAFE_ARG = re.compile(r"\d{1,3}([+,]\d{1,3})*|\d{1,2}:\d{2}|[A-Za-z_]+(/[A-Za-z0-9_+\-]+)+", re.ASCII)
+
+
+class UpdateRecorder:
+    # Пишет входящие апдейты в компактный JSONL только для дозаписи: первая строка — заголовок,
+    # дальше {"t": секунды от старта записи, "u": обезличенный апдейт}.
+    # id пользователей и чатов заменяются HMAC-псевдонимами со случайной солью на запуск:
+    # внутри файла один человек — один id, но связать его с настоящим нельзя.
+    def __init__(self, path, safe_texts=()):
+        self.path = path
+        self.safe_texts = set(safe_texts)
+        self._salt = os.urandom(16)
+        self._pseudonyms = {}
+        self._started = time.time()
+        # Построчная буферизация: каждая запись сразу уходит в файл и не теряется при падении бота
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+        self._write({"v": RECORD_FORMAT_VERSION, "started": int(self._started)})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def pseudonym(self, real_id):
+        if real_id not in self._pseudonyms:
+            digest = hmac.new(self._salt, str(real_id).encode(), hashlib.sha256).digest()
+            value = int.from_bytes(digest[:6], "big") or 1
+            # Знак сохраняем: отрицательные id — группы
+            self._pseudonyms[real_id] = -value if real_id < 0 else value
+        return self._pseudonyms[real_id]
+
+    def _anonymize(self, value, key=None):
+        if isinstance(value, dict):
+            result = {}
+            kept = KEPT_FIELDS.get(key)
+            for field, item in value.items():
+                if kept is not None and field not in kept:
+                    continue
+                if field in PERSONAL_FIELDS:
+                    result[field] = field[0].upper()
+                elif field == "id" and key in ID_HOLDERS and isinstance(item, int):
+                    result[field] = self.pseudonym(item)
+                elif field == "chat_instance" and isinstance(item, str):
+                    result[field] = "x" * len(item)
+                elif field == "text" and isinstance(item, str):
+                    result[field] = self._anonymize_text(item)
+                else:
+                    result[field] = self._anonymize(item, field)
+            return result
+        if isinstance(value, list):
+            return [self._anonymize(item, key) for item in value]
+        return value
+
+    def _anonymize_text(self, text):
+        if text in self.safe_texts or SAFE_TEXT.fullmatch(text):
+            return text
+        command = COMMAND.match(text)
+        if not command:
+            return "x" * len(text)
+        args = re.sub(r"\S+", lambda arg: arg[0] if SAFE_ARG.fullmatch(arg[0]) else "x" * len(arg[0]), text[command.end():])
+        return command[0] + args
+
+    async def record(self, update, context):
+        try:
+            data = {k: v for k, v in update.to_dict().items() if k in KEPT_UPDATE_FIELDS}
+            self._write({"t": round(time.time() - self._started, 3), "u": self._anonymize(data)})
+        except Exception as e:
+            logger.warning(f"Failed to record update: {e}")
+
+    def close(self):
+        self._file.close()
+
+
+def read_recording(path):
+    # -> [(секунды от начала файла, update_dict), ...]; файл может содержать несколько сессий записи
+    updates = []
+    first_started = session_started = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "v" in record:
+                if record["v"] != RECORD_FORMAT_VERSION:
+                    raise ValueError(f"Unsupported recording version: {record['v']}")
+                session_started = record["started"]
+                if first_started is None:
+                    first_started = session_started
+                continue
+            updates.append((session_started - first_started + record["t"], record["u"]))
+    return updates
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import inspect
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+# Настройки окружения — до импорта main: данные только в памяти, запись апдейтов и медленный лог выключены
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["RECORD_UPDATES_PATH"] = ""
+os.environ["TRACE_SLOW_MS"] = "inf"
+os.environ["TRACE_LOG_PATH"] = os.path.join(tempfile.gettempdir(), "replay_slow_updates.jsonl")
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from recorder import read_recording
+
+REPLAY_TOKEN = "123456:REPLAY"
+
+
+class FakeBotAPI(BaseRequest):
+    # Bot API без сети: отвечает правдоподобными объектами с заданной задержкой и считает вызовы
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._result(name, params)}).encode()
+
+    def _result(self, name, params):
+        if name == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        if name in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = params.get("chat_id", 0)
+            return {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+async def replay(updates, speed, api_latency):
+    import main
+
+    api = FakeBotAPI(api_latency)
+    application = main.build_application(token=REPLAY_TOKEN, request=api, get_updates_request=FakeBotAPI(api_latency))
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(on_error)
+    await application.initialize()
+
+    latencies = []
+
+    async def timed(coroutine, fed_at):
+        try:
+            await coroutine
+        finally:
+            latencies.append(time.perf_counter() - fed_at)
+
+    tasks = []
+    processing = []
+    first_t = updates[0][0] if updates else 0
+    started = time.perf_counter()
+    for t, data in updates:
+        if speed:
+            delay = (t - first_t) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(data, application.bot)
+        fed_at = time.perf_counter()
+        # Тот же путь, что у Application: процессор апдейтов, затем диспетчеризация по хэндлерам
+        processing.append(application.process_update(update))
+        tasks.append(asyncio.create_task(
+            application.update_processor.process_update(update, timed(processing[-1], fed_at))
+        ))
+    await asyncio.gather(*tasks)
+    # Отброшенные антифлудом апдейты так и не запускались
+    for coroutine in processing:
+        if inspect.getcoroutinestate(coroutine) == inspect.CORO_CREATED:
+            coroutine.close()
+    elapsed = time.perf_counter() - started
+
+    # Хэндлеры запускают фоновые задачи (напоминания) — после прогона они не нужны
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    await application.shutdown()
+    return elapsed, latencies, api.calls, errors
+
+
+def parse_speed(value):
+    # 1, 10, ... — во сколько раз быстрее записи; max — без пауз
+    return 0.0 if value == "max" else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a fake Bot API")
+    parser.add_argument("recording", help="file written with RECORD_UPDATES_PATH")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1, 10, ... or max")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="fake Bot API response time, seconds")
+    parser.add_argument("--concurrency", type=int, help="overrides CONCURRENT_UPDATES")
+    args = parser.parse_args()
+
+    if args.concurrency:
+        os.environ["CONCURRENT_UPDATES"] = str(args.concurrency)
+    updates = read_recording(args.recording)
+    if not updates:
+        print("Recording is empty")
+        sys.exit(1)
+
+    elapsed, latencies, calls, errors = asyncio.run(replay(updates, args.speed, args.api_latency))
+    ms = [latency * 1000 for latency in latencies]
+    span = updates[-1][0] - updates[0][0]
+    print(f"updates: {len(updates)} (recorded over {span:.1f}s), replayed in {elapsed:.2f}s")
+    print(f"throughput: {len(updates) / elapsed:.1f} updates/s")
+    print(
+        f"latency ms: p50 {percentile(ms, 50):.1f}  p90 {percentile(ms, 90):.1f}  "
+        f"p99 {percentile(ms, 99):.1f}  max {max(ms, default=0.0):.1f}"
+    )
+    print("bot api calls: " + ", ".join(f"{name} {count}" for name, count in calls.most_common()))
+    import main as bot
+    if bot.flood_guard:
+        flood = bot.flood_guard.counters()
+        print(f"flood guard: allowed {flood['allowed']}, dropped {flood['dropped']}, notices {flood['notices']}")
+    if errors:
+        print(f"handler errors: {len(errors)}")
+        for error, count in Counter(errors).most_common(5):
+            print(f"  {count} x {error}")
+
+
+if __name__ == "__main__":
+    main()
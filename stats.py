@@ -0,0 +1,112 @@
+import time
+from datetime import datetime
+
+from db import get_tz, local_day, DEFAULT_TZ
+
+MINUTES_PER_DAY = 24 * 60
+
+
+class ChallengeStats:
+    # Счётчики челленджа, которые обновляются на каждой записи в хранилище (через subscribe),
+    # так что /stats отвечает без прохода по таблице users.
+    def __init__(self, storage):
+        self.storage = storage
+        self.clear()
+
+    def clear(self):
+        self.active = 0
+        self.finishers = 0
+        # Гистограмма времени финиша по минутам локального дня — из неё берём медиану
+        self.finish_histogram = [0] * MINUTES_PER_DAY
+        self.fails = [0, 0, 0, 0]
+        self.game_overs = {}  # {день: сколько вылетело}
+
+    # --- Подписка на изменения в db ---
+    def user_changed(self, before, after):
+        self._apply(before, -1)
+        self._apply(after, 1)
+        if after and after.game_over and not (before and before.game_over):
+            day = after.game_over_day or local_day(after.tz)
+            self.game_overs[day] = self.game_overs.get(day, 0) + 1
+
+    def reloaded(self):
+        self.rebuild(self.storage.get_all_users())
+
+    def rebuild(self, rows):
+        game_overs = self.game_overs
+        self.clear()
+        for row in rows:
+            self._apply(row, 1)
+            if row.game_over and row.game_over_day is not None:
+                day = row.game_over_day
+                self.game_overs[day] = self.game_overs.get(day, 0) + 1
+        # Вылетевших на смене дня переносят в архив — их счёт за день не теряем
+        for day, count in game_overs.items():
+            self.game_overs[day] = max(self.game_overs.get(day, 0), count)
+
+    def _apply(self, u, sign):
+        if u is None or u.game_over:
+            return
+        self.active += sign
+        self.fails[min(u.fails or 0, 3)] += sign
+        minute = self._finish_minute(u)
+        if minute is not None:
+            self.finishers += sign
+            self.finish_histogram[minute] += sign
+
+    @staticmethod
+    def _finish_minute(u):
+        if u.pushups_today < 100 or not u.completed_at or u.last_day != local_day(u.tz):
+            return None
+        finished = datetime.fromtimestamp(u.completed_at, get_tz(u.tz))
+        return finished.hour * 60 + finished.minute
+
+    # --- Запросы ---
+    def median_finish_minute(self):
+        if not self.finishers:
+            return None
+        half = (self.finishers + 1) // 2
+        seen = 0
+        for minute, count in enumerate(self.finish_histogram):
+            seen += count
+            if seen >= half:
+                return minute
+        return None
+
+    def game_overs_on(self, day):
+        return self.game_overs.get(day, 0)
+
+    def snapshot(self, day, utc_offset, tz_names):
+        # Снимок закончившегося дня в поясах tz_names (одна смена дня, смещение utc_offset в минутах) —
+        # до того, как переход дня обнулит отжимания. Общие счётчики смешивают пояса, где день ещё идёт,
+        # поэтому считаем по строкам пользователей только этих поясов
+        active = 0
+        fails = [0, 0, 0, 0]
+        finish_minutes = []
+        game_overs = 0
+        for u in self.storage.get_users_in_timezones(tz_names):
+            if u.game_over:
+                game_overs += u.game_over_day == day
+                continue
+            active += 1
+            fails[min(u.fails or 0, 3)] += 1
+            if u.last_day == day and u.pushups_today >= 100 and u.completed_at:
+                finished = datetime.fromtimestamp(u.completed_at, get_tz(u.tz))
+                finish_minutes.append(finished.hour * 60 + finished.minute)
+        finish_minutes.sort()
+        self.storage.save_daily_stats((
+            day,
+            utc_offset,
+            active,
+            len(finish_minutes),
+            finish_minutes[(len(finish_minutes) + 1) // 2 - 1] if finish_minutes else None,
+            *fails,
+            game_overs,
+            int(time.time()),
+        ))
+        # Старые дни для /stats больше не нужны
+        for old in [d for d in self.game_overs if d < day - 1]:
+            del self.game_overs[old]
+
+    def today(self):
+        return local_day(DEFAULT_TZ)
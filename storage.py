@@ -0,0 +1,1270 @@
+import asyncio
+import functools
+import heapq
+import inspect
+import os
+import sys
+import time
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import db
+from db import CHALLENGE_DAYS, DEFAULT_TZ, UserRecord, local_day, utc_offset_seconds
+
+
+def _top_key(u):
+    # Порядок get_top_pushups_today в SQL: финишёры по времени финиша, потом по убыванию отжиманий
+    if u.pushups_today >= 100:
+        return (0, u.completed_at or 0, 0)
+    return (1, 0, -u.pushups_today)
+
+
+def _call_in(path, func, *args, **kwargs):
+    # Функции db.py работают с файлом из db.db_path (None — db.DB_PATH)
+    token = db.db_path.set(path)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        db.db_path.reset(token)
+
+
+def _iterate_in(path, items):
+    # Генератор db.py выполняет запрос при итерации — файл выставляем на каждый шаг, а не на время паузы
+    try:
+        while True:
+            try:
+                item = _call_in(path, next, items)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        _call_in(path, items.close)
+
+
+def _in_file(func):
+    # Функция db.py на файле экземпляра (self.path)
+    if inspect.isgeneratorfunction(func):
+        def call(self, *args, **kwargs):
+            return _iterate_in(self.path, func(*args, **kwargs))
+    else:
+        def call(self, *args, **kwargs):
+            return _call_in(self.path, func, *args, **kwargs)
+    return call
+
+
+class Storage(ABC):
+    # Все операции с данными, которые нужны боту. Хэндлеры работают только через этот интерфейс,
+    # так что хранилище можно подменить (SQLite в проде, память — для бенчмарков и тестовых ботов).
+    # Пользователи возвращаются как UserRecord (колонки таблицы users).
+    @abstractmethod
+    def init(self):
+        ...
+
+    def close(self):
+        pass
+
+    async def write(self, method, user_id, *args, **kwargs):
+        # Запись одного пользователя из хэндлера: await storage.write("add_pushups", user_id, count).
+        # Здесь — обычный вызов; ShardedStorage выполняет её в потоке шарда, не занимая event loop
+        return getattr(self, method)(user_id, *args, **kwargs)
+
+    @abstractmethod
+    def subscribe(self, listener):
+        ...
+
+    # --- Пользователи ---
+    @abstractmethod
+    def add_user(self, user_id, name, start_minute, end_minute, reminders, username=None, tz=DEFAULT_TZ):
+        ...
+
+    @abstractmethod
+    def update_user_settings(self, user_id, start_minute, end_minute, reminders, tz=None):
+        ...
+
+    @abstractmethod
+    def get_user(self, user_id):
+        ...
+
+    @abstractmethod
+    def get_all_users(self):
+        ...
+
+    @abstractmethod
+    def get_all_user_ids(self):
+        ...
+
+    @abstractmethod
+    def get_users_in_timezones(self, tz_names):
+        # Список UserRecord из этих поясов
+        ...
+
+    @abstractmethod
+    def get_users(self, user_ids):
+        # Итератор UserRecord по списку id
+        ...
+
+    @abstractmethod
+    def describe_users(self):
+        # [(колонка, тип, not null, default)] — для /showtable
+        ...
+
+    @abstractmethod
+    def reset_user(self, user_id):
+        # Переносит текущий челлендж в архив; True, если было что переносить
+        ...
+
+    @abstractmethod
+    def archive_users_with_3_fails(self):
+        ...
+
+    @abstractmethod
+    def get_archive(self, user_id):
+        # Архивные челленджи пользователя: строки users плюс archived_day, archived_at, reason
+        ...
+
+    # --- Отжимания и дни ---
+    @abstractmethod
+    def add_pushups(self, user_id, count):
+        ...
+
+    @abstractmethod
+    def decrease_pushups(self, user_id, count):
+        ...
+
+    @abstractmethod
+    def get_pushups_today(self, user_id):
+        ...
+
+    @abstractmethod
+    def next_day(self, user_id):
+        ...
+
+    @abstractmethod
+    def fail_day(self, user_id):
+        ...
+
+    @abstractmethod
+    def get_fails(self, user_id):
+        ...
+
+    @abstractmethod
+    def fail_days(self, user_ids):
+        # Пачечный fail_day: итератор (user_id, fails)
+        ...
+
+    @abstractmethod
+    def next_days(self, user_ids):
+        # Пачечный next_day: итератор id
+        ...
+
+    @abstractmethod
+    def rollover_timezones(self, tz_names, day, missed=1):
+        # Новый день для поясов; выбывших и завершивших переносит в архив, возвращает их число.
+        # missed > 1 — догоняем пропущенные смены дня: пустые дни стоят жизни, на третьей — game over
+        ...
+
+    @abstractmethod
+    def get_rollover_state(self):
+        # {пояс: последний день, на который уже переключились}
+        ...
+
+    @abstractmethod
+    def save_rollover_state(self, rows):
+        ...
+
+    @abstractmethod
+    def get_timezones(self):
+        ...
+
+    # --- Флаги ---
+    @abstractmethod
+    def get_notify_fail(self, user_id):
+        ...
+
+    @abstractmethod
+    def set_notify_fail(self, user_id, value):
+        ...
+
+    @abstractmethod
+    def get_game_over(self, user_id):
+        ...
+
+    @abstractmethod
+    def set_game_over(self, user_id, value):
+        ...
+
+    @abstractmethod
+    def set_notify_fail_many(self, user_ids, value):
+        ...
+
+    @abstractmethod
+    def set_game_over_many(self, user_ids, value):
+        # Итератор id, которым поменяли флаг
+        ...
+
+    @abstractmethod
+    def set_greeted_day(self, user_id, day):
+        ...
+
+    @abstractmethod
+    def set_card_message_id(self, user_id, message_id):
+        ...
+
+    # --- Рейтинги и группы ---
+    @abstractmethod
+    def get_top_pushups_today(self, limit=5):
+        ...
+
+    @abstractmethod
+    def get_leaderboard_rows(self):
+        ...
+
+    @abstractmethod
+    def join_group(self, chat_id, title, user_id):
+        ...
+
+    @abstractmethod
+    def leave_group(self, chat_id, user_id):
+        ...
+
+    @abstractmethod
+    def get_group_top(self, chat_id, limit=5):
+        ...
+
+    @abstractmethod
+    def get_group_summary(self, chat_id):
+        ...
+
+    @abstractmethod
+    def get_groups(self):
+        ...
+
+    @abstractmethod
+    def set_group_digest_day(self, chat_id, day):
+        ...
+
+    # --- Служебное: планировщик, статистика, persistence ---
+    @abstractmethod
+    def get_scheduler_state(self, user_id):
+        ...
+
+    @abstractmethod
+    def save_scheduler_state(self, rows):
+        ...
+
+    @abstractmethod
+    def save_daily_stats(self, row):
+        ...
+
+    @abstractmethod
+    def get_weekly_summaries(self, first_day, last_day, after_user_id=0, limit=500):
+        # Итоги дней [first_day, last_day] из daily_results по активным пользователям с id > after_user_id:
+        # dict с days, completed, avg_finish_minute, hearts_lost, total_pushups и лучшим днём (best_*)
+        ...
+
+    @abstractmethod
+    def get_recipient_ids(self, after_user_id=0, limit=500):
+        # Страница id активных (не заблокировавших бота) пользователей по возрастанию
+        ...
+
+    @abstractmethod
+    def count_recipients(self):
+        ...
+
+    @abstractmethod
+    def set_active_many(self, user_ids, value):
+        # Сколько записей поменялось
+        ...
+
+    @abstractmethod
+    def create_broadcast(self, text, chat_id, total):
+        ...
+
+    @abstractmethod
+    def get_unfinished_broadcasts(self):
+        # Строки broadcasts (dict) с done=0
+        ...
+
+    @abstractmethod
+    def save_broadcast_progress(self, broadcast_id, cursor, sent, blocked, failed, done=0, message_id=None):
+        ...
+
+    @abstractmethod
+    def get_job_cursor(self, job):
+        # (period, cursor, done) или None
+        ...
+
+    @abstractmethod
+    def save_job_cursor(self, job, period, cursor, done=0):
+        ...
+
+    # --- Outbox: исходящие сообщения с доставкой хотя бы один раз ---
+    @abstractmethod
+    def enqueue_messages(self, rows):
+        # rows: (dedup_key, user_id, chat_id, kind, payload, send_after) -> сколько добавлено
+        ...
+
+    @abstractmethod
+    def enqueue_greeting(self, user_id, chat_id, day, send_after):
+        # Приветствие в очередь и greeted_day — атомарно
+        ...
+
+    @abstractmethod
+    def get_due_messages(self, now, limit=200):
+        # Строки outbox (dict, payload — dict) со status='pending' и send_after <= now
+        ...
+
+    @abstractmethod
+    def save_outbox_results(self, rows):
+        # rows: (status, send_after, outbox_id)
+        ...
+
+    @abstractmethod
+    def prune_outbox(self, before):
+        ...
+
+    @abstractmethod
+    def count_outbox(self):
+        # {status: сколько}
+        ...
+
+    @abstractmethod
+    def compact(self, pages):
+        # Шаг возврата свободного места; возвращает, сколько ещё осталось
+        ...
+
+    @abstractmethod
+    def load_conversations(self, name):
+        ...
+
+    @abstractmethod
+    def load_user_data(self, user_id):
+        ...
+
+    @abstractmethod
+    def save_persistence(self, conversations, dropped_conversations, user_data, dropped_user_data):
+        ...
+
+
+class SQLiteStorage(Storage):
+    # Обёртка над функциями db.py. Путь к файлу у экземпляра (через db.db_path), None — db.DB_PATH
+    def __init__(self, path=None):
+        self.path = path
+
+    init = _in_file(db.init_db)
+    subscribe = staticmethod(db.subscribe)
+
+    add_user = _in_file(db.add_user)
+    update_user_settings = _in_file(db.update_user_settings)
+    get_user = _in_file(db.get_user)
+    get_all_users = _in_file(db.get_all_users)
+    get_all_user_ids = _in_file(db.get_all_user_ids)
+    get_users_in_timezones = _in_file(db.get_users_in_timezones)
+    get_users = _in_file(db.get_users)
+    describe_users = _in_file(db.describe_users)
+    reset_user = _in_file(db.reset_user)
+    archive_users_with_3_fails = _in_file(db.archive_users_with_3_fails)
+    get_archive = _in_file(db.get_archive)
+
+    add_pushups = _in_file(db.add_pushups)
+    decrease_pushups = _in_file(db.decrease_pushups)
+    get_pushups_today = _in_file(db.get_pushups_today)
+    next_day = _in_file(db.next_day)
+    fail_day = _in_file(db.fail_day)
+    get_fails = _in_file(db.get_fails)
+    fail_days = _in_file(db.fail_days)
+    next_days = _in_file(db.next_days)
+    rollover_timezones = _in_file(db.rollover_timezones)
+    get_rollover_state = _in_file(db.get_rollover_state)
+    save_rollover_state = _in_file(db.save_rollover_state)
+    get_timezones = _in_file(db.get_timezones)
+
+    get_notify_fail = _in_file(db.get_notify_fail)
+    set_notify_fail = _in_file(db.set_notify_fail)
+    get_game_over = _in_file(db.get_game_over)
+    set_game_over = _in_file(db.set_game_over)
+    set_notify_fail_many = _in_file(db.set_notify_fail_many)
+    set_game_over_many = _in_file(db.set_game_over_many)
+    set_greeted_day = _in_file(db.set_greeted_day)
+    set_card_message_id = _in_file(db.set_card_message_id)
+
+    get_top_pushups_today = _in_file(db.get_top_pushups_today)
+    get_leaderboard_rows = _in_file(db.get_leaderboard_rows)
+    join_group = _in_file(db.join_group)
+    leave_group = _in_file(db.leave_group)
+    get_group_top = _in_file(db.get_group_top)
+    get_group_summary = _in_file(db.get_group_summary)
+    get_groups = _in_file(db.get_groups)
+    set_group_digest_day = _in_file(db.set_group_digest_day)
+
+    get_scheduler_state = _in_file(db.get_scheduler_state)
+    save_scheduler_state = _in_file(db.save_scheduler_state)
+    save_daily_stats = _in_file(db.save_daily_stats)
+    get_weekly_summaries = _in_file(db.get_weekly_summaries)
+    get_job_cursor = _in_file(db.get_job_cursor)
+    get_recipient_ids = _in_file(db.get_recipient_ids)
+    count_recipients = _in_file(db.count_recipients)
+    set_active_many = _in_file(db.set_active_many)
+    create_broadcast = _in_file(db.create_broadcast)
+    get_unfinished_broadcasts = _in_file(db.get_unfinished_broadcasts)
+    save_broadcast_progress = _in_file(db.save_broadcast_progress)
+    save_job_cursor = _in_file(db.save_job_cursor)
+    enqueue_messages = _in_file(db.enqueue_messages)
+    enqueue_greeting = _in_file(db.enqueue_greeting)
+    get_due_messages = _in_file(db.get_due_messages)
+    save_outbox_results = _in_file(db.save_outbox_results)
+    prune_outbox = _in_file(db.prune_outbox)
+    count_outbox = _in_file(db.count_outbox)
+    compact = _in_file(db.incremental_vacuum)
+    load_conversations = _in_file(db.load_conversations)
+    load_user_data = _in_file(db.load_user_data)
+    save_persistence = _in_file(db.save_persistence)
+
+
+def shard_paths(path, shards):
+    # /data/users.db -> /data/users.0.db … /data/users.{shards-1}.db
+    root, ext = os.path.splitext(path)
+    return [f"{root}.{i}{ext}" for i in range(shards)]
+
+
+def shard_of(user_id, shards):
+    # Стабильный хэш: шард пользователя не меняется между запусками (hash() в Python для этого не годится)
+    return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % shards
+
+
+def _routed(func):
+    # Чтение одного пользователя (user_id — первый аргумент): в его шарде, в потоке вызывающего
+    def call(self, user_id, *args, **kwargs):
+        return self._on(self._path(user_id), func, user_id, *args, **kwargs)
+    return call
+
+
+def _routed_write(func):
+    # Запись одного пользователя: в потоке его шарда, через постоянное соединение-писатель.
+    # Из хэндлера — await storage.write("имя", user_id, ...), тогда записи в разные шарды идут параллельно
+    def call(self, user_id, *args, **kwargs):
+        return self._write(self._path(user_id), func, user_id, *args, **kwargs)
+    call.db_func = func
+    return call
+
+
+def _at_home(func):
+    # Общие таблицы — в шарде 0
+    def call(self, *args, **kwargs):
+        return self._on(self.home, func, *args, **kwargs)
+    return call
+
+
+def _home_write(func):
+    def call(self, *args, **kwargs):
+        return self._write(self.home, func, *args, **kwargs)
+    return call
+
+
+class ShardedStorage(Storage):
+    # Пользователи разложены по нескольким файлам SQLite по хэшу user_id. У каждого файла своя блокировка записи,
+    # так что запись пользователя из одного шарда не ждёт записи в другом. В шарде пользователя — всё, что
+    # привязано к нему: users, архив, daily_results, scheduler_state, outbox, user_data, участие в группах.
+    # Общие таблицы (рассылки, курсоры задач, rollover_state, daily_stats, диалоги) — в шарде 0.
+    # У каждого шарда свой поток с постоянным соединением-писателем: через него идут все записи и операции
+    # по всем пользователям (по шардам параллельно, выдачи сливаются heapq.merge). Чтения одного пользователя —
+    # в потоке вызывающего. Функции db.py те же — файл и соединение выбираются через db.db_path и db.connection.
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.home = self.paths[0]
+        self._shards = {path: i for i, path in enumerate(self.paths)}
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard{i}") for i in range(len(self.paths))
+        ]
+        self._writers = [None] * len(self.paths)
+
+    def _path(self, user_id):
+        return self.paths[shard_of(user_id, len(self.paths))]
+
+    _on = staticmethod(_call_in)
+
+    def _in_shard(self, shard, func, *args, **kwargs):
+        # Выполняется в потоке шарда. Уведомления подписчиков копятся и возвращаются вызывающему
+        conn = self._writers[shard]
+        if conn is None:
+            conn = self._writers[shard] = db.open_writer(self.paths[shard])
+        changes = []
+        path_token = db.db_path.set(self.paths[shard])
+        conn_token = db.connection.set(conn)
+        publish_token = db.publishing.set(changes)
+        try:
+            return func(*args, **kwargs), changes
+        finally:
+            # Упавшая на середине функция не должна оставить открытую транзакцию следующей записи
+            if conn.in_transaction:
+                conn.rollback()
+            db.publishing.reset(publish_token)
+            db.connection.reset(conn_token)
+            db.db_path.reset(path_token)
+
+    def _write(self, path, func, *args, **kwargs):
+        shard = self._shards[path]
+        result, changes = self._executors[shard].submit(self._in_shard, shard, func, *args, **kwargs).result()
+        db._deliver(changes)
+        return result
+
+    async def write(self, method, user_id, *args, **kwargs):
+        shard = shard_of(user_id, len(self.paths))
+        func = getattr(type(self), method).db_func
+        result, changes = await asyncio.get_running_loop().run_in_executor(
+            self._executors[shard], functools.partial(self._in_shard, shard, func, user_id, *args, **kwargs)
+        )
+        db._deliver(changes)
+        return result
+
+    def _each(self, func, *args):
+        # func на всех шардах параллельно -> результаты в порядке шардов.
+        # Уведомления отбрасываем — вызывающий сам перечитывает подписчиков, один раз
+        futures = [executor.submit(self._in_shard, shard, func, *args) for shard, executor in enumerate(self._executors)]
+        return [future.result()[0] for future in futures]
+
+    def _by_shard(self, user_ids):
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self._path(user_id), []).append(user_id)
+        return groups.items()
+
+    def close(self):
+        # Соединения-писатели закрываются в своих потоках
+        for shard, executor in enumerate(self._executors):
+            if self._writers[shard] is not None:
+                executor.submit(self._writers[shard].release).result()
+                self._writers[shard] = None
+
+    def init(self):
+        for path in self.paths:
+            self._on(path, db.init_db)
+
+    subscribe = staticmethod(db.subscribe)
+
+    # --- Пользователи ---
+    add_user = _routed_write(db.add_user)
+    update_user_settings = _routed_write(db.update_user_settings)
+    get_user = _routed(db.get_user)
+    reset_user = _routed_write(db.reset_user)
+    get_archive = _routed(db.get_archive)
+
+    def get_all_users(self):
+        return [u for rows in self._each(db.get_all_users) for u in rows]
+
+    def get_all_user_ids(self):
+        return [user_id for ids in self._each(db.get_all_user_ids) for user_id in ids]
+
+    def get_users_in_timezones(self, tz_names):
+        return [u for rows in self._each(db.get_users_in_timezones, tz_names) for u in rows]
+
+    def get_users(self, user_ids):
+        for path, ids in self._by_shard(user_ids):
+            yield from self._on(path, lambda ids: list(db.get_users(ids)), ids)
+
+    describe_users = _at_home(db.describe_users)
+
+    def archive_users_with_3_fails(self):
+        archived = sum(self._each(db.archive_users_with_3_fails))
+        db._publish_reload()
+        return archived
+
+    # --- Отжимания и дни ---
+    add_pushups = _routed_write(db.add_pushups)
+    decrease_pushups = _routed_write(db.decrease_pushups)
+    get_pushups_today = _routed(db.get_pushups_today)
+    next_day = _routed_write(db.next_day)
+    fail_day = _routed_write(db.fail_day)
+    get_fails = _routed(db.get_fails)
+
+    def _bulk(self, func, user_ids):
+        # Пачечные операции по шардам сразу, а не при итерации результата
+        return iter([item for path, ids in self._by_shard(user_ids) for item in self._write(path, func, ids)])
+
+    def fail_days(self, user_ids):
+        return self._bulk(db.fail_days, user_ids)
+
+    def next_days(self, user_ids):
+        return self._bulk(db.next_days, user_ids)
+
+    def rollover_timezones(self, tz_names, day, missed=1):
+        if not tz_names:
+            return
+        # rollover_state пишет каждый шард, читается из шарда 0
+        archived = sum(self._each(db.rollover_timezones, tz_names, day, missed))
+        db._publish_reload()
+        return archived
+
+    get_rollover_state = _at_home(db.get_rollover_state)
+    save_rollover_state = _home_write(db.save_rollover_state)
+
+    def get_timezones(self):
+        return list(dict.fromkeys(tz_name for tz_names in self._each(db.get_timezones) for tz_name in tz_names))
+
+    # --- Флаги ---
+    get_notify_fail = _routed(db.get_notify_fail)
+    set_notify_fail = _routed_write(db.set_notify_fail)
+    get_game_over = _routed(db.get_game_over)
+    set_game_over = _routed_write(db.set_game_over)
+    set_greeted_day = _routed_write(db.set_greeted_day)
+    set_card_message_id = _routed_write(db.set_card_message_id)
+
+    def set_notify_fail_many(self, user_ids, value):
+        return sum(self._write(path, db.set_notify_fail_many, ids, value) for path, ids in self._by_shard(user_ids))
+
+    def set_game_over_many(self, user_ids, value):
+        return iter([
+            user_id
+            for path, ids in self._by_shard(user_ids)
+            for user_id in self._write(path, db.set_game_over_many, ids, value)
+        ])
+
+    # --- Рейтинги и группы ---
+    def get_top_pushups_today(self, limit=5):
+        return list(islice(heapq.merge(*self._each(db.get_top_pushups_today, limit), key=_top_key), limit))
+
+    def get_leaderboard_rows(self):
+        return [u for rows in self._each(db.get_leaderboard_rows) for u in rows]
+
+    def join_group(self, chat_id, title, user_id):
+        # Строка groups появляется в шардах участников; get_groups их объединяет
+        return self._write(self._path(user_id), db.join_group, chat_id, title, user_id)
+
+    def leave_group(self, chat_id, user_id):
+        return self._write(self._path(user_id), db.leave_group, chat_id, user_id)
+
+    def get_group_top(self, chat_id, limit=5):
+        return list(islice(heapq.merge(*self._each(db.get_group_top, chat_id, limit), key=_top_key), limit))
+
+    def get_group_summary(self, chat_id):
+        summaries = self._each(db.get_group_summary, chat_id)
+        return {key: sum(summary[key] for summary in summaries) for key in summaries[0]}
+
+    def get_groups(self):
+        groups = {}
+        for rows in self._each(db.get_groups):
+            for row in rows:
+                groups.setdefault(row["chat_id"], row)
+        return list(groups.values())
+
+    def set_group_digest_day(self, chat_id, day):
+        self._each(db.set_group_digest_day, chat_id, day)
+
+    # --- Служебное: планировщик, статистика, persistence ---
+    get_scheduler_state = _routed(db.get_scheduler_state)
+
+    def save_scheduler_state(self, rows):
+        by_path = {}
+        for row in rows:
+            by_path.setdefault(self._path(row[0]), []).append(row)
+        for path, shard_rows in by_path.items():
+            self._write(path, db.save_scheduler_state, shard_rows)
+
+    save_daily_stats = _home_write(db.save_daily_stats)
+
+    def get_weekly_summaries(self, first_day, last_day, after_user_id=0, limit=500):
+        pages = self._each(db.get_weekly_summaries, first_day, last_day, after_user_id, limit)
+        return list(islice(heapq.merge(*pages, key=lambda row: row["user_id"]), limit))
+
+    def get_recipient_ids(self, after_user_id=0, limit=500):
+        return list(islice(heapq.merge(*self._each(db.get_recipient_ids, after_user_id, limit)), limit))
+
+    def count_recipients(self):
+        return sum(self._each(db.count_recipients))
+
+    def set_active_many(self, user_ids, value):
+        return sum(self._write(path, db.set_active_many, ids, value) for path, ids in self._by_shard(user_ids))
+
+    create_broadcast = _home_write(db.create_broadcast)
+    get_unfinished_broadcasts = _at_home(db.get_unfinished_broadcasts)
+    save_broadcast_progress = _home_write(db.save_broadcast_progress)
+    get_job_cursor = _at_home(db.get_job_cursor)
+    save_job_cursor = _home_write(db.save_job_cursor)
+
+    # --- Outbox: строка живёт в шарде пользователя, наружу id = локальный id * шардов + номер шарда ---
+    def enqueue_messages(self, rows):
+        by_path = {}
+        for row in rows:
+            by_path.setdefault(self._path(row[1]), []).append(row)
+        return sum(self._write(path, db.enqueue_messages, shard_rows) for path, shard_rows in by_path.items())
+
+    enqueue_greeting = _routed_write(db.enqueue_greeting)
+
+    def get_due_messages(self, now, limit=200):
+        shards = len(self.paths)
+        pages = self._each(db.get_due_messages, now, limit)
+        for shard, rows in enumerate(pages):
+            for row in rows:
+                row["outbox_id"] = row["outbox_id"] * shards + shard
+        return list(islice(heapq.merge(*pages, key=lambda row: (row["send_after"], row["outbox_id"])), limit))
+
+    def save_outbox_results(self, rows):
+        shards = len(self.paths)
+        by_path = {}
+        for status, send_after, outbox_id in rows:
+            by_path.setdefault(self.paths[outbox_id % shards], []).append((status, send_after, outbox_id // shards))
+        for path, shard_rows in by_path.items():
+            self._write(path, db.save_outbox_results, shard_rows)
+
+    def prune_outbox(self, before):
+        return sum(self._each(db.prune_outbox, before))
+
+    def count_outbox(self):
+        counts = {}
+        for shard_counts in self._each(db.count_outbox):
+            for status, count in shard_counts.items():
+                counts[status] = counts.get(status, 0) + count
+        return counts
+
+    def compact(self, pages):
+        return sum(self._each(db.incremental_vacuum, pages))
+
+    load_conversations = _at_home(db.load_conversations)
+    load_user_data = _routed(db.load_user_data)
+
+    def save_persistence(self, conversations, dropped_conversations, user_data, dropped_user_data):
+        # Диалоги — в шарде 0, user_data — в шардах пользователей; по транзакции на шард
+        by_path = {self.home: ([], [])}
+        for row in user_data:
+            by_path.setdefault(self._path(row[0]), ([], []))[0].append(row)
+        for user_id in dropped_user_data:
+            by_path.setdefault(self._path(user_id), ([], []))[1].append(user_id)
+        for path, (rows, dropped) in by_path.items():
+            if path == self.home:
+                self._write(path, db.save_persistence, conversations, dropped_conversations, rows, dropped)
+            elif rows or dropped:
+                self._write(path, db.save_persistence, [], [], rows, dropped)
+
+
+# Колонки users в порядке таблицы: (имя, тип, not null, default)
+USER_COLUMNS = (
+    ("user_id", "INTEGER", 0, None),
+    ("username", "TEXT", 0, None),
+    ("name", "TEXT", 0, None),
+    ("start_minute", "INTEGER", 1, None),
+    ("end_minute", "INTEGER", 1, None),
+    ("reminders", "INTEGER", 1, None),
+    ("pushups_today", "INTEGER", 1, "0"),
+    ("last_day", "INTEGER", 0, None),
+    ("fails", "INTEGER", 1, "0"),
+    ("completed_at", "INTEGER", 0, None),
+    ("registered_day", "INTEGER", 1, None),
+    ("notify_fail", "INTEGER", 1, "0"),
+    ("game_over", "INTEGER", 1, "0"),
+    ("greeted_day", "INTEGER", 0, None),
+    ("tz", "TEXT", 1, f"'{DEFAULT_TZ}'"),
+    ("card_message_id", "INTEGER", 0, None),
+    ("game_over_day", "INTEGER", 0, None),
+    ("active", "INTEGER", 1, "1"),
+    ("current_streak", "INTEGER", 1, "0"),
+    ("longest_streak", "INTEGER", 1, "0"),
+    ("best_finish_minute", "INTEGER", 0, None),
+    ("total_pushups", "INTEGER", 1, "0"),
+)
+
+
+# Как в db.get_leaderboard_rows: остальные поля записи не заполняются
+LEADERBOARD_FIELDS = ("user_id", "username", "name", "pushups_today", "completed_at", "tz")
+
+
+class MemoryStorage(Storage):
+    # Всё в памяти процесса: словари плюс индексы по поясу и по группам.
+    # Для бенчмарков, симуляций и тестовых ботов — после перезапуска ничего не остаётся.
+    def __init__(self):
+        self._listeners = []
+        self.users = {}
+        self.archive = {}  # {user_id: [архивные строки]}
+        self.by_tz = {}  # {tz: set(user_id)}
+        self.groups = {}
+        self.group_members = {}  # {chat_id: {user_id: joined_day}}
+        self.scheduler_state = {}  # {user_id: {kind: (last_fire, next_fire)}}
+        self.daily_stats = {}
+        self.daily_results = {}  # {user_id: {day: (pushups, finish_minute)}}
+        self.job_cursors = {}
+        self.broadcasts = {}
+        self.rollover_state = {}
+        self.outbox = {}  # {outbox_id: строка}
+        self.outbox_keys = {}  # {dedup_key: outbox_id}
+        self.outbox_seq = 0
+        self.conversations = {}  # {name: {conv_key: state}}
+        self.user_data = {}
+
+    def init(self):
+        pass
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def _publish(self, user_id, before):
+        if not self._listeners:
+            return
+        after = self.get_user(user_id)
+        for listener in self._listeners:
+            listener.user_changed(before, after)
+
+    def _publish_reload(self):
+        for listener in self._listeners:
+            listener.reloaded()
+
+    def _update(self, user_id, **fields):
+        u = self.users.get(user_id)
+        if u is None:
+            return
+        before = u.copy() if self._listeners else None
+        for field, value in fields.items():
+            setattr(u, field, value)
+        self._publish(user_id, before)
+
+    def _is_today(self, u):
+        return u.last_day == local_day(u.tz)
+
+    # --- Пользователи ---
+    def add_user(self, user_id, name, start_minute, end_minute, reminders, username=None, tz=DEFAULT_TZ):
+        if user_id in self.users:
+            return
+        today = local_day(tz)
+        u = UserRecord(
+            user_id=user_id, username=username, name=name,
+            start_minute=start_minute, end_minute=end_minute, reminders=reminders,
+            pushups_today=0, last_day=today, fails=0, registered_day=today,
+            notify_fail=0, game_over=0, tz=sys.intern(tz), active=1,
+            current_streak=0, longest_streak=0, total_pushups=0,
+        )
+        self.users[user_id] = u
+        self.by_tz.setdefault(tz, set()).add(user_id)
+        self._publish(user_id, None)
+
+    def update_user_settings(self, user_id, start_minute, end_minute, reminders, tz=None):
+        u = self.users.get(user_id)
+        if u is None:
+            return
+        if tz is not None and tz != u.tz:
+            self.by_tz[u.tz].discard(user_id)
+            self.by_tz.setdefault(tz, set()).add(user_id)
+        self._update(user_id, start_minute=start_minute, end_minute=end_minute, reminders=reminders, tz=tz or u.tz)
+
+    def get_user(self, user_id):
+        u = self.users.get(user_id)
+        return u.copy() if u else None
+
+    def get_all_users(self):
+        return [u.copy() for u in self.users.values()]
+
+    def get_users_in_timezones(self, tz_names):
+        return [self.users[user_id].copy() for tz_name in dict.fromkeys(tz_names) for user_id in self.by_tz.get(tz_name, ())]
+
+    def get_all_user_ids(self):
+        return list(self.users)
+
+    def get_users(self, user_ids):
+        for user_id in dict.fromkeys(user_ids):
+            u = self.users.get(user_id)
+            if u is not None:
+                yield u.copy()
+
+    def describe_users(self):
+        return list(USER_COLUMNS)
+
+    def _archive(self, user_id, reason=None):
+        u = self.users.pop(user_id)
+        self.by_tz[u.tz].discard(user_id)
+        self.scheduler_state.pop(user_id, None)
+        for members in self.group_members.values():
+            members.pop(user_id, None)
+        self.archive.setdefault(user_id, []).append(dict(
+            u.as_dict(),
+            archived_day=local_day(u.tz),
+            archived_at=int(time.time()),
+            reason=reason or ("game_over" if u.game_over else "finished"),
+        ))
+        return u
+
+    def reset_user(self, user_id):
+        self.scheduler_state.pop(user_id, None)
+        if user_id not in self.users:
+            return False
+        before = self._archive(user_id, "reset")
+        self._publish(user_id, before)
+        return True
+
+    def archive_users_with_3_fails(self):
+        purged = [user_id for user_id, u in self.users.items() if u.fails >= 3]
+        for user_id in purged:
+            self._archive(user_id, "purged")
+        self._publish_reload()
+        return len(purged)
+
+    def get_archive(self, user_id):
+        return [dict(row) for row in self.archive.get(user_id, [])]
+
+    # --- Отжимания и дни ---
+    def add_pushups(self, user_id, count):
+        u = self.users.get(user_id)
+        if not u or u.game_over:
+            return False
+        today_pushups = u.pushups_today if self._is_today(u) else 0
+        completed_at = u.completed_at if self._is_today(u) else None
+        new_pushups = min(today_pushups + count, 100)
+        if new_pushups >= 100 and not completed_at:
+            completed_at = int(time.time())
+        self._update(
+            user_id, pushups_today=new_pushups, last_day=local_day(u.tz), completed_at=completed_at,
+            total_pushups=u.total_pushups + new_pushups - today_pushups,
+        )
+        return True
+
+    def decrease_pushups(self, user_id, count):
+        u = self.users.get(user_id)
+        if not u or u.game_over:
+            return False
+        cur_pushups = u.pushups_today if self._is_today(u) else 0
+        new_pushups = max(0, cur_pushups - count)
+        completed_at = u.completed_at
+        if cur_pushups >= 100 and new_pushups < 100:
+            completed_at = None
+        self._update(
+            user_id, pushups_today=new_pushups, last_day=local_day(u.tz), completed_at=completed_at,
+            total_pushups=max(u.total_pushups - (cur_pushups - new_pushups), 0),
+        )
+        return new_pushups
+
+    def get_pushups_today(self, user_id):
+        u = self.users.get(user_id)
+        if not u or u.game_over or not self._is_today(u):
+            return 0
+        return u.pushups_today
+
+    def next_day(self, user_id):
+        u = self.users.get(user_id)
+        if not u or u.game_over:
+            return
+        self._update(user_id, pushups_today=0, last_day=local_day(u.tz), completed_at=None)
+
+    def fail_day(self, user_id):
+        u = self.users.get(user_id)
+        if not u or u.game_over:
+            return 0
+        fails = min(u.fails + 1, 3)
+        self._update(user_id, fails=fails, pushups_today=0, last_day=local_day(u.tz), completed_at=None)
+        return fails
+
+    def get_fails(self, user_id):
+        u = self.users.get(user_id)
+        return u.fails if u and not u.game_over else 0
+
+    def _active(self, user_ids):
+        return [user_id for user_id in dict.fromkeys(user_ids) if user_id in self.users and not self.users[user_id].game_over]
+
+    def fail_days(self, user_ids):
+        return iter([(user_id, self.fail_day(user_id)) for user_id in self._active(user_ids)])
+
+    def next_days(self, user_ids):
+        active = self._active(user_ids)
+        for user_id in active:
+            self.next_day(user_id)
+        return iter(active)
+
+    def rollover_timezones(self, tz_names, day, missed=1):
+        if not tz_names:
+            return
+        last = day - missed
+        empty_days = missed - 1
+        offset = utc_offset_seconds(tz_names[0], last)
+        start_offset = utc_offset_seconds(tz_names[0], day)
+        now = int(time.time())
+        for tz_name in tz_names:
+            for user_id in self.by_tz.get(tz_name, ()):
+                u = self.users[user_id]
+                if u.game_over:
+                    continue
+                finished = u.last_day == last and u.pushups_today >= 100
+                finish_minute = (u.completed_at + offset) % 86400 // 60 if finished and u.completed_at else None
+                if u.last_day == last:
+                    self.daily_results.setdefault(user_id, {})[last] = (u.pushups_today, finish_minute)
+                for empty_day in range(max(last + 1, u.registered_day), day):
+                    self.daily_results.setdefault(user_id, {}).setdefault(empty_day, (0, None))
+                u.longest_streak = max(u.longest_streak, u.current_streak + 1 if finished else 0)
+                u.current_streak = u.current_streak + 1 if finished and not empty_days else 0
+                if finish_minute is not None:
+                    u.best_finish_minute = min(u.best_finish_minute if u.best_finish_minute is not None else 1440, finish_minute)
+                if u.pushups_today < 100 or empty_days:
+                    u.fails = min(u.fails + (u.pushups_today < 100) + empty_days, 3)
+                    if u.active:
+                        kind = "game_over" if u.fails >= 3 else "fail_missed" if empty_days else "fail"
+                        send_after = day * 86400 + u.start_minute * 60 - start_offset if not empty_days else now
+                        payload = {"fails": u.fails, "day": day, "missed": empty_days}
+                        self._enqueue(f"fail:{user_id}:{day}", user_id, user_id, kind, payload, send_after)
+                u.pushups_today = 0
+                u.last_day = day
+                u.completed_at = None
+                if u.fails >= 3:
+                    u.game_over = 1
+                    u.game_over_day = day
+        done = [
+            user_id
+            for tz_name in tz_names
+            for user_id in self.by_tz.get(tz_name, ())
+            if (self.users[user_id].game_over and (self.users[user_id].game_over_day or 0) < day)
+            or day - self.users[user_id].registered_day >= CHALLENGE_DAYS
+        ]
+        for user_id in done:
+            self._archive(user_id)
+        for tz_name in tz_names:
+            self.rollover_state[tz_name] = day
+        self._publish_reload()
+        return len(done)
+
+    def get_rollover_state(self):
+        return dict(self.rollover_state)
+
+    def save_rollover_state(self, rows):
+        for tz_name, day in rows:
+            self.rollover_state[tz_name] = day
+
+    def get_timezones(self):
+        return [tz_name for tz_name, user_ids in self.by_tz.items() if user_ids]
+
+    # --- Флаги ---
+    def get_notify_fail(self, user_id):
+        u = self.users.get(user_id)
+        return u.notify_fail if u else 0
+
+    def set_notify_fail(self, user_id, value):
+        if user_id in self.users:
+            self.users[user_id].notify_fail = value
+
+    def get_game_over(self, user_id):
+        u = self.users.get(user_id)
+        return u.game_over if u else 0
+
+    def set_game_over(self, user_id, value):
+        u = self.users.get(user_id)
+        if u is None:
+            return
+        self._update(user_id, game_over=value, game_over_day=local_day(u.tz) if value else None)
+
+    def set_notify_fail_many(self, user_ids, value):
+        changed = [user_id for user_id in dict.fromkeys(user_ids) if user_id in self.users]
+        for user_id in changed:
+            self.users[user_id].notify_fail = value
+        return len(changed)
+
+    def set_game_over_many(self, user_ids, value):
+        changed = [user_id for user_id in dict.fromkeys(user_ids) if user_id in self.users]
+        for user_id in changed:
+            self.set_game_over(user_id, value)
+        return iter(changed)
+
+    def set_greeted_day(self, user_id, day):
+        if user_id in self.users:
+            self.users[user_id].greeted_day = day
+
+    def set_card_message_id(self, user_id, message_id):
+        if user_id in self.users:
+            self.users[user_id].card_message_id = message_id
+
+    # --- Рейтинги и группы ---
+    def _today_active(self, user_ids):
+        for user_id in user_ids:
+            u = self.users.get(user_id)
+            if u and not u.game_over and self._is_today(u):
+                yield u
+
+    def get_top_pushups_today(self, limit=5):
+        return [u.copy() for u in heapq.nsmallest(limit, self._today_active(self.users), key=_top_key)]
+
+    def get_leaderboard_rows(self):
+        return [
+            UserRecord(**{field: getattr(u, field) for field in LEADERBOARD_FIELDS})
+            for u in self._today_active(self.users)
+            if u.pushups_today > 0
+        ]
+
+    def join_group(self, chat_id, title, user_id):
+        group = self.groups.setdefault(chat_id, {"chat_id": chat_id, "title": title, "tz": DEFAULT_TZ, "digest_day": None})
+        group["title"] = title
+        members = self.group_members.setdefault(chat_id, {})
+        if user_id in members:
+            return False
+        members[user_id] = local_day(DEFAULT_TZ)
+        return True
+
+    def leave_group(self, chat_id, user_id):
+        return self.group_members.get(chat_id, {}).pop(user_id, None) is not None
+
+    def get_group_top(self, chat_id, limit=5):
+        members = self.group_members.get(chat_id, {})
+        return [u.copy() for u in heapq.nsmallest(limit, self._today_active(members), key=_top_key)]
+
+    def get_group_summary(self, chat_id):
+        summary = {"members": 0, "finished": 0, "pushups": 0}
+        for user_id in self.group_members.get(chat_id, {}):
+            u = self.users.get(user_id)
+            if not u or u.game_over:
+                continue
+            summary["members"] += 1
+            if self._is_today(u):
+                summary["pushups"] += u.pushups_today
+                if u.pushups_today >= 100:
+                    summary["finished"] += 1
+        return summary
+
+    def get_groups(self):
+        return [dict(group) for group in self.groups.values()]
+
+    def set_group_digest_day(self, chat_id, day):
+        if chat_id in self.groups:
+            self.groups[chat_id]["digest_day"] = day
+
+    # --- Служебное ---
+    def get_scheduler_state(self, user_id):
+        return dict(self.scheduler_state.get(user_id, {}))
+
+    def save_scheduler_state(self, rows):
+        for user_id, kind, last_fire, next_fire in rows:
+            self.scheduler_state.setdefault(user_id, {})[kind] = (last_fire, next_fire)
+
+    def save_daily_stats(self, row):
+        self.daily_stats[(row[0], row[1])] = row
+
+    def get_weekly_summaries(self, first_day, last_day, after_user_id=0, limit=500):
+        summaries = []
+        for user_id in sorted(user_id for user_id in self.daily_results if user_id > after_user_id):
+            u = self.users.get(user_id)
+            if u is None or u.game_over or not u.active:
+                continue
+            days = [
+                (day, pushups, finish_minute)
+                for day, (pushups, finish_minute) in self.daily_results[user_id].items()
+                if first_day <= day <= last_day and day >= u.registered_day
+            ]
+            if not days:
+                continue
+            finishes = [finish_minute for _day, _pushups, finish_minute in days if finish_minute is not None]
+            best_day, best_pushups, best_finish = min(
+                days, key=lambda d: (-d[1], d[2] is None, d[2] or 0, d[0])
+            )
+            summaries.append({
+                "user_id": user_id,
+                "username": u.username,
+                "name": u.name,
+                "days": len(days),
+                "completed": sum(pushups >= 100 for _day, pushups, _finish in days),
+                "avg_finish_minute": round(sum(finishes) / len(finishes)) if finishes else None,
+                "hearts_lost": sum(pushups < 100 for _day, pushups, _finish in days),
+                "total_pushups": sum(pushups for _day, pushups, _finish in days),
+                "best_day": best_day,
+                "best_pushups": best_pushups,
+                "best_finish_minute": best_finish,
+            })
+            if len(summaries) == limit:
+                break
+        return summaries
+
+    def get_recipient_ids(self, after_user_id=0, limit=500):
+        return heapq.nsmallest(limit, (user_id for user_id, u in self.users.items() if user_id > after_user_id and u.active))
+
+    def count_recipients(self):
+        return sum(1 for u in self.users.values() if u.active)
+
+    def set_active_many(self, user_ids, value):
+        changed = [
+            user_id for user_id in dict.fromkeys(user_ids)
+            if user_id in self.users and self.users[user_id].active != value
+        ]
+        for user_id in changed:
+            self.users[user_id].active = value
+        return len(changed)
+
+    def create_broadcast(self, text, chat_id, total):
+        broadcast_id = len(self.broadcasts) + 1
+        now = int(time.time())
+        self.broadcasts[broadcast_id] = {
+            "broadcast_id": broadcast_id, "text": text, "chat_id": chat_id, "message_id": None, "total": total,
+            "cursor": 0, "sent": 0, "blocked": 0, "failed": 0, "done": 0, "created_at": now, "updated_at": now,
+        }
+        return broadcast_id
+
+    def get_unfinished_broadcasts(self):
+        return [dict(row) for row in self.broadcasts.values() if not row["done"]]
+
+    def save_broadcast_progress(self, broadcast_id, cursor, sent, blocked, failed, done=0, message_id=None):
+        row = self.broadcasts[broadcast_id]
+        row.update(cursor=cursor, sent=sent, blocked=blocked, failed=failed, done=done, updated_at=int(time.time()))
+        if message_id is not None:
+            row["message_id"] = message_id
+
+    def get_job_cursor(self, job):
+        return self.job_cursors.get(job)
+
+    def save_job_cursor(self, job, period, cursor, done=0):
+        self.job_cursors[job] = (period, cursor, done)
+
+    def _enqueue(self, dedup_key, user_id, chat_id, kind, payload, send_after):
+        if dedup_key in self.outbox_keys:
+            return 0
+        self.outbox_seq += 1
+        outbox_id = self.outbox_seq
+        now = int(time.time())
+        self.outbox[outbox_id] = {
+            "outbox_id": outbox_id, "dedup_key": dedup_key, "user_id": user_id, "chat_id": chat_id, "kind": kind,
+            "payload": dict(payload), "send_after": send_after, "attempts": 0, "status": "pending",
+            "created_at": now, "updated_at": now,
+        }
+        self.outbox_keys[dedup_key] = outbox_id
+        return 1
+
+    def enqueue_messages(self, rows):
+        return sum(self._enqueue(*row) for row in rows)
+
+    def enqueue_greeting(self, user_id, chat_id, day, send_after):
+        added = self._enqueue(f"greeting:{user_id}:{day}", user_id, chat_id, "greeting", {"day": day}, send_after)
+        self.set_greeted_day(user_id, day)
+        return added
+
+    def get_due_messages(self, now, limit=200):
+        due = (row for row in self.outbox.values() if row["status"] == "pending" and row["send_after"] <= now)
+        return [
+            dict(row, payload=dict(row["payload"]))
+            for row in heapq.nsmallest(limit, due, key=lambda row: (row["send_after"], row["outbox_id"]))
+        ]
+
+    def save_outbox_results(self, rows):
+        now = int(time.time())
+        for status, send_after, outbox_id in rows:
+            row = self.outbox[outbox_id]
+            row.update(status=status, send_after=send_after, attempts=row["attempts"] + 1, updated_at=now)
+
+    def prune_outbox(self, before):
+        old = [row for row in self.outbox.values() if row["status"] != "pending" and row["updated_at"] < before]
+        for row in old:
+            del self.outbox[row["outbox_id"]]
+            del self.outbox_keys[row["dedup_key"]]
+        return len(old)
+
+    def count_outbox(self):
+        counts = {}
+        for row in self.outbox.values():
+            counts[row["status"]] = counts.get(row["status"], 0) + 1
+        return counts
+
+    def compact(self, pages):
+        return 0
+
+    def load_conversations(self, name):
+        return list(self.conversations.get(name, {}).items())
+
+    def load_user_data(self, user_id):
+        return self.user_data.get(user_id)
+
+    def save_persistence(self, conversations, dropped_conversations, user_data, dropped_user_data):
+        for name, conv_key, state in conversations:
+            self.conversations.setdefault(name, {})[conv_key] = state
+        for name, conv_key in dropped_conversations:
+            self.conversations.get(name, {}).pop(conv_key, None)
+        for user_id, data in user_data:
+            self.user_data[user_id] = data
+        for user_id in dropped_user_data:
+            self.user_data.pop(user_id, None)
@@ -0,0 +1,223 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+import uuid
+
+from telegram.request import HTTPXRequest
+
+# Апдейт дольше порога (мс) пишется целиком, со всеми спанами, в ротируемый JSONL.
+# Настройки читаются в setup_logging — после load_dotenv
+TRACE_SLOW_MS = 1000.0
+
+_current = contextvars.ContextVar("trace", default=None)
+_listener = None
+slow_logger = logging.getLogger("trace.slow")
+
+
+class Trace:
+    __slots__ = ("trace_id", "update_id", "user", "kind", "started", "spans", "finished")
+
+    def __init__(self, update_id, user, kind):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.update_id = update_id
+        self.user = user
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.spans = []
+        self.finished = False
+
+    def add(self, kind, name, started, duration, **extra):
+        # Задачи, созданные из хэндлера, наследуют контекст — после конца апдейта их спаны не нужны
+        if self.finished:
+            return
+        span = {
+            "kind": kind,
+            "name": name,
+            "at_ms": round((started - self.started) * 1000, 2),
+            "ms": round(duration * 1000, 2),
+        }
+        span.update(extra)
+        self.spans.append(span)
+
+    def record(self, total):
+        return {
+            "ts": int(time.time()),
+            "trace_id": self.trace_id,
+            "update_id": self.update_id,
+            "user": self.user,
+            "kind": self.kind,
+            "total_ms": round(total * 1000, 2),
+            "spans": self.spans,
+        }
+
+
+def describe_update(update):
+    message = getattr(update, "effective_message", None)
+    if getattr(update, "callback_query", None) is not None:
+        return f"callback:{(update.callback_query.data or '').split(':')[0]}"
+    if message is not None and message.text:
+        if message.text.startswith("/"):
+            return message.text.split()[0].split("@")[0]
+        return "text"
+    return "other"
+
+
+def start_trace(update, user):
+    trace = Trace(getattr(update, "update_id", None), user, describe_update(update))
+    return trace, _current.set(trace)
+
+
+def finish_trace(trace, token):
+    _current.reset(token)
+    trace.finished = True
+    total = time.perf_counter() - trace.started
+    if total * 1000 >= TRACE_SLOW_MS:
+        slow_logger.info(json.dumps(trace.record(total), ensure_ascii=False, default=str))
+
+
+def current_trace_id():
+    trace = _current.get()
+    return trace.trace_id if trace else "-"
+
+
+class span:
+    # with span("db", "get_user"): ... — без активного трейса почти ничего не стоит
+    __slots__ = ("kind", "name", "extra", "trace", "started")
+
+    def __init__(self, kind, name, **extra):
+        self.kind = kind
+        self.name = name
+        self.extra = extra
+
+    def __enter__(self):
+        self.trace = _current.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            if exc_type is not None:
+                self.extra["error"] = exc_type.__name__
+            self.trace.add(self.kind, self.name, self.started, time.perf_counter() - self.started, **self.extra)
+        return False
+
+
+def event(kind, name, **extra):
+    # Мгновенное событие (попадание/промах кэша и т.п.)
+    trace = _current.get()
+    if trace is not None:
+        trace.add(kind, name, time.perf_counter(), 0, **extra)
+
+
+def traced(kind, name=None):
+    def decorator(func):
+        label = name or func.__name__
+        if inspect.isgeneratorfunction(func):
+            return _traced_generator(func, kind, label)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(kind, label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _traced_generator(func, kind, label):
+    # Запрос генератора выполняется при итерации, а не при вызове: спан — суммарное время внутри next(),
+    # паузы потребителя между элементами в него не входят
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = _current.get()
+        if trace is None:
+            yield from func(*args, **kwargs)
+            return
+        started = time.perf_counter()
+        busy = 0.0
+        rows = 0
+        extra = {}
+        items = func(*args, **kwargs)
+        try:
+            while True:
+                step = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    busy += time.perf_counter() - step
+                    return
+                except BaseException as e:
+                    busy += time.perf_counter() - step
+                    extra["error"] = type(e).__name__
+                    raise
+                busy += time.perf_counter() - step
+                rows += 1
+                yield item
+        finally:
+            items.close()
+            trace.add(kind, label, started, busy, rows=rows, **extra)
+
+    return wrapper
+
+
+class TracedHTTPXRequest(HTTPXRequest):
+    # Каждый вызов Bot API — отдельный спан, имя = метод API
+    async def do_request(self, url, method, *args, **kwargs):
+        with span("bot_api", url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = current_trace_id()
+        return True
+
+
+def setup_logging(level=logging.INFO):
+    # Обработчики с вводом-выводом живут в отдельном потоке QueueListener,
+    # в event loop только кладём запись в очередь
+    global _listener, TRACE_SLOW_MS
+    if _listener is not None:
+        return
+    TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+    log_queue = queue.SimpleQueue()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"))
+    slow_file = logging.handlers.RotatingFileHandler(
+        os.getenv("TRACE_LOG_PATH", "/data/slow_updates.jsonl"),
+        maxBytes=int(os.getenv("TRACE_LOG_MAX_BYTES", str(5 * 1024 * 1024))),
+        backupCount=int(os.getenv("TRACE_LOG_BACKUPS", "3")),
+        encoding="utf-8",
+        delay=True,
+    )
+    slow_file.setFormatter(logging.Formatter("%(message)s"))
+    slow_file.addFilter(lambda record: record.name == slow_logger.name)
+    console.addFilter(lambda record: record.name != slow_logger.name)
+
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(TraceIdFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    slow_logger.setLevel(logging.INFO)
+
+    _listener = logging.handlers.QueueListener(log_queue, console, slow_file, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,44 @@
+import importlib.util
+
+import httpx
+
+from tracing import TracedHTTPXRequest
+
+
+def http2_available():
+    # HTTP/2 в httpx — только с пакетом h2 (python-telegram-bot[http2])
+    return importlib.util.find_spec("h2") is not None
+
+
+class PooledHTTPXRequest(TracedHTTPXRequest):
+    # HTTPXRequest с настраиваемым keep-alive: сколько простаивающих соединений держать и сколько секунд.
+    # У httpx по умолчанию соединение закрывается через 5 с простоя — между всплесками напоминаний
+    # пул пустеет, и каждый всплеск начинается с новых TCP+TLS рукопожатий.
+    # В PTB 20.6 у HTTPXRequest нет публичного параметра для httpx.Limits, поэтому лимиты
+    # подставляются во внутренние _client_kwargs и клиент пересобирается через _build_client().
+    # Это завязано на внутренности именно 20.6 — версия в requirements.txt зафиксирована из-за этого.
+    def __init__(self, keepalive_connections=None, keepalive_expiry=5.0, **kwargs):
+        super().__init__(**kwargs)
+        pool_size = kwargs.get("connection_pool_size", 1)
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size if keepalive_connections is None else keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = self._build_client()
+
+
+def build_request(pool_size, connect_timeout, read_timeout, write_timeout, pool_timeout,
+                  http2="auto", keepalive_connections=None, keepalive_expiry=5.0):
+    # http2: auto — если установлен h2, "1"/"0" — принудительно
+    use_http2 = http2_available() if http2 == "auto" else http2 in ("1", "true", "yes")
+    return PooledHTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        write_timeout=write_timeout,
+        pool_timeout=pool_timeout,
+        http_version="2" if use_http2 else "1.1",
+        keepalive_connections=keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
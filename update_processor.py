@@ -0,0 +1,89 @@
+import logging
+from collections import deque
+
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+from tracing import finish_trace, span, start_trace
+
+logger = logging.getLogger(__name__)
+
+SLOW_DOWN_TEXT = "Повільніше! 🐢 Забагато повідомлень підряд — зачекай кілька секунд і спробуй ще раз."
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей обрабатываются параллельно, одного пользователя — строго по очереди.
+    # Пока у пользователя идёт обработка, новые апдейты встают в его очередь и не занимают слоты:
+    # их дорабатывает та же задача, так что один "спамер" не блокирует остальных.
+    # С flood_guard лишние апдейты отбрасываются ещё до очереди (см. flood.py).
+    def __init__(self, max_concurrent_updates, flood_guard=None):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}
+        self.flood_guard = flood_guard
+
+    @staticmethod
+    def update_key(update):
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return f"chat:{chat.id}"
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if self.flood_guard is not None and key is not None and not self.flood_guard.allow(key):
+            coroutine.close()
+            if self.flood_guard.should_notify(key):
+                await self._slow_down(update)
+            return
+        # Трейс открываем сразу: ожидание в очереди пользователя тоже часть задержки
+        trace, token = start_trace(update, key)
+        if key is None:
+            await self._run(trace, token, coroutine)
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append((trace, token, coroutine))
+            return
+        queue = self._queues[key] = deque([(trace, token, coroutine)])
+        try:
+            while queue:
+                queued_trace, queued_token, queued = queue.popleft()
+                try:
+                    await self._run(queued_trace, queued_token, queued)
+                except Exception as e:
+                    logger.exception(f"Update processing failed for {key}: {e}")
+        finally:
+            self._queues.pop(key, None)
+
+    @staticmethod
+    async def _slow_down(update):
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(SLOW_DOWN_TEXT)
+            elif update.effective_message and update.effective_chat.type == "private":
+                await update.effective_message.reply_text(SLOW_DOWN_TEXT)
+        except TelegramError as e:
+            logger.warning(f"Failed to send slow down notice: {e}")
+
+    @staticmethod
+    async def _run(trace, token, coroutine):
+        # Апдейты из очереди выполняются в задаче первого — переключаем текущий трейс на свой
+        if token.var.get() is not trace:
+            token = token.var.set(trace)
+        try:
+            with span("dispatch", trace.kind):
+                await coroutine
+        finally:
+            finish_trace(trace, token)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        for queue in self._queues.values():
+            while queue:
+                queue.popleft()[2].close()
+        self._queues.clear()